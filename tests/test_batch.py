@@ -0,0 +1,43 @@
+import os
+import threading
+
+from toearthly.core import io, repository
+from toearthly.scripts import batch, run
+
+
+def test_repos_are_converted_apart(tmp_path, monkeypatch):
+    repos = [str(tmp_path / name) for name in ("api", "broken", "web")]
+    # Every repo is converting at once before any of them finishes
+    together = threading.Barrier(len(repos), timeout=5)
+
+    def convert(input_dir, earthfile_path, workflow, dockerfile, *args) -> None:
+        together.wait()
+        io.write_debug("seen.txt", f"{workflow} {dockerfile}")
+        if input_dir.endswith("broken"):
+            raise ValueError("no luck")
+        io.write(dockerfile, earthfile_path)
+
+    monkeypatch.setattr(
+        io, "find_first_workflow", lambda d: ("ci.yml", os.path.basename(d))
+    )
+    monkeypatch.setattr(
+        repository,
+        "find_first_dockerfile",
+        lambda d, workflow: ("", f"FROM {workflow}\n"),
+    )
+    monkeypatch.setattr(run, "convert", convert)
+    results = batch.main(repos, len(repos), False)
+
+    assert [(os.path.basename(r.input_dir), r.ok) for r in results] == [
+        ("api", True),
+        ("broken", False),
+        ("web", True),
+    ]
+    assert results[1].error == "ValueError: no luck"
+    for repo in repos:
+        name = os.path.basename(repo)
+        debug = os.path.join(repo, batch.DEBUG_DIR_NAME)
+        assert io.read(os.path.join(debug, "seen.txt")) == f"{name} FROM {name}\n"
+    assert "no luck" in io.read(os.path.join(repos[1], batch.DEBUG_DIR_NAME, "log.txt"))
+    assert io.read(os.path.join(repos[2], "Earthfile")) == "FROM web\n"
+    assert not os.path.exists(os.path.join(repos[1], "Earthfile"))
@@ -0,0 +1,70 @@
+import pytest
+
+from toearthly.core import budget, io, llm, program
+
+
+# A template counting a token per character of its variables and the request
+class Sized(program.Template):
+    def measure(self, llm, level=0, static=None, **kwargs) -> int:
+        variables = self.levels(static)[level]
+        return sum(len("".join(value)) for value in variables.values()) + sum(
+            len(value) for value in kwargs.values()
+        )
+
+
+@pytest.fixture
+def template(tmp_path, monkeypatch):
+    monkeypatch.setattr(budget, "CONTEXT_WINDOWS", {"small": 1000, "large": 4000})
+    monkeypatch.setattr(budget, "FALLBACK_MODELS", {"small": "large"})
+    monkeypatch.setattr(budget, "SAFETY_MARGIN", 0)
+    monkeypatch.setattr(llm, "get", lambda model: model)
+    static = {
+        "examples": ["e" * 300, "f" * 300],
+        "tips": "t" * 200,
+        "basics": "b" * 100,
+    }
+    with io.use_debug_dir(str(tmp_path)):
+        yield Sized("", "", lambda: static, trim=["examples", "tips", "basics"])
+
+
+def test_fits_untrimmed(template):
+    plan = budget.fit(template, "small", {"answer": 90}, request="hi")
+    assert plan == budget.Plan("small", 0, {"answer": 90}, 902)
+
+
+def test_sections_are_dropped_in_order(template):
+    plan = budget.fit(template, "small", {"answer": 450}, request="hi")
+    assert plan == budget.Plan("small", 2, {"answer": 450}, 302)
+    variables = template.levels()[plan.level]
+    assert variables["examples"] == []
+    assert variables["tips"] == "t" * 200
+
+
+def test_gens_are_shrunk_before_a_larger_model(template):
+    outputs = {"plan": 600, "answer": 400}
+    plan = budget.fit(template, "small", outputs, request="x" * 200)
+    assert plan.model == "small"
+    assert plan.level == len(template.levels()) - 1
+    # 800 tokens are left once every section is dropped
+    assert plan.max_tokens == {"plan": 480, "answer": 320}
+
+
+def test_larger_model_when_shrinking_is_not_enough(template):
+    plan = budget.fit(template, "small", {"answer": 1000}, request="x" * 900)
+    assert plan == budget.Plan("large", 0, {"answer": 1000}, 1800)
+
+
+def test_nothing_fits(template):
+    with pytest.raises(ValueError, match="does not fit"):
+        budget.fit(template, "small", {"answer": 100}, request="x" * 4000)
+
+
+def test_estimate_is_about_four_characters_a_token():
+    encoding = llm.EstimatedEncoding("test")
+    text = "FROM python:3.11\n\n    RUN pip install -r requirements.txt\n"
+    tokens = encoding.encode(text)
+    assert encoding.decode(tokens) == text
+    # Whitespace runs aren't tokens of their own
+    assert len(encoding.encode("a    b\n\n\n c")) == 3
+    characters = len("".join(text.split()))
+    assert characters / 4 <= len(tokens) <= characters / 3
@@ -0,0 +1,119 @@
+import os
+import subprocess
+import sys
+import textwrap
+import types
+
+import pytest
+
+from toearthly.core import cache, constants
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def llm_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "CACHE_PATH", str(tmp_path / "cache.sqlite3"))
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", types.SimpleNamespace(time=clock))
+    made = cache.LLMCache()
+    made.clock = clock
+    return made
+
+
+def test_key_covers_the_request():
+    keys = cache.LLMCache()
+    key = keys.key("gpt-4", MESSAGES, 0, 100)
+    assert key == keys.key("gpt-4", [dict(m) for m in MESSAGES], 0, 100)
+    assert len({
+        key,
+        keys.key("gpt-3.5-turbo", MESSAGES, 0, 100),
+        keys.key("gpt-4", [{"role": "user", "content": "hi"}], 0, 100),
+        keys.key("gpt-4", MESSAGES, 0.5, 100),
+        keys.key("gpt-4", MESSAGES, 0, 200),
+    }) == 5
+
+
+def test_round_trip(llm_cache):
+    llm_cache["a"] = {"text": "answer"}
+    assert "a" in llm_cache
+    assert llm_cache["a"] == {"text": "answer"}
+    assert "b" not in llm_cache
+    # A new instance reads it from the file
+    assert cache.LLMCache()["a"] == {"text": "answer"}
+
+
+def test_entries_expire(llm_cache, monkeypatch):
+    monkeypatch.setattr(constants, "CACHE_TTL_SECONDS", 100)
+    llm_cache["a"] = "answer"
+    llm_cache.clock.now += 50
+    assert "a" in llm_cache
+    llm_cache.clock.now += 100
+    assert "a" not in llm_cache
+    assert "a" not in cache.LLMCache()
+
+
+def test_least_recently_used_are_evicted(llm_cache, monkeypatch):
+    value = "x" * 1000
+    monkeypatch.setattr(constants, "CACHE_MAX_BYTES", 3500)
+    for key in "abc":
+        llm_cache[key] = value
+    # Read from memory, which still counts as a use
+    assert llm_cache["a"] == value
+    llm_cache["d"] = value
+    fresh = cache.LLMCache()
+    assert [key for key in "abcd" if key in fresh] == ["a", "c", "d"]
+
+
+WRITER = textwrap.dedent(
+    """
+    import sys
+    from toearthly.core import cache, constants
+
+    constants.CACHE_PATH = sys.argv[1]
+    for n in range(50):
+        cache.llm_cache[f"{sys.argv[2]}{n}"] = n
+    print(cache.llm_cache[f"{sys.argv[3]}0"] if len(sys.argv) > 3 else "")
+    """
+)
+
+
+def test_processes_share_the_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.sqlite3")
+    monkeypatch.setattr(constants, "CACHE_PATH", path)
+    writers = [
+        subprocess.Popen(
+            [sys.executable, "-c", WRITER, path, prefix],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+        )
+        for prefix in "ab"
+    ]
+    for writer in writers:
+        writer.communicate()
+        assert writer.returncode == 0
+    shared = cache.LLMCache()
+    assert all(f"{prefix}{n}" in shared for prefix in "ab" for n in range(50))
+    mode = shared._connection().execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+
+    # And what this process writes, another reads
+    shared["mine0"] = "from the parent"
+    reader = subprocess.run(
+        [sys.executable, "-c", WRITER, path, "c", "mine"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert reader.stdout.strip() == "from the parent"
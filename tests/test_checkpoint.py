@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from toearthly.core import checkpoint, constants, io, repository
+
+
+@pytest.fixture
+def debug_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "RESUME", True)
+    with io.use_debug_dir(str(tmp_path)):
+        yield tmp_path
+
+
+def test_resume_reuses_unchanged_stage(debug_dir):
+    calls = []
+    checkpoint.run_stage("stage", lambda x: calls.append(x) or x.upper(), "a")
+    assert checkpoint.run_stage("stage", lambda x: calls.append(x), "a") == "A"
+    assert calls == ["a"]
+
+
+@pytest.mark.parametrize(
+    "setting, value",
+    [("FAST", True), ("LLM_MODEL", "gpt-4-32k"), ("LLM_ROUTES", "data/router.json")],
+)
+def test_settings_change_the_key(debug_dir, monkeypatch, setting, value):
+    before = checkpoint.inputs_key("stage", "a")
+    monkeypatch.setattr(constants, setting, value)
+    assert checkpoint.inputs_key("stage", "a") != before
+
+
+def test_listing_leaves_out_generated_earthfile(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "main.py").write_text("print()\n")
+    earthfile = os.path.join(repo, "Earthfile")
+    with io.use_debug_dir(str(tmp_path / "debug")):
+        before = repository.file_structure(str(repo), "", [earthfile])
+        (repo / "Earthfile").write_text("VERSION 0.7\n")
+        repository._indexes.clear()
+        after = repository.file_structure(str(repo), "", [earthfile])
+    assert before == after
+    assert "Earthfile" not in after
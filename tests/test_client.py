@@ -0,0 +1,136 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from toearthly.core import client, constants, provider
+
+ANSWER = {
+    "id": "chatcmpl-1",
+    "object": "chat.completion",
+    "choices": [
+        {
+            "index": 0,
+            "message": {"role": "assistant", "content": "hi"},
+            "finish_reason": "stop",
+        }
+    ],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1},
+}
+
+
+# An OpenAI compatible endpoint answering with the scripted (status, headers,
+# delay) replies in turn, then with success
+class Endpoint:
+    def __init__(self, *replies) -> None:
+        self.replies = list(replies)
+        self.requests = 0
+        self.lock = threading.Lock()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                self.rfile.read(int(self.headers["Content-Length"]))
+                with endpoint.lock:
+                    endpoint.requests += 1
+                    reply = endpoint.replies.pop(0) if endpoint.replies else None
+                status, headers, delay = reply or (200, {}, 0)
+                time.sleep(delay)
+                body = ANSWER if status == 200 else {"error": {"message": "no"}}
+                data = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except OSError:
+                    pass
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1"
+
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(constants, "LLM_ATTEMPTS", 3)
+    monkeypatch.setattr(constants, "LLM_BACKOFF", 0.01)
+    monkeypatch.setattr(constants, "LLM_TIMEOUT", 5.0)
+    monkeypatch.setattr(constants, "LLM_HEDGE", False)
+    servers = []
+
+    def start(*replies, concurrency: int = 2):
+        server = Endpoint(*replies)
+        servers.append(server)
+        config = provider.Config("gpt-4", server.url, 1.0, 5.0, concurrency)
+        return server, provider.Provider(config)
+
+    yield start
+    for server in servers:
+        server.server.shutdown()
+    client._latencies.clear()
+
+
+def ask(sender: provider.Provider, stage: str = "test"):
+    async def request():
+        return await sender.create(
+            model="gpt-4", messages=[{"role": "user", "content": "hello"}]
+        )
+
+    return asyncio.run(client.call(request, stage))
+
+
+def test_retries_after_rate_limit(endpoint):
+    server, sender = endpoint((429, {"Retry-After": "0.2"}, 0))
+    start = time.monotonic()
+    assert ask(sender)["choices"][0]["message"]["content"] == "hi"
+    assert server.requests == 2
+    assert time.monotonic() - start >= 0.2
+
+
+def test_retries_server_errors_until_exhausted(endpoint):
+    server, sender = endpoint((500, {}, 0), (503, {}, 0), (502, {}, 0))
+    with pytest.raises(client.RetriesExhausted):
+        ask(sender)
+    assert server.requests == 3
+
+
+@pytest.mark.parametrize("status", [400, 401])
+def test_client_errors_are_not_retried(endpoint, status):
+    server, sender = endpoint((status, {}, 0))
+    with pytest.raises(Exception) as raised:
+        ask(sender)
+    assert not isinstance(raised.value, client.RetriesExhausted)
+    assert server.requests == 1
+
+
+def test_deadline_retries_and_frees_the_slot(endpoint, monkeypatch):
+    monkeypatch.setattr(constants, "LLM_TIMEOUT", 0.3)
+    # One slot, held by a request the server sits on past the deadline
+    server, sender = endpoint((200, {}, 2), concurrency=1)
+    start = time.monotonic()
+    assert ask(sender)["choices"][0]["message"]["content"] == "hi"
+    assert server.requests == 2
+    assert time.monotonic() - start < 1.5
+
+
+def test_hedges_slow_requests(endpoint, monkeypatch):
+    monkeypatch.setattr(constants, "LLM_HEDGE", True)
+    for _ in range(client.HEDGE_MIN_SAMPLES):
+        client.record("test", 0.05)
+    server, sender = endpoint((200, {}, 2))
+    start = time.monotonic()
+    assert ask(sender)["choices"][0]["message"]["content"] == "hi"
+    assert server.requests == 2
+    assert time.monotonic() - start < 1.5
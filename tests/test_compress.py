@@ -0,0 +1,57 @@
+import yaml
+
+from toearthly.core import compress
+
+WORKFLOW = """\
+name: Release
+on:
+  push:
+    branches: [main]  # only main
+permissions:
+  contents: read
+jobs:
+  version:
+    runs-on: ubuntu-latest
+    timeout-minutes: 5
+    outputs:
+      tag: ${{ steps.tag.outputs.tag }}
+    steps:
+      - id: tag
+        name: tag
+        run: |
+          echo "tag=$(git describe --tags)" >> "$GITHUB_OUTPUT"
+
+      - if: ${{ steps.tag.outputs.tag != '' }}
+        continue-on-error: true
+        run: echo ${{ steps.tag.outputs.tag }}
+  publish:
+    needs: version
+    runs-on: ubuntu-latest
+    steps:
+      - run: docker build -t acme/app:${{ needs.version.outputs.tag }} .
+"""
+
+
+def test_step_outputs_survive():
+    compact = compress.workflow(WORKFLOW)
+    raw = yaml.safe_load(compact)
+    version = raw["jobs"]["version"]
+    assert version["outputs"] == {"tag": "${{ steps.tag.outputs.tag }}"}
+    assert version["steps"][0]["id"] == "tag"
+    assert version["steps"][1]["if"] == "${{ steps.tag.outputs.tag != '' }}"
+    assert raw["jobs"]["publish"]["needs"] == "version"
+
+
+def test_drops_what_the_build_does_not_need():
+    compact = compress.workflow(WORKFLOW)
+    raw = yaml.safe_load(compact)
+    assert list(raw) == ["name", "jobs"]
+    assert "timeout-minutes" not in raw["jobs"]["version"]
+    assert "continue-on-error" not in raw["jobs"]["version"]["steps"][1]
+    assert "#" not in compact
+    assert "\n\n" not in compact
+    assert len(compact) < len(WORKFLOW)
+
+
+def test_unreadable_workflow_is_kept():
+    assert compress.workflow("jobs: [") == "jobs: ["
@@ -0,0 +1,93 @@
+import pytest
+
+from toearthly.core import dockerfile
+
+MULTISTAGE = """\
+ARG GO_VERSION=1.21
+FROM golang:${GO_VERSION} AS builder
+WORKDIR /src
+COPY go.mod go.sum ./
+RUN go mod download
+COPY . .
+RUN go build -o /out/app ./cmd/app
+
+FROM alpine:3.18
+COPY --from=builder /out/app /usr/local/bin/app
+ENTRYPOINT ["/usr/local/bin/app", "--port", "8080"]
+"""
+
+
+def test_instructions_join_continuations():
+    found = dockerfile.instructions("FROM a\nRUN echo 1 \\\n  # note\n  && echo 2\n")
+    assert found == [
+        dockerfile.Instruction("FROM", "a", 1),
+        dockerfile.Instruction("RUN", "echo 1 && echo 2", 2),
+    ]
+
+
+def test_multistage_copy_from_saves_artifact():
+    earthfile = dockerfile.translate(MULTISTAGE)
+    assert "ARG --global GO_VERSION=1.21" in earthfile
+    assert "builder:\n  FROM golang:${GO_VERSION}\n" in earthfile
+    assert "  SAVE ARTIFACT /out/app\n" in earthfile
+    assert "  COPY +builder/app /usr/local/bin/app\n" in earthfile
+    assert '  ENTRYPOINT ["/usr/local/bin/app", "--port", "8080"]\n' in earthfile
+    assert "  SAVE IMAGE docker:latest\n" in earthfile
+    assert earthfile.endswith("all:\n  BUILD +docker\n")
+
+
+def test_base_stage_is_renamed():
+    earthfile = dockerfile.translate("FROM python:3.11 AS base\nFROM base\nRUN x\n")
+    assert "deps:\n  FROM python:3.11\n" in earthfile
+    assert "docker:\n  FROM +deps\n" in earthfile
+
+
+def test_image_settings_from_workflow():
+    workflow = "run: docker build -t acme/app:$(date +%s) --target builder .\n"
+    workflow += "run: docker push acme/app\n"
+    earthfile = dockerfile.translate(MULTISTAGE, workflow)
+    assert "  SAVE IMAGE --push acme/app:latest\n" in earthfile
+    assert earthfile.index("SAVE IMAGE") < earthfile.index("\ndocker:")
+
+
+def test_json_copy_and_dropped_flags():
+    earthfile = dockerfile.translate(
+        'FROM a\nCOPY --link --chown=1:1 ["src", "/app/"]\n'
+    )
+    assert "  COPY --chown=1:1 src /app/\n" in earthfile
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        'FROM a\nCOPY ["a b", "/b"]\n',
+        "FROM a\nCOPY \"a b\" /b\n",
+        "FROM a\nCOPY [\"a\", \n",
+        "FROM a\nCOPY a\n",
+        "FROM a\nADD https://example.com/x.tgz /x\n",
+        "FROM a\nRUN <<EOF\necho\nEOF\n",
+        "FROM a\nRUN --mount=type=secret,id=x cat /run/secrets/x\n",
+        "FROM a\nCOPY --from=nginx:latest /etc/nginx /etc/nginx\n",
+        "FROM a\nONBUILD RUN x\n",
+        "RUN x\nFROM a\n",
+    ],
+)
+def test_unsupported(content):
+    with pytest.raises(dockerfile.UnsupportedInstruction):
+        dockerfile.translate(content)
+
+
+def test_copy_paths_move_from_the_build_context():
+    earthfile = dockerfile.translate(
+        "FROM a AS build\nCOPY . /src\nCOPY /go.mod src/*.go ./\n"
+        "FROM b\nCOPY --from=build /src/app /app\n",
+        context="services/api",
+    )
+    assert "  COPY services/api /src\n" in earthfile
+    assert "  COPY services/api/go.mod services/api/src/*.go ./\n" in earthfile
+    assert "  COPY +build/app /app\n" in earthfile
+
+
+def test_copy_from_outside_the_build_context():
+    with pytest.raises(dockerfile.UnsupportedInstruction):
+        dockerfile.translate("FROM a\nCOPY ../shared /shared\n", context="api")
@@ -0,0 +1,140 @@
+import pytest
+
+from toearthly.core import earthfile as parser
+
+VALID = """VERSION 0.7
+FROM python:3.11
+WORKDIR /app
+
+deps:
+    COPY requirements.txt .
+    RUN pip install -r requirements.txt
+    SAVE ARTIFACT /usr/local/lib/python3.11
+
+build:
+    FROM +deps
+    COPY --dir src .
+    RUN python -m compileall src
+    SAVE ARTIFACT src AS LOCAL out/src
+
+test:
+    FROM +build
+    COPY +build/src ./checked
+    IF [ -f tests ]
+        RUN pytest
+    ELSE
+        RUN echo "no tests"
+    END
+
+docker:
+    FROM +build
+    ENTRYPOINT ["python", "-m", "src"]
+    SAVE IMAGE --push app:latest
+
+all:
+    BUILD +test
+    BUILD +docker
+"""
+
+
+def test_accepts_valid_earthfile():
+    earthfile = parser.parse(VALID)
+    assert earthfile.version == "0.7"
+    assert [t.name for t in earthfile.targets] == [
+        "deps", "build", "test", "docker", "all"
+    ]
+    assert earthfile.target("docker").images == ["app:latest"]
+    assert earthfile.target("build").artifacts[0].local == "out/src"
+
+
+def test_accepts_functions():
+    content = """VERSION 0.8
+FROM alpine
+
+INSTALL:
+    FUNCTION
+    ARG package
+    RUN apk add $package
+
+UDC:
+    COMMAND
+    RUN echo old style
+
+build:
+    DO +INSTALL --package=curl
+    DO +UDC
+"""
+    earthfile = parser.parse(content)
+    assert earthfile.target("INSTALL").commands[0].name == "FUNCTION"
+
+
+def test_continued_lines_and_comments():
+    content = """VERSION 0.7
+FROM alpine
+
+# a comment
+build:
+    RUN echo one \\
+        two
+"""
+    (command,) = parser.parse(content).target("build").commands
+    assert command.args == ("echo one two",)
+
+
+@pytest.mark.parametrize(
+    "content, message",
+    [
+        ("FROM alpine\nbuild:\nRUN echo\n", "must be indented"),
+        ("FROM alpine\nbase:\n  RUN echo\n", "can't be named base"),
+        ("FROM alpine\na:\n  RUN x\na:\n  RUN y\n", "duplicate target a"),
+        ("FROM alpine\na:\n  RUNN echo\n", "unknown command RUNN"),
+        ("FROM alpine\na:\n  run echo\n", "expected a command"),
+        ("FROM alpine\na:\n  IF true\n    RUN x\n", "IF is missing its END"),
+        ("FROM alpine\na:\n  END\n", "END without an open block"),
+        ("FROM alpine\na:\n  ELSE\n", "ELSE without IF"),
+        ("FROM alpine\na:\n  COPY onlyone\n", "COPY needs at least 2"),
+        ("FROM alpine\na:\n  ARG 1bad\n", "invalid ARG name"),
+        ("FROM alpine\na:\n  COPY 'open .\n", "unbalanced quotes"),
+        ("FROM alpine\na:\n  VERSION 0.7\n", "VERSION must be the first"),
+        ("  FROM alpine\n", "unexpected indentation"),
+    ],
+)
+def test_rejects_invalid_syntax(content, message):
+    with pytest.raises(parser.EarthfileSyntaxError, match=message):
+        parser.parse(content)
+
+
+def test_rejects_missing_target():
+    content = "FROM alpine\nall:\n  BUILD +missing\n"
+    with pytest.raises(parser.EarthfileSyntaxError) as e:
+        parser.parse(content)
+    assert "unknown target +missing" in e.value.message
+    assert e.value.target == "all"
+    assert e.value.line == 3
+
+
+def test_rejects_copy_without_artifact_path():
+    content = "FROM alpine\nbuild:\n  SAVE ARTIFACT x\nuse:\n  COPY +build .\n"
+    with pytest.raises(parser.EarthfileSyntaxError, match="needs an artifact path"):
+        parser.parse(content)
+
+
+def test_rejects_copy_from_target_without_save_artifact():
+    content = "FROM alpine\nbuild:\n  RUN make\nuse:\n  COPY +build/app .\n"
+    with pytest.raises(parser.EarthfileSyntaxError) as e:
+        parser.parse(content)
+    assert "+build has no SAVE ARTIFACT" in e.value.message
+    # Reported where the fix belongs
+    assert e.value.target == "build"
+
+
+def test_artifacts_inherited_through_from():
+    content = (
+        "FROM alpine\nbuild:\n  SAVE ARTIFACT app\nimage:\n  FROM +build\n"
+        "use:\n  COPY +image/app .\n"
+    )
+    parser.parse(content)
+
+
+def test_remote_references_are_not_checked():
+    parser.parse("FROM alpine\na:\n  BUILD github.com/earthly/earthly+lint\n")
@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import toearthly.core
+
+CORE = os.path.dirname(toearthly.core.__file__)
+MODULES = sorted(name[:-3] for name in os.listdir(CORE) if name.endswith(".py"))
+
+
+# Each module imported first, in a fresh interpreter, so import cycles show up
+@pytest.mark.parametrize("module", MODULES)
+def test_core_module_imports_on_its_own(module):
+    subprocess.run(
+        [sys.executable, "-c", f"import toearthly.core.{module}"],
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(CORE)),
+    )
@@ -0,0 +1,21 @@
+import os
+
+from toearthly.core import io, trace
+
+
+def test_debug_dir_handles_close_on_exit(tmp_path):
+    directory = str(tmp_path)
+    with io.use_debug_dir(directory):
+        with io.use_debug_dir(directory):
+            io.log("inner")
+            with trace.span("stage", "one"):
+                pass
+        # Still in use by the outer block
+        io.log("outer")
+        assert len(trace.spans()) == 1
+    assert not [path for path in io._appenders if path.startswith(directory)]
+    assert directory not in trace._finished
+    with open(os.path.join(directory, "log.txt")) as f:
+        assert f.read() == "inner\nouter\n"
+    with open(os.path.join(directory, trace.TRACE)) as f:
+        assert len(f.readlines()) == 1
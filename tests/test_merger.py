@@ -0,0 +1,80 @@
+import pytest
+
+from toearthly.core import earthfile as parser
+from toearthly.core import io, markdown, merger
+
+
+def fixture(name: str) -> str:
+    return io.relative_read(f"data/merge/{name}")
+
+
+def test_merge_matches_bundled_example():
+    first, second = fixture("in1a.Earthfile"), fixture("in1b.Earthfile")
+    merged = merger.merge(first, "workflow.yml", second, "Dockerfile")
+    (expected,) = markdown.extract_code_blocks(fixture("out1.md"))
+    assert merged.strip() == expected.strip()
+
+
+def test_merge_drops_repeated_targets():
+    first = "VERSION 0.7\nFROM alpine\n\nbuild:\n  RUN make\n\nall:\n  BUILD +build\n"
+    second = "VERSION 0.6\nFROM alpine\n\ncompile:\n  RUN make\n"
+    merged = merger.merge(first, "workflow.yml", second, "Dockerfile")
+    earthfile = parser.parse(merged)
+    assert [t.name for t in earthfile.targets] == ["build", "all"]
+    assert earthfile.version == "0.7"
+
+
+def test_merge_prefixes_clashes_with_project_name():
+    first = "VERSION 0.7\nFROM alpine\n\nbuild:\n  RUN make\n"
+    second = "VERSION 0.7\nFROM alpine\n\nbuild:\n  RUN make docs\n"
+    merged = merger.merge(first, "workflow.yml", second, "docs.yml")
+    assert "docs-build:\n  RUN make docs" in merged
+    all_target = parser.parse(merged).target("all")
+    assert [c.args for c in all_target.commands] == [("+build",), ("+docs-build",)]
+
+
+def test_merge_conflicts():
+    broken = "FROM alpine\nbuild:\n  RUNN make\n"
+    with pytest.raises(merger.MergeConflict, match="does not parse"):
+        merger.merge(broken, "workflow.yml", "FROM alpine\n", "Dockerfile")
+    locally = "LOCALLY\n\nbuild:\n  RUN make\n"
+    with pytest.raises(merger.MergeConflict, match="LOCALLY in its base"):
+        merger.merge("FROM alpine\na:\n  RUN x\n", "a.yml", locally, "Dockerfile")
+
+
+STITCH_BASE = "VERSION 0.7\nFROM python:3.11\n\n"
+DEPS = "deps:\n  COPY requirements.txt .\n  RUN pip install -r requirements.txt\n\n"
+
+
+def test_stitch_follows_needs():
+    lint = STITCH_BASE + DEPS + "lint:\n  FROM +deps\n  RUN flake8\n"
+    test = STITCH_BASE + DEPS + "test:\n  FROM +deps\n  RUN pytest\n"
+    build = STITCH_BASE + "build:\n  RUN make\n"
+    docs = "VERSION 0.7\nFROM node:20\n\nsite:\n  RUN npm run docs\n"
+    jobs = [
+        ("lint", lint + "\nall:\n  BUILD +lint\n", ()),
+        ("test_unit", test + "\nall:\n  BUILD +test\n", ("lint",)),
+        ("build", build + "\nall:\n  BUILD +build\n", ("lint", "test_unit")),
+        ("docs", docs + "\nall:\n  BUILD +site\n", ()),
+    ]
+    earthfile = parser.parse(merger.stitch(jobs))
+    targets = {t.name: t for t in earthfile.targets}
+    assert [t.name for t in earthfile.targets].count("deps") == 1
+    builds = {
+        name: [c.args[0] for c in targets[name].commands if c.name == "BUILD"]
+        for name in ("lint", "test-unit", "build", "docs", "all")
+    }
+    assert builds == {
+        "lint": ["+lint-steps"],
+        "test-unit": ["+lint", "+test"],
+        "build": ["+lint", "+test-unit", "+build-steps"],
+        "docs": ["+site"],
+        "all": ["+build", "+docs"],
+    }
+    assert targets["site"].commands[0].args == ("node:20",)
+
+
+def test_stitch_rejects_clashing_job_ids():
+    content = "VERSION 0.7\nFROM alpine\n\nx:\n  RUN true\n"
+    with pytest.raises(merger.MergeConflict):
+        merger.stitch([("a-b", content, ()), ("a_b", content, ())])
@@ -0,0 +1,88 @@
+import pytest
+
+from toearthly.core import constants, io, repair
+from toearthly.prompt import earthfile_repair
+from toearthly.scripts import run
+
+BROKEN = """VERSION 0.7
+FROM alpine
+
+build:
+    RUNN make
+    SAVE ARTIFACT out
+
+test:
+    FROM +build
+    RUN make test
+"""
+
+
+# Stands in for the LLM, answering each request with the next of `answers`
+class Fixer:
+    def __init__(self, *answers: str) -> None:
+        self.answers = list(answers)
+        self.requests = []
+
+    def __call__(self, snippet: str, error: str, outline: str) -> str:
+        self.requests.append((snippet, error, outline))
+        return self.answers.pop(0) if self.answers else snippet
+
+
+@pytest.fixture(autouse=True)
+def debug_dir(tmp_path):
+    with io.use_debug_dir(str(tmp_path)):
+        yield
+
+
+def test_only_the_failing_target_is_sent():
+    fixer = Fixer("build:\n    RUN make\n    SAVE ARTIFACT out")
+    fixed = repair.repair(BROKEN, fixer, 2)
+    assert fixed == BROKEN.replace("RUNN", "RUN")
+    ((snippet, error, outline),) = fixer.requests
+    assert snippet == "build:\n    RUNN make\n    SAVE ARTIFACT out"
+    assert "line 5" in error
+    assert "<part to fix>" in outline
+    assert "RUN make test" in outline
+
+
+def test_converges_over_several_attempts():
+    fixer = Fixer(
+        "build:\n    RUN make\n    SAVE ARTIFACT out\n    COPYY x y",
+        "build:\n    RUN make\n    SAVE ARTIFACT out",
+    )
+    assert repair.repair(BROKEN, fixer, 3) == BROKEN.replace("RUNN", "RUN")
+    assert len(fixer.requests) == 2
+    assert "COPYY" in fixer.requests[1][0]
+
+
+def test_stops_at_the_attempt_limit():
+    answers = [f"build:\n    RUNN make {n}" for n in range(5)]
+    fixer = Fixer(*answers)
+    fixed = repair.repair(BROKEN, fixer, 2)
+    assert len(fixer.requests) == 2
+    assert "RUNN make 1" in fixed
+
+
+def test_stops_when_a_fix_changes_nothing():
+    fixer = Fixer()
+    assert repair.repair(BROKEN, fixer, 5) == BROKEN
+    assert len(fixer.requests) == 1
+
+
+def test_verify_raises_the_last_error(monkeypatch):
+    monkeypatch.setattr(constants, "REPAIR_ATTEMPTS", 1)
+    monkeypatch.setattr(constants, "VERIFY_EARTHFILE", True)
+    monkeypatch.setattr(constants, "VERIFY_WITH_EARTHLY", False)
+    fixer = Fixer("build:\n    RUN make\n    COPYY x y")
+    monkeypatch.setattr(earthfile_repair, "prompt", fixer)
+    with pytest.raises(ValueError, match="COPYY") as raised:
+        run.verify(BROKEN)
+    assert "RUNN" not in str(raised.value)
+    assert len(fixer.requests) == 1
+
+
+def test_verify_returns_the_repaired_earthfile(monkeypatch):
+    monkeypatch.setattr(constants, "VERIFY_WITH_EARTHLY", False)
+    fixer = Fixer("build:\n    RUN make\n    SAVE ARTIFACT out")
+    monkeypatch.setattr(earthfile_repair, "prompt", fixer)
+    assert run.verify(BROKEN) == BROKEN.replace("RUNN", "RUN")
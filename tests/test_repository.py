@@ -0,0 +1,45 @@
+import os
+
+from toearthly.core import io, repository
+
+WORKFLOW = """\
+jobs:
+  build:
+    runs-on: ubuntu-latest
+    steps:
+      - run: docker build -t api services/api
+"""
+
+
+def make_repo(tmp_path, *dockerfiles):
+    repo = tmp_path / "repo"
+    for path in dockerfiles:
+        (repo / path).parent.mkdir(parents=True, exist_ok=True)
+        (repo / path).write_text("FROM alpine\n")
+    (repo / "README.md").write_text("hi\n")
+    return str(repo)
+
+
+def find(tmp_path, repo, content):
+    with io.use_debug_dir(str(tmp_path / "debug")):
+        return repository.find_dockerfile(repo, content)
+
+
+def test_root_dockerfile_first(tmp_path):
+    repo = make_repo(tmp_path, "Dockerfile", "services/api/Dockerfile")
+    found = find(tmp_path, repo, WORKFLOW)
+    assert found == os.path.join(repo, "Dockerfile")
+    assert repository.build_context(repo, found) == ""
+
+
+def test_dockerfile_where_the_workflow_works(tmp_path):
+    repo = make_repo(tmp_path, "docs/Dockerfile", "services/api/Dockerfile")
+    found = find(tmp_path, repo, WORKFLOW)
+    assert found == os.path.join(repo, "services", "api", "Dockerfile")
+    assert repository.build_context(repo, found) == "services/api"
+
+
+def test_unrelated_dockerfile_is_not_used(tmp_path):
+    repo = make_repo(tmp_path, "docs/Dockerfile")
+    assert find(tmp_path, repo, WORKFLOW) is None
+    assert repository.build_context(repo, "") == ""
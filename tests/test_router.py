@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+from toearthly.core import constants, io, llm, markdown, router
+from toearthly.core import earthfile as parser
+
+RULES = {
+    "dockerfile_to_earthfile": [
+        {"model": "gpt-3.5-turbo", "max_input_tokens": 100},
+    ],
+    "earthfile_correction": [
+        {"model": "gpt-3.5-turbo", "parses": True},
+    ],
+}
+
+
+class Encoder:
+    def encode(self, text: str):
+        return text.split()
+
+
+@pytest.fixture
+def routes(tmp_path, monkeypatch):
+    path = tmp_path / "router.json"
+    path.write_text(json.dumps(RULES))
+    monkeypatch.setattr(constants, "LLM_MODEL", "gpt-4")
+    monkeypatch.setattr(constants, "LLM_ROUTES", str(path))
+    monkeypatch.setattr(llm, "get", lambda model=None: Encoder())
+    router.routes.cache_clear()
+    with io.use_debug_dir(str(tmp_path)):
+        yield
+    router.routes.cache_clear()
+
+
+def test_off_without_routes(monkeypatch):
+    monkeypatch.setattr(constants, "LLM_ROUTES", None)
+    models = []
+    answer = router.run("dockerfile_to_earthfile", ["FROM a"], models.append)
+    assert answer is None
+    assert models == [constants.LLM_MODEL]
+
+
+def test_choose(routes):
+    assert router.choose("dockerfile_to_earthfile", 50) == "gpt-3.5-turbo"
+    assert router.choose("dockerfile_to_earthfile", 500) == "gpt-4"
+    assert router.choose("earthfile_correction", 50, parses=True) == "gpt-3.5-turbo"
+    assert router.choose("earthfile_correction", 50, parses=False) == "gpt-4"
+    assert router.choose("merge", 50) == "gpt-4"
+
+
+def test_unknown_model_is_rejected(tmp_path):
+    path = tmp_path / "bad.json"
+    path.write_text(json.dumps({"merge": [{"model": "gpt-5000"}]}))
+    with pytest.raises(router.RouteError):
+        router.routes(str(path))
+
+
+def test_accepted_answer_stays_on_the_cheap_model(routes):
+    models = []
+
+    def attempt(model: str) -> str:
+        models.append(model)
+        return "VERSION 0.7\nFROM alpine\n"
+
+    router.run("dockerfile_to_earthfile", ["FROM a"], attempt, check=parser.parse)
+    assert models == ["gpt-3.5-turbo"]
+
+
+@pytest.mark.parametrize(
+    "cheap",
+    [
+        "VERSION 0.7\nFROM alpine\nbuild:\n    RUNN make\n",
+        markdown.UnexpectedCodeBlocks("Expected 1 code block, found 0"),
+    ],
+)
+def test_rejected_answer_escalates(routes, cheap):
+    models = []
+
+    def attempt(model: str) -> str:
+        models.append(model)
+        if model == "gpt-4":
+            return "VERSION 0.7\nFROM alpine\n"
+        if isinstance(cheap, Exception):
+            raise cheap
+        return cheap
+
+    answer = router.run(
+        "dockerfile_to_earthfile", ["FROM a"], attempt, check=parser.parse
+    )
+    assert answer == "VERSION 0.7\nFROM alpine\n"
+    assert models == ["gpt-3.5-turbo", "gpt-4"]
+
+
+def test_other_errors_are_not_escalated(routes):
+    def attempt(model: str) -> str:
+        raise RuntimeError(model)
+
+    with pytest.raises(RuntimeError, match="gpt-3.5-turbo"):
+        router.run("dockerfile_to_earthfile", ["FROM a"], attempt)
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+from toearthly.core import checkpoint, constants, io
+from toearthly.core import earthfile as parser
+from toearthly.scripts import run
+
+
+def test_failed_branch_stops_the_others(tmp_path):
+    started = threading.Event()
+    stages = []
+
+    def failing() -> str:
+        started.wait(5)
+        raise ValueError("boom")
+
+    def slow() -> str:
+        for n in range(50):
+            stages.append(n)
+            started.set()
+            checkpoint.run_stage(f"stage{n}", lambda: threading.Event().wait(0.05))
+        return "done"
+
+    with io.use_debug_dir(str(tmp_path)):
+        with pytest.raises(ValueError, match="boom"):
+            run.run_branches({"failing": failing, "slow": slow}, True)
+    assert len(stages) < 50
+
+
+def test_branches_return_results(tmp_path):
+    with io.use_debug_dir(str(tmp_path)):
+        results = run.run_branches({"a": lambda: "A", "b": lambda: "B"}, True)
+    assert results == {"a": "A", "b": "B"}
+
+
+@pytest.mark.parametrize("threshold, split", [(None, False), (0, False), (3, True)])
+def test_split_jobs_threshold(monkeypatch, threshold, split):
+    monkeypatch.setattr(constants, "SPLIT_JOBS", threshold)
+    content = "jobs:\n" + "".join(
+        f"  {id}:\n    steps:\n      - run: make {id}\n" for id in ("a", "b", "c")
+    )
+    assert bool(run.split_jobs(content)) == split
+
+
+def test_merge_tree_keeps_every_target(tmp_path):
+    names = ["api", "web", "docs", "lint", "cli"]
+    earthfiles = [
+        (
+            f"{name}.yml",
+            f"VERSION 0.7\nFROM alpine\n\nbuild:\n  RUN make {name}\n\n"
+            f"{name}:\n  RUN ./{name}.sh\n\nall:\n  BUILD +build\n  BUILD +{name}\n",
+        )
+        for name in names
+    ]
+    with io.use_debug_dir(str(tmp_path)):
+        merged = run.merge_tree(earthfiles)
+    earthfile = parser.parse(merged)
+    runs = [
+        command.args
+        for target in earthfile.targets
+        for command in target.commands
+        if command.name == "RUN"
+    ]
+    for name in names:
+        assert (f"make {name}",) in runs
+        assert (f"./{name}.sh",) in runs
+        assert name in [target.name for target in earthfile.targets]
+    # Every target but `all` is built by it
+    built = [command.args[0] for command in earthfile.target("all").commands]
+    assert sorted(built) == sorted(
+        f"+{target.name}" for target in earthfile.targets if target.name != "all"
+    )
+    # Three rounds of merges, each merge in a folder of its own
+    folders = sorted(path.name for path in tmp_path.iterdir() if path.is_dir())
+    assert folders == ["merge1-0", "merge1-1", "merge2-0", "merge3-0"]
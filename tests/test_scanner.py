@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+from toearthly.core import constants, io, scanner
+
+
+def make(root, *paths: str) -> None:
+    for path in paths:
+        full = root / path
+        if path.endswith("/"):
+            full.mkdir(parents=True, exist_ok=True)
+        else:
+            full.parent.mkdir(parents=True, exist_ok=True)
+            full.write_text("")
+
+
+def listing(node: scanner.Node, prefix: str = "") -> list:
+    paths = []
+    for child in node.children:
+        path = prefix + child.name + ("/" if child.directory else "")
+        paths.append(path)
+        paths += listing(child, path)
+    return paths
+
+
+@pytest.fixture(autouse=True)
+def defaults(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "SCAN_IGNORE", ["node_modules/"])
+    monkeypatch.setattr(constants, "SCAN_MAX_DEPTH", 10)
+    monkeypatch.setattr(constants, "SCAN_MAX_ENTRIES", 1000)
+    monkeypatch.setattr(constants, "SCAN_MAX_SECONDS", 10.0)
+    with io.use_debug_dir(str(tmp_path / "debug")):
+        yield
+
+
+def scan(root) -> list:
+    return sorted(listing(scanner.scan(str(root)).root))
+
+
+def test_negation(tmp_path):
+    make(tmp_path, "a.log", "keep.log", "src/b.log", "src/keep.log")
+    (tmp_path / ".gitignore").write_text("*.log\n!keep.log\n")
+    assert scan(tmp_path) == ["keep.log", "src/", "src/keep.log"]
+
+
+def test_anchored_patterns(tmp_path):
+    make(tmp_path, "build/x", "src/build/y", "docs/out/z", "src/docs/out/w")
+    (tmp_path / ".gitignore").write_text("/build\ndocs/out\n")
+    assert scan(tmp_path) == [
+        "docs/",
+        "src/",
+        "src/build/",
+        "src/build/y",
+        "src/docs/",
+        "src/docs/out/",
+        "src/docs/out/w",
+    ]
+
+
+def test_directory_only_patterns(tmp_path):
+    make(tmp_path, "out/x", "src/out")
+    (tmp_path / ".gitignore").write_text("out/\n")
+    assert scan(tmp_path) == ["src/", "src/out"]
+
+
+def test_nested_gitignore(tmp_path):
+    make(tmp_path, "a.tmp", "lib/b.tmp", "lib/gen/c", "gen/d")
+    (tmp_path / "lib" / ".gitignore").write_text("*.tmp\n/gen\n")
+    assert scan(tmp_path) == ["a.tmp", "gen/", "gen/d", "lib/"]
+
+
+def test_nested_gitignore_can_negate_its_parent(tmp_path):
+    make(tmp_path, "a.txt", "lib/b.txt", "lib/c.txt")
+    (tmp_path / ".gitignore").write_text("*.txt\n")
+    (tmp_path / "lib" / ".gitignore").write_text("!b.txt\n")
+    assert scan(tmp_path) == ["lib/", "lib/b.txt"]
+
+
+def test_ignored_directories_are_not_entered(tmp_path, monkeypatch):
+    make(tmp_path, "node_modules/left/pad.js", "dist/app.js", "src/main.js")
+    (tmp_path / ".gitignore").write_text("dist/\n")
+    entered = []
+    scandir = os.scandir
+
+    def recording(path):
+        entered.append(os.path.relpath(path, tmp_path))
+        return scandir(path)
+
+    monkeypatch.setattr(scanner.os, "scandir", recording)
+    assert scan(tmp_path) == ["src/", "src/main.js"]
+    assert sorted(entered) == [".", "src"]
+
+
+def test_symlinks(tmp_path):
+    make(tmp_path, "src/main.py")
+    os.symlink(tmp_path / "src" / "main.py", tmp_path / "src" / "link.py")
+    # A link back up the tree is listed but not walked again
+    os.symlink(tmp_path, tmp_path / "src" / "loop")
+    found = scanner.scan(str(tmp_path))
+    assert sorted(listing(found.root)) == [
+        "src/",
+        "src/link.py",
+        "src/loop/",
+        "src/main.py",
+    ]
+    assert found.truncated is None
+
+
+def test_budget_leaves_directories_incomplete(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "SCAN_MAX_ENTRIES", 3)
+    make(tmp_path, "a/1", "a/2", "b/3")
+    found = scanner.scan(str(tmp_path))
+    assert found.entries == 3
+    assert found.truncated == "more than 3 entries"
+    assert "..." in scanner.render(found.root)
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from toearthly.core import (
+    cache,
+    cassette,
+    constants,
+    io,
+    llm,
+    markdown,
+    provider,
+    stream,
+)
+
+ANSWER = "Here it is:\n```Earthfile\nVERSION 0.7\nFROM alpine\nRUN true\n```\n" + (
+    "Some trailing prose that isn't needed. " * 20
+)
+
+
+@pytest.mark.parametrize(
+    "pieces",
+    [
+        ["``", "`Earth", "file\nVERSION 0.7\nFR", "OM alpine\nRUN true\n`", "``"],
+        ["```\n", "VERSION 0.7\n", "FROM alpine\n", "RUN true", "\n``", "`\nmore"],
+        ["```\nVERSION 0.7\nFROM alpine\nRUN true\n```"],
+    ],
+)
+def test_code_block_split_across_chunks(pieces):
+    code = markdown.CodeBlockStream()
+    blocks = []
+    for piece in pieces:
+        blocks += code.feed(piece)
+    assert blocks == ["VERSION 0.7\nFROM alpine\nRUN true"]
+    assert code.close() == []
+
+
+def test_short_blocks_are_not_code():
+    code = markdown.CodeBlockStream()
+    assert code.feed("Run it:\n```\nearthly +all\n```\n") == []
+
+
+class CountingPlayer(cassette.Player):
+    requests = 0
+
+    async def create(self, **kwargs):
+        CountingPlayer.requests += 1
+        return await super().create(**kwargs)
+
+    # Chunks arrive over time, as from the API
+    async def _replay(self, chunks):
+        for chunk in chunks:
+            await asyncio.sleep(0.005)
+            yield chunk
+
+
+@pytest.fixture
+def streaming_llm(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(constants, "CACHE_PATH", str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(llm, "_llms", {})
+    monkeypatch.setattr(provider, "_provider", None)
+    CountingPlayer.requests = 0
+    player = CountingPlayer(
+        cassette.Cassette(str(tmp_path / "cassette.json")), 0, lambda *_: ANSWER
+    )
+    provider.install(player)
+    cache.llm_cache.clear()
+    yield llm.get("gpt-4")
+    cache.llm_cache.clear()
+
+
+def run_stopped(model, debug_dir):
+    import guidance
+
+    program = guidance(
+        "{{#user~}}\nWrite an Earthfile\n{{~/user}}\n"
+        "{{#assistant~}}\n{{gen 'answer' temperature=0 max_tokens=300}}\n"
+        "{{~/assistant}}",
+        llm=model,
+    )
+    progress = stream.Progress("test", ["answer"])
+    with io.use_debug_dir(debug_dir):
+        out = io.stream_llm_program(program, progress)
+    return out, progress
+
+
+def test_stopped_stream_is_cached(streaming_llm, tmp_path):
+    first, progress = run_stopped(streaming_llm, str(tmp_path / "debug"))
+    assert progress.stopped
+    assert CountingPlayer.requests == 1
+    assert "```\n" in first["answer"]
+    assert len(first["answer"]) < len(ANSWER)
+
+    second, _ = run_stopped(streaming_llm, str(tmp_path / "debug"))
+    assert CountingPlayer.requests == 1
+    assert second["answer"] == first["answer"]
@@ -0,0 +1,190 @@
+import pytest
+
+from toearthly.core import workflow
+
+WORKFLOW = """\
+name: CI
+env:
+  MODE: ci
+  TOKEN: ${{ secrets.TOKEN }}
+jobs:
+  build:
+    runs-on: ubuntu-latest
+    steps:
+      - uses: actions/checkout@v4
+      - uses: actions/setup-python@v4
+        with:
+          python-version: "3.11"
+      - run: pip install -r requirements.txt
+      - name: compile
+        run: make compile
+      - uses: acme/a@v1
+      - name: test
+        run: make test
+      - uses: acme/b@v1
+      - name: package
+        run: make package
+      - run: docker build -t acme/app .
+"""
+
+
+def answer(build: str, dockerfile: str = "FROM alpine\n", run: str = ""):
+    return (run, dockerfile, f"#!/bin/bash\nset -e\n{build}\n")
+
+
+def test_parse():
+    parsed = workflow.parse(WORKFLOW)
+    assert parsed.name == "CI"
+    assert [job.id for job in parsed.jobs] == ["build"]
+    steps = parsed.jobs[0].steps
+    assert steps[1].action == "actions/setup-python"
+    assert steps[3].title == "compile"
+
+
+@pytest.mark.parametrize("content", ["jobs: [", "name: x\n", "jobs: 1\n"])
+def test_parse_rejects(content):
+    with pytest.raises(ValueError):
+        workflow.parse(content)
+
+
+def test_convert_by_rule():
+    conversion = workflow.convert(workflow.parse(WORKFLOW))
+    assert conversion.dockerfile.startswith("FROM python:3.11\n")
+    assert "RUN pip install -r requirements.txt\n" in conversion.dockerfile
+    assert "export MODE=ci\n" in conversion.build
+    assert "TOKEN" not in conversion.build
+    assert conversion.run.endswith("docker build -t acme/app .\n")
+
+
+def test_unknown_steps_keep_their_place():
+    conversion = workflow.convert(workflow.parse(WORKFLOW))
+    assert [
+        [step.uses for step in steps["build"]] for steps in conversion.unknown
+    ] == [["acme/a@v1"], ["acme/b@v1"]]
+
+    spliced = workflow.splice(conversion, [answer("echo a"), answer("echo b")])
+    order = ["make compile", "echo a", "make test", "echo b", "make package"]
+    positions = [spliced.build.index(line) for line in order]
+    assert positions == sorted(positions)
+    assert "{unknown steps" not in spliced.build
+    assert spliced.unknown == []
+
+
+def test_consecutive_unknown_steps_share_a_marker():
+    content = WORKFLOW.replace("      - name: test\n        run: make test\n", "")
+    conversion = workflow.convert(workflow.parse(content))
+    assert len(conversion.unknown) == 1
+    assert len(conversion.unknown[0]["build"]) == 2
+    assert conversion.build.count("{unknown steps") == 1
+
+
+def test_splice_dockerfile_and_run():
+    content = WORKFLOW.replace("      - uses: acme/b@v1\n", "")
+    conversion = workflow.convert(workflow.parse(content))
+    spliced = workflow.splice(
+        conversion,
+        [
+            answer(
+                "echo a",
+                "FROM node\nRUN npm ci\nRUN chmod +x build.sh\n",
+                "docker build -t build -f build.Dockerfile .\ndocker push acme/app\n",
+            )
+        ],
+    )
+    assert spliced.dockerfile.startswith("FROM python:3.11\n")
+    assert spliced.dockerfile.endswith("RUN npm ci\n")
+    assert spliced.run.endswith("docker push acme/app\n")
+
+
+def test_splice_needs_an_answer_per_run():
+    conversion = workflow.convert(workflow.parse(WORKFLOW))
+    with pytest.raises(ValueError):
+        workflow.splice(conversion, [answer("echo a")])
+
+
+def test_subset_keeps_only_the_given_steps():
+    parsed = workflow.parse(WORKFLOW)
+    conversion = workflow.convert(parsed)
+    subset = workflow.parse(workflow.subset(parsed, conversion.unknown[1]))
+    assert [step.uses for step in subset.jobs[0].steps] == ["acme/b@v1"]
+    assert subset.env == parsed.env
+
+
+def test_split_orders_jobs_by_needs():
+    content = """\
+name: CI
+env:
+  MODE: ci
+jobs:
+  build:
+    needs: [lint, test_unit]
+    runs-on: ubuntu-latest
+    steps:
+      - run: make
+  test_unit:
+    needs: lint
+    runs-on: ubuntu-latest
+    steps:
+      - run: pytest
+  lint:
+    runs-on: ubuntu-latest
+    steps:
+      - run: flake8
+"""
+    jobs = workflow.split(workflow.parse(content))
+    assert [(id, needs) for id, _, needs in jobs] == [
+        ("lint", ()),
+        ("test_unit", ("lint",)),
+        ("build", ("lint", "test_unit")),
+    ]
+    build = workflow.parse(jobs[2][1])
+    assert build.env == {"MODE": "ci"}
+    assert build.jobs[0].needs == ()
+    assert [step.run for step in build.jobs[0].steps] == ["make"]
+
+
+def steps_workflow(steps: str, defaults: str = "") -> str:
+    return (
+        f"{defaults}jobs:\n  build:\n    runs-on: ubuntu-latest\n"
+        f"    steps:\n{steps}"
+    )
+
+
+def test_default_working_directory():
+    steps = "      - run: pytest\n      - run: make\n        working-directory: lib\n"
+    content = steps_workflow(steps, "defaults:\n  run:\n    working-directory: app\n")
+    build = workflow.convert(workflow.parse(content)).build
+    assert "(\ncd app\npytest\n)" in build
+    assert "(\ncd lib\nmake\n)" in build
+
+    job_defaults = "    defaults:\n      run:\n        working-directory: api\n"
+    content = content.replace("    runs-on:", job_defaults + "    runs-on:")
+    build = workflow.convert(workflow.parse(content)).build
+    assert "(\ncd api\npytest\n)" in build
+
+
+def test_step_env_expressions_are_not_exported():
+    steps = (
+        "      - run: make\n        env:\n          TOKEN: ${{ secrets.TOKEN }}\n"
+        "          MODE: ci\n"
+        "      - run: ./deploy --token $TOKEN\n"
+        "        env:\n          TOKEN: ${{ secrets.TOKEN }}\n"
+    )
+    conversion = workflow.convert(workflow.parse(steps_workflow(steps)))
+    assert "secrets" not in conversion.build
+    assert "(\nexport MODE=ci\nmake\n)" in conversion.build
+    # The step that needs the value goes to the LLM
+    (unknown,) = conversion.unknown
+    assert [step.run for step in unknown["build"]] == ["./deploy --token $TOKEN"]
+
+
+def test_docker_steps_keep_their_directory_and_env():
+    steps = (
+        "      - run: docker build -t me/api .\n"
+        "        working-directory: services/api\n"
+        "        env:\n          DOCKER_BUILDKIT: 1\n"
+    )
+    run = workflow.convert(workflow.parse(steps_workflow(steps))).run
+    assert run.endswith(
+        "(\nexport DOCKER_BUILDKIT=1\ncd services/api\ndocker build -t me/api .\n)\n"
+    )
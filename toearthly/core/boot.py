@@ -3,5 +3,10 @@ import os
 import dotenv
 
 dotenv.load_dotenv()
-if os.environ.get("OPENAI_API_KEY") is None:
-    raise EnvironmentError("OPENAI_API_KEY ENV is not set.")
+
+
+# Checked when the first LLM client is created rather than at import, so
+# --help and other preflight checks work without a key.
+def check_api_key() -> None:
+    if os.environ.get("OPENAI_API_KEY") is None:
+        raise EnvironmentError("OPENAI_API_KEY ENV is not set.")
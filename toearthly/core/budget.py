@@ -0,0 +1,74 @@
+from typing import Any, Dict, Iterator, NamedTuple
+
+from toearthly.core import io, llm, program
+
+CONTEXT_WINDOWS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+}
+# Only used once trimming alone can't make the prompt fit
+FALLBACK_MODELS = {
+    "gpt-4": "gpt-4-32k",
+    "gpt-3.5-turbo": "gpt-3.5-turbo-16k",
+}
+# Slack for the prompt count being an estimate
+SAFETY_MARGIN = 64
+# A gen can be shrunk to this share of its requested max_tokens
+MIN_OUTPUT_FRACTION = 0.25
+
+
+class Plan(NamedTuple):
+    model: str
+    level: int
+    max_tokens: Dict[str, int]
+    prompt_tokens: int
+
+
+def models(model: str) -> Iterator[str]:
+    while model is not None:
+        yield model
+        model = FALLBACK_MODELS.get(model)
+
+
+def _scaled(outputs: Dict[str, int], room: int) -> Dict[str, int]:
+    total = sum(outputs.values())
+    return {name: int(tokens * room / total) for name, tokens in outputs.items()}
+
+
+# Picks the model, trim level and gen sizes for a template call so that the
+# prompt plus every gen's max_tokens fits the context window. `outputs` maps
+# the template's max_tokens variables to the size each gen asks for. For each
+# model the template's trim steps are applied in order until everything fits.
+# If it still doesn't, the gens are shrunk (down to MIN_OUTPUT_FRACTION), and
+# only then is the next, larger model tried.
+def fit(
+    template: program.Template,
+    model: str,
+    outputs: Dict[str, int],
+    static: Dict[str, Any] = None,
+    **kwargs,
+) -> Plan:
+    wanted = sum(outputs.values())
+    for candidate in models(model):
+        client = llm.get(candidate)
+        window = CONTEXT_WINDOWS[candidate] - SAFETY_MARGIN
+        for level in range(len(template.levels(static))):
+            prompt_tokens = template.measure(client, level, static, **kwargs)
+            room = window - prompt_tokens
+            if room >= wanted:
+                plan = Plan(candidate, level, dict(outputs), prompt_tokens)
+                break
+        else:
+            if room < wanted * MIN_OUTPUT_FRACTION:
+                continue
+            plan = Plan(candidate, level, _scaled(outputs, room), prompt_tokens)
+
+        if plan.model != model or plan.level or plan.max_tokens != outputs:
+            io.log(f"Token budget: {plan}")
+        return plan
+
+    raise ValueError(
+        f"Prompt of {prompt_tokens} tokens does not fit any model from {model}."
+    )
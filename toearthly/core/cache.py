@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+from toearthly.core import constants, io, trace
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+)
+"""
+
+
+def cache_path() -> str:
+    if constants.CACHE_PATH:
+        return constants.CACHE_PATH
+    return os.path.join(io.debug_dir(), "data", "llm_cache.sqlite3")
+
+
+# Every LLM response goes through this cache: the guidance programs in
+# toearthly/prompt (it implements guidance's Cache interface) and
+# io.call_chat_completion_api_cached. An in-process LRU sits in front of a
+# single SQLite file in WAL mode, which several processes can share.
+class LLMCache:
+    def __init__(self):
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def key(
+        self, model: str, messages: List[Dict[str, str]], temperature, max_tokens
+    ) -> str:
+        return self.create_key(
+            model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+
+    # Called by guidance with the model, rendered prompt, temperature, max_tokens
+    # and the rest of the request parameters.
+    def create_key(self, llm: str, **kwargs: Dict[str, Any]) -> str:
+        if "cache_key" in kwargs:
+            return str(kwargs["cache_key"])
+        options = json.dumps(kwargs, sort_keys=True, default=str)
+        return hashlib.sha256(f"{llm}{options}".encode()).hexdigest()
+
+    def _connection(self) -> sqlite3.Connection:
+        path = cache_path()
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if path not in connections:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(SCHEMA)
+            connections[path] = conn
+        return connections[path]
+
+    def _remember(self, key: str, value: Any, created: float) -> None:
+        with self._lock:
+            self._memory[key] = (value, created)
+            self._memory.move_to_end(key)
+            while len(self._memory) > constants.CACHE_MEMORY_ENTRIES:
+                self._memory.popitem(last=False)
+
+    # Hits in memory are recorded in the file too, so eviction there sees them
+    def _load(self, key: str) -> Any:
+        now = time.time()
+        expired = now - constants.CACHE_TTL_SECONDS
+        with self._lock:
+            remembered = self._memory.get(key)
+            if remembered is not None and remembered[1] < expired:
+                del self._memory[key]
+                remembered = None
+            if remembered is not None:
+                self._memory.move_to_end(key)
+        conn = self._connection()
+        if remembered is not None:
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            return remembered[0]
+        row = conn.execute(
+            "SELECT value, created FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] < expired:
+            raise KeyError(key)
+        conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        value = pickle.loads(row[0])
+        self._remember(key, value, row[1])
+        return value
+
+    # guidance reads back what it has just stored, which isn't a hit
+    def __getitem__(self, key: str) -> Any:
+        value = self._load(key)
+        if getattr(self._local, "stored", None) != key:
+            trace.count("cache_hits")
+        self._local.stored = None
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self._load(key)
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        blob = pickle.dumps(value)
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+            (key, blob, len(blob), now, now),
+        )
+        self._remember(key, value, now)
+        self._local.stored = key
+        self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM entries WHERE created < ?",
+                (now - constants.CACHE_TTL_SECONDS,),
+            )
+            (total,) = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            if total > constants.CACHE_MAX_BYTES:
+                # Least recently used first, down to 90% of the cap
+                excess = total - constants.CACHE_MAX_BYTES * 0.9
+                evicted = []
+                for key, size in conn.execute(
+                    "SELECT key, size FROM entries ORDER BY accessed"
+                ):
+                    if excess <= 0:
+                        break
+                    evicted.append((key,))
+                    excess -= size
+                conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+                with self._lock:
+                    for (key,) in evicted:
+                        self._memory.pop(key, None)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        self._connection().execute("DELETE FROM entries")
+
+
+llm_cache = LLMCache()
@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from toearthly.core import boot, client, constants, provider, trace
+
+RECORD = "record"
+REPLAY = "replay"
+# Roughly a token per chunk when a recorded answer is replayed as a stream
+CHUNK = re.compile(r"\s*\S+|\s+")
+
+# The answer for a request that wasn't recorded, from the stage and request
+Fallback = Callable[[str, Dict[str, Any]], str]
+
+
+class CassetteMiss(ValueError):
+    pass
+
+
+# Request parameters that decide the answer. A stream and a plain request
+# for the same prompt share an entry.
+def key(kwargs: Dict[str, Any]) -> str:
+    request = {
+        name: value
+        for name, value in kwargs.items()
+        if name not in ("stream", "deployment_id")
+    }
+    options = json.dumps(request, sort_keys=True, default=str)
+    return hashlib.sha256(options.encode()).hexdigest()
+
+
+# Answers by request key, in a JSON file: the content, why it finished, the
+# token usage and the seconds the API took.
+class Cassette:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r") as file:
+                self.entries: Dict[str, Dict[str, Any]] = json.load(file)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self.entries.get(key)
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self.entries[key] = entry
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path + ".tmp", "w") as file:
+                json.dump(self.entries, file, indent=1, sort_keys=True)
+                file.write("\n")
+            os.replace(self.path + ".tmp", self.path)
+
+
+def _response(entry: Dict[str, Any]) -> Any:
+    import openai
+
+    return openai.util.convert_to_openai_object(
+        {
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": entry["content"]},
+                    "finish_reason": entry["finish_reason"],
+                }
+            ],
+            "usage": entry["usage"],
+        }
+    )
+
+
+def _chunks(entry: Dict[str, Any]) -> List[Any]:
+    import openai
+
+    pieces = CHUNK.findall(entry["content"])
+    chunks = [{"delta": {"content": piece}, "finish_reason": None} for piece in pieces]
+    chunks.append({"delta": {}, "finish_reason": entry["finish_reason"]})
+    return [
+        openai.util.convert_to_openai_object(
+            {"object": "chat.completion.chunk", "choices": [{"index": 0, **chunk}]}
+        )
+        for chunk in chunks
+    ]
+
+
+# Sends requests like Provider and records each answer into the cassette
+class Recorder(provider.Provider):
+    def __init__(self, config: provider.Config, cassette: Cassette) -> None:
+        super().__init__(config)
+        self.cassette = cassette
+
+    async def create(self, **kwargs) -> Any:
+        start = time.perf_counter()
+        response = await super().create(**kwargs)
+        if not kwargs.get("stream"):
+            choice = response.choices[0]
+            self.cassette.put(
+                key(kwargs),
+                {
+                    "content": choice.message.content,
+                    "finish_reason": choice.finish_reason,
+                    "usage": response.get("usage") or {},
+                    "seconds": round(time.perf_counter() - start, 3),
+                },
+            )
+            return response
+        return self._record(kwargs, response, start)
+
+    async def _record(self, kwargs: Dict[str, Any], chunks: Any, start: float):
+        content = ""
+        finish_reason = None
+        async for chunk in chunks:
+            choice = chunk.choices[0]
+            content += choice.delta.get("content", "")
+            finish_reason = choice.get("finish_reason") or finish_reason
+            yield chunk
+        self.cassette.put(
+            key(kwargs),
+            {
+                "content": content,
+                "finish_reason": finish_reason,
+                # Streams don't report usage
+                "usage": {},
+                "seconds": round(time.perf_counter() - start, 3),
+            },
+        )
+
+
+# Answers from the cassette without touching the network. `latency` scales
+# the recorded time each answer took, 0 answers at once. A request that
+# wasn't recorded raises CassetteMiss, or with a fallback is answered by it
+# and recorded, which is how cassettes are seeded without the API.
+class Player(provider.Provider):
+    def __init__(
+        self, cassette: Cassette, latency: float = 0.0, fallback: Fallback = None
+    ) -> None:
+        self.cassette = cassette
+        self.latency = latency
+        self.fallback = fallback
+
+    async def create(self, **kwargs) -> Any:
+        request = key(kwargs)
+        entry = self.cassette.get(request)
+        if entry is None:
+            stage = client.current_stage()
+            if self.fallback is None:
+                raise CassetteMiss(
+                    f"{stage}: no recorded answer in {self.cassette.path}, "
+                    "record it again"
+                )
+            entry = {
+                "content": self.fallback(stage, kwargs),
+                "finish_reason": "stop",
+                "usage": {},
+                "seconds": 0.0,
+            }
+            self.cassette.put(request, entry)
+        if self.latency:
+            await asyncio.sleep(entry["seconds"] * self.latency)
+        usage = entry["usage"]
+        trace.count("prompt_tokens", usage.get("prompt_tokens", 0))
+        trace.count("completion_tokens", usage.get("completion_tokens", 0))
+        if not kwargs.get("stream"):
+            return _response(entry)
+        return self._replay(_chunks(entry))
+
+    async def _replay(self, chunks: List[Any]):
+        for chunk in chunks:
+            yield chunk
+
+
+def provider_for(config: provider.Config) -> provider.Provider:
+    cassette = Cassette(constants.CASSETTE)
+    if constants.CASSETTE_MODE == RECORD:
+        boot.check_api_key()
+        return Recorder(config, cassette)
+    return Player(cassette, constants.CASSETTE_LATENCY)
@@ -0,0 +1,125 @@
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, List
+
+from toearthly.core import constants, io, trace
+
+MANIFEST = "checkpoint.json"
+
+_lock = threading.Lock()
+
+
+class Cancelled(Exception):
+    pass
+
+
+# Events that abandon the current run once set, like when a branch running
+# alongside it has failed. Stages and LLM calls check them before starting,
+# so the rest of the run stops rather than running up cost.
+_cancel: contextvars.ContextVar = contextvars.ContextVar("cancel", default=())
+
+
+@contextlib.contextmanager
+def cancellable(event: threading.Event):
+    token = _cancel.set(_cancel.get() + (event,))
+    try:
+        yield
+    finally:
+        _cancel.reset(token)
+
+
+def check_cancelled() -> None:
+    if any(event.is_set() for event in _cancel.get()):
+        raise Cancelled("Stopped after a concurrent branch failed.")
+
+
+def manifest_path() -> str:
+    return os.path.join(io.debug_dir(), MANIFEST)
+
+
+def load() -> Dict[str, Dict[str, Any]]:
+    try:
+        return json.loads(io.read(manifest_path()))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _record(stage: str, entry: Dict[str, Any]) -> None:
+    with _lock:
+        manifest = load()
+        manifest[stage] = entry
+        path = manifest_path()
+        io.write(json.dumps(manifest, indent=2), path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+
+# The prompts, docs, examples and routing config shipped with the package,
+# so an upgrade doesn't resume from what older prompts answered
+@functools.lru_cache(maxsize=None)
+def _package_digest(routes: str) -> str:
+    package = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    files = []
+    for folder in ("prompt", "data"):
+        for directory, _, names in os.walk(os.path.join(package, folder)):
+            files += [os.path.join(directory, n) for n in names if n[-4:] != ".pyc"]
+    files.sort()
+    if routes:
+        files.append(os.path.join(package, routes))
+    digest = hashlib.sha256()
+    for path in files:
+        with open(path, "rb") as file:
+            digest.update(os.path.relpath(path, package).encode() + file.read())
+    return digest.hexdigest()
+
+
+# Settings that change what a stage answers
+def _settings() -> List[Any]:
+    return [
+        constants.LLM_MODEL,
+        constants.LLM_ROUTES,
+        constants.FAST,
+        _package_digest(constants.LLM_ROUTES),
+    ]
+
+
+def inputs_key(stage: str, *args: str) -> str:
+    key = json.dumps([stage, *args, _settings()])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# Runs one pipeline stage, recording its inputs hash and output in the
+# manifest. With constants.RESUME a stage whose inputs are unchanged since it
+# last succeeded is skipped. Each stage's inputs include the previous stage's
+# output, so a rerun restarts at the first stage that failed or is stale.
+# Stages run in an io.use_debug_subdir are recorded under that folder's name.
+def run_stage(stage: str, fn: Callable[..., Any], *args: str) -> Any:
+    check_cancelled()
+    if io.debug_subdir() is not None:
+        stage = f"{io.debug_subdir()}/{stage}"
+    key = inputs_key(stage, *args)
+    entry = load().get(stage)
+    with trace.span("stage", stage) as span:
+        if (
+            constants.RESUME
+            and entry is not None
+            and entry["key"] == key
+            and entry["status"] == "done"
+        ):
+            print(f"Resuming: {stage} inputs unchanged, using checkpoint.")
+            span.attributes["resumed"] = True
+            output = entry["output"]
+            return tuple(output) if isinstance(output, list) else output
+
+        _record(stage, {"key": key, "status": "running"})
+        try:
+            output = fn(*args)
+        except BaseException as e:
+            _record(stage, {"key": key, "status": "failed", "error": str(e)})
+            raise
+        _record(stage, {"key": key, "status": "done", "output": output})
+        return output
@@ -0,0 +1,217 @@
+import asyncio
+import contextlib
+import contextvars
+import email.utils
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, NamedTuple, Optional
+
+from toearthly.core import constants, trace
+
+# Status codes worth another try, anything else from the API is final
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# Latencies kept per stage, and how many are needed before hedging on them
+LATENCY_SAMPLES = 100
+HEDGE_MIN_SAMPLES = 10
+
+Request = Callable[[], Awaitable[Any]]
+
+
+class RetriesExhausted(ValueError):
+    pass
+
+
+class Policy(NamedTuple):
+    timeout: float
+    attempts: int
+    backoff: float
+    max_backoff: float
+    hedge: bool
+
+
+# The stage a request is made for, set by program.Template so guidance's
+# calls pick up that stage's policy.
+_stage: contextvars.ContextVar = contextvars.ContextVar("stage", default=None)
+_latencies: Dict[str, Deque[float]] = {}
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def use_stage(stage: str):
+    token = _stage.set(stage)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+def current_stage() -> str:
+    return _stage.get() or "default"
+
+
+def policy(stage: str) -> Policy:
+    return Policy(
+        constants.LLM_STAGE_TIMEOUTS.get(stage, constants.LLM_TIMEOUT),
+        constants.LLM_ATTEMPTS,
+        constants.LLM_BACKOFF,
+        constants.LLM_BACKOFF_MAX,
+        constants.LLM_HEDGE,
+    )
+
+
+def record(stage: str, seconds: float) -> None:
+    with _lock:
+        _latencies.setdefault(stage, deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+
+
+# The stage's p95 latency, once enough calls have finished to know it
+def hedge_after(stage: str) -> Optional[float]:
+    with _lock:
+        samples = list(_latencies.get(stage, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return statistics.quantiles(samples, n=20)[-1]
+
+
+def retryable(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    openai = sys.modules.get("openai")
+    if openai is None or not isinstance(error, openai.error.OpenAIError):
+        return False
+    if isinstance(
+        error,
+        (
+            openai.error.AuthenticationError,
+            openai.error.PermissionError,
+            openai.error.InvalidRequestError,
+        ),
+    ):
+        return False
+    if isinstance(
+        error,
+        (openai.error.Timeout, openai.error.APIConnectionError, openai.error.TryAgain),
+    ):
+        return True
+    status = error.http_status
+    return status is None or status in RETRYABLE_STATUS or status >= 500
+
+
+# Seconds the server asked us to wait, from Retry-After or retry-after-ms
+def retry_after(error: BaseException) -> Optional[float]:
+    headers = getattr(error, "headers", None) or {}
+    headers = {name.lower(): value for name, value in headers.items()}
+    if "retry-after-ms" in headers:
+        with contextlib.suppress(ValueError):
+            return float(headers["retry-after-ms"]) / 1000
+    if "retry-after" in headers:
+        with contextlib.suppress(ValueError):
+            return float(headers["retry-after"])
+        # Or an HTTP date
+        with contextlib.suppress(TypeError, ValueError):
+            date = email.utils.parsedate_to_datetime(headers["retry-after"])
+            return max(date.timestamp() - time.time(), 0.0)
+    return None
+
+
+# openai puts the whole response into server errors
+def describe(error: BaseException) -> str:
+    text = f"{type(error).__name__}: {error}"
+    return text if len(text) <= 200 else text[:197] + "..."
+
+
+# Full jitter, so workers that failed together don't retry together. A hint
+# from the server is a minimum.
+def backoff(attempt: int, policy: Policy, hint: Optional[float] = None) -> float:
+    delay = random.uniform(0, min(policy.max_backoff, policy.backoff * 2**attempt))
+    return max(delay, hint or 0.0)
+
+
+# Runs the request with a deadline. With `hedge_after` a second copy is sent
+# once the first has taken that long, and whichever succeeds first is used.
+async def _race(request: Request, stage: str, timeout: float, hedge_after=None):
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    if hedge_after is not None and hedge_after >= timeout:
+        hedge_after = None
+
+    async def timed():
+        sent = loop.time()
+        result = await request()
+        record(stage, loop.time() - sent)
+        return result
+
+    pending = {asyncio.ensure_future(timed())}
+    error = None
+    try:
+        while pending:
+            until = start + timeout
+            if hedge_after is not None:
+                until = min(until, start + hedge_after)
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=max(until - loop.time(), 0),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = error or task.exception()
+            if not pending:
+                break
+            if hedge_after is not None and loop.time() >= start + hedge_after:
+                print(f"{stage}: no answer after {hedge_after:.1f}s, hedging")
+                trace.count("hedges")
+                pending.add(asyncio.ensure_future(timed()))
+                hedge_after = None
+            elif loop.time() >= start + timeout:
+                raise asyncio.TimeoutError(f"no answer after {timeout:g}s")
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# Sends a request under the stage's policy. Errors that another try can't fix,
+# like a bad key or a prompt over the context length, are raised as they are.
+# RetriesExhausted is raised once the attempts run out.
+async def call(request: Request, stage: str = None) -> Any:
+    stage = stage or current_stage()
+    current = policy(stage)
+    with trace.span("request", stage):
+        trace.count("requests")
+        return await _attempts(request, stage, current)
+
+
+async def _attempts(request: Request, stage: str, current: Policy) -> Any:
+    for attempt in range(current.attempts):
+        try:
+            return await _race(
+                request,
+                stage,
+                current.timeout,
+                hedge_after(stage) if current.hedge else None,
+            )
+        except Exception as e:
+            if not retryable(e):
+                raise
+            if attempt == current.attempts - 1:
+                raise RetriesExhausted(
+                    f"{stage}: gave up after {current.attempts} attempts: {describe(e)}"
+                ) from e
+            delay = backoff(attempt, current, retry_after(e))
+            print(f"{stage}: {describe(e)}, retrying in {delay:.1f}s")
+            trace.count("retries")
+            await asyncio.sleep(delay)
+
+
+# Wraps a guidance OpenAI caller, which guidance awaits for every gen
+def wrap(caller: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    async def policy_caller(**kwargs):
+        return await call(lambda: caller(**kwargs))
+
+    return policy_caller
@@ -0,0 +1,177 @@
+import functools
+import re
+from typing import Any, Dict, List, Tuple
+
+from toearthly.core import io, llm, trace
+
+# Workflow keys that say how the build runs. Triggers, permissions,
+# concurrency and timeouts don't. Step ids and job outputs stay for the
+# expressions that refer to them, like ${{ steps.<id>.outputs.<name> }}.
+WORKFLOW_KEYS = ("name", "env", "defaults", "jobs")
+JOB_KEYS = (
+    "name",
+    "runs-on",
+    "needs",
+    "if",
+    "outputs",
+    "env",
+    "defaults",
+    "container",
+    "services",
+    "strategy",
+    "steps",
+)
+STEP_KEYS = (
+    "id",
+    "name",
+    "if",
+    "uses",
+    "with",
+    "run",
+    "env",
+    "working-directory",
+    "shell",
+)
+
+# Sections of basics.md each stage leaves out of its digest, by heading
+DIGEST_SKIP = {
+    "bash_to_earthly": [
+        "Not All Targets Produce Output",
+        "Passing ARGs in FROM, BUILD, and COPY",
+    ],
+    "dockerfile_to_earthfile": [
+        "Not All Targets Produce Output",
+        "External Changes",
+    ],
+    "earthfile_correction": [
+        "Not All Targets Produce Output",
+    ],
+    "merge": [
+        "Not All Targets Produce Output",
+        "The Push Flag",
+        "External Changes",
+    ],
+}
+HEADING = re.compile(r"#+ (.*)$")
+CODE_BLOCK = re.compile(r"```(\w*)\n.*?```\n?", re.S)
+
+
+def _only(raw: Dict[str, Any], keys: Tuple[str, ...]) -> Dict[str, Any]:
+    return {key: raw[key] for key in raw if key in keys}
+
+
+def _step(raw: Any) -> Any:
+    if not isinstance(raw, dict):
+        return raw
+    step = _only(raw, STEP_KEYS)
+    if isinstance(step.get("run"), str):
+        lines = [line.rstrip() for line in step["run"].strip("\n").split("\n")]
+        step["run"] = "\n".join(lines) + ("\n" if len(lines) > 1 else "")
+    return step
+
+
+def _dumper():
+    import yaml
+
+    class Dumper(yaml.SafeDumper):
+        pass
+
+    # Scripts stay readable as block literals instead of escaped strings
+    def string(dumper, value: str):
+        style = "|" if "\n" in value else None
+        return dumper.represent_scalar("tag:yaml.org,2002:str", value, style=style)
+
+    Dumper.add_representer(str, string)
+    return Dumper
+
+
+# The workflow with only what the build needs: no comments or blank lines,
+# and none of the keys outside WORKFLOW_KEYS, JOB_KEYS and STEP_KEYS. One
+# that can't be read is returned as it is.
+def workflow(content: str) -> str:
+    import yaml
+
+    try:
+        raw = yaml.safe_load(content)
+    except yaml.YAMLError:
+        return content
+    if not isinstance(raw, dict) or not isinstance(raw.get("jobs"), dict):
+        return content
+    compressed = _only(raw, WORKFLOW_KEYS)
+    compressed["jobs"] = {}
+    for id, job in raw["jobs"].items():
+        if not isinstance(job, dict):
+            compressed["jobs"][id] = job
+            continue
+        job = _only(job, JOB_KEYS)
+        if isinstance(job.get("steps"), list):
+            job["steps"] = [_step(step) for step in job["steps"]]
+        compressed["jobs"][id] = job
+    return yaml.dump(
+        compressed,
+        Dumper=_dumper(),
+        sort_keys=False,
+        allow_unicode=True,
+        width=1000,
+    )
+
+
+# (heading, text) for each section of a markdown document, the first one's
+# heading empty if it has none. Lines in code blocks aren't headings.
+def _sections(text: str) -> List[Tuple[str, str]]:
+    sections = [("", "")]
+    in_code = False
+    for line in text.splitlines(keepends=True):
+        if line.startswith("```"):
+            in_code = not in_code
+        heading = None if in_code else HEADING.match(line)
+        if heading:
+            sections.append((heading.group(1).strip(), line))
+        else:
+            title, section = sections[-1]
+            sections[-1] = (title, section + line)
+    return sections
+
+
+# basics.md for a stage: without the sections DIGEST_SKIP leaves out for it,
+# the shell examples of running earthly, Earthfile examples the digest
+# already has, and runs of blank lines
+@functools.lru_cache(maxsize=None)
+def digest(stage: str) -> str:
+    text = io.relative_read("data/earthly_docs/basics.md")
+    skip = set(DIGEST_SKIP.get(stage, []))
+    seen = set()
+
+    def block(match: re.Match) -> str:
+        if match.group(1) in ("bash", "sh"):
+            return ""
+        if match.group(0) in seen:
+            return ""
+        seen.add(match.group(0))
+        return match.group(0)
+
+    kept = [section for title, section in _sections(text) if title not in skip]
+    condensed = CODE_BLOCK.sub(block, "".join(kept))
+    condensed = re.sub(r"[ \t]+\n", "\n", condensed)
+    return re.sub(r"\n{3,}", "\n\n", condensed).strip() + "\n"
+
+
+def tokens(text: str) -> int:
+    return len(llm.get().encode(text))
+
+
+def saving(before: str, after: str) -> int:
+    return tokens(before) - tokens(after)
+
+
+@functools.lru_cache(maxsize=None)
+def digest_saving(stage: str) -> int:
+    return saving(io.relative_read("data/earthly_docs/basics.md"), digest(stage))
+
+
+# Counts prompt tokens compression saved a stage on the current span, and
+# logs them
+def report(stage: str, saved: int) -> None:
+    if saved > 0:
+        io.log(f"{stage}: compression saved {saved} prompt tokens")
+        trace.count("tokens_saved", saved)
@@ -1,3 +1,54 @@
 DEBUG_DIR = "/input/.to_earthly/"
 EARTHLY_WARNING = "# This Earthfile is autogenerated and may not be correct.\n"
 VERIFY_EARTHFILE = True
+# Also check Earthfiles with `earthly debug ast`, which needs the earthly binary.
+VERIFY_WITH_EARTHLY = False
+# LLM fixes tried on an Earthfile that doesn't parse, one target at a time.
+REPAIR_ATTEMPTS = 2
+# LLM response cache. Defaults to DEBUG_DIR/data/llm_cache.sqlite3 when unset.
+CACHE_PATH = None
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+CACHE_MEMORY_ENTRIES = 256
+# Repository scans skip what .gitignore files and these patterns exclude,
+# and stop early past either budget
+SCAN_IGNORE = ["node_modules/", "vendor/"]
+SCAN_MAX_ENTRIES = 20000
+SCAN_MAX_SECONDS = 5.0
+SCAN_MAX_DEPTH = 8
+# Workflows with at least this many jobs are converted a job at a time, see
+# scripts/run.py. 0, like None, converts every workflow whole.
+SPLIT_JOBS = 3
+# Skip pipeline stages whose inputs match the last successful run.
+RESUME = False
+# The model prompts start with, and where to send requests: None uses
+# OPENAI_API_BASE or OpenAI, or point it at any OpenAI compatible API.
+LLM_MODEL = "gpt-4"
+LLM_BASE_URL = None
+# Per stage model routing, see core/router.py. A path relative to the
+# toearthly package or absolute, like data/router.json, or None to send every
+# request to LLM_MODEL.
+LLM_ROUTES = None
+# Requests in flight at once, across every stage and batch worker
+LLM_CONCURRENCY = 8
+LLM_CONNECT_TIMEOUT = 10.0
+# Record LLM answers to this cassette file, or replay them from it offline
+CASSETTE = None
+CASSETTE_MODE = "replay"
+# Replayed answers take this share of the time they took when recorded
+CASSETTE_LATENCY = 0.0
+# LLM request policy, see core/client.py. Timeouts are in seconds, per
+# attempt, and can be set per stage (a prompt module's template name).
+LLM_TIMEOUT = 180.0
+LLM_STAGE_TIMEOUTS = {"earthfile_repair": 90.0}
+LLM_ATTEMPTS = 4
+LLM_BACKOFF = 1.0
+LLM_BACKOFF_MAX = 30.0
+# Send a second copy of a request that is slower than the stage's p95 latency
+LLM_HEDGE = False
+# Ask stages for their answer in one generation, after at most a short plan,
+# instead of a separate plan turn first. Quicker, as output tokens dominate
+# latency, but it can cost quality.
+FAST = False
+# Stream LLM output, printing progress and stopping once the code is complete.
+STREAM = False
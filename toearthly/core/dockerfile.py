@@ -0,0 +1,300 @@
+import json
+import posixpath
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from toearthly.core import earthfile as parser
+
+# The implicit base target of an Earthfile can't be a stage name
+RESERVED = {"base": "deps"}
+INDENT = "  "
+# Instructions copied over unchanged
+PASSTHROUGH = {
+    "ARG", "CMD", "ENTRYPOINT", "ENV", "EXPOSE", "HEALTHCHECK", "LABEL", "USER",
+    "VOLUME", "WORKDIR",
+}
+# COPY flags Earthly doesn't have but can do without
+DROPPED_FLAGS = {"--link"}
+ARCHIVE = re.compile(r"\.(tar|tgz|tbz2?|txz)(\.\w+)?$")
+IMAGE_NAME = re.compile(r"^[\w./:-]+$")
+TAG = re.compile(r"(?:--tag|-t)[ =](\S+)|^\s*tags:\s*(\S+)\s*$", re.M)
+TARGET = re.compile(r"(?:--target[ =]|^\s*target:\s*)(\S+)", re.M)
+PUSH = re.compile(r"^\s*push:\s*true\b|docker push ", re.M)
+QUOTED = re.compile(r"[\s\"'\\]")
+
+
+class UnsupportedInstruction(ValueError):
+    def __init__(self, message: str, line: int) -> None:
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+
+
+class Instruction(NamedTuple):
+    name: str
+    args: str
+    line: int
+
+
+class Stage(NamedTuple):
+    name: str
+    image: str
+    flags: List[str]
+    instructions: List[Instruction]
+    line: int
+
+
+# Dockerfile instructions with `\` continuations joined and comments dropped
+def instructions(content: str) -> List[Instruction]:
+    found: List[Instruction] = []
+    pending: Optional[Tuple[int, str]] = None
+    for number, line in enumerate(content.split("\n"), start=1):
+        stripped = line.strip()
+        if pending is None and (not stripped or stripped.startswith("#")):
+            continue
+        if pending is not None:
+            if stripped.startswith("#"):
+                continue
+            number, stripped = pending[0], pending[1] + " " + stripped
+            pending = None
+        if stripped.endswith("\\"):
+            pending = (number, stripped[:-1].rstrip())
+            continue
+        name, _, args = stripped.partition(" ")
+        found.append(Instruction(name.upper(), args.strip(), number))
+    if pending is not None:
+        name, _, args = pending[1].partition(" ")
+        found.append(Instruction(name.upper(), args.strip(), pending[0]))
+    return found
+
+
+def _target_name(stage: str, taken: List[str]) -> str:
+    name = re.sub(r"[^a-z0-9.-]+", "-", stage.lower()).strip("-.") or "stage"
+    if not name[0].isalpha():
+        name = f"stage-{name}"
+    name = RESERVED.get(name, name)
+    candidate, n = name, 2
+    while candidate in taken:
+        candidate = f"{name}{n}"
+        n += 1
+    return candidate
+
+
+def stages(content: str) -> Tuple[List[Instruction], List[Stage]]:
+    global_args: List[Instruction] = []
+    found: List[Stage] = []
+    for instruction in instructions(content):
+        if instruction.name == "FROM":
+            words = instruction.args.split()
+            flags = [word for word in words if word.startswith("--")]
+            words = [word for word in words if not word.startswith("--")]
+            if len(words) == 3 and words[1].upper() == "AS":
+                name = words[2]
+            elif len(words) == 1:
+                name = str(len(found))
+            else:
+                raise UnsupportedInstruction("malformed FROM", instruction.line)
+            found.append(Stage(name, words[0], flags, [], instruction.line))
+        elif not found:
+            if instruction.name != "ARG":
+                raise UnsupportedInstruction(
+                    f"{instruction.name} before the first FROM", instruction.line
+                )
+            global_args.append(instruction)
+        else:
+            found[-1].instructions.append(instruction)
+    if not found:
+        raise UnsupportedInstruction("no FROM", 1)
+    return global_args, found
+
+
+# Image name and whether it is pushed, from docker steps in the workflow
+def image_settings(workflow: str) -> Tuple[Optional[str], Optional[str], bool]:
+    tag = None
+    for match in TAG.finditer(workflow):
+        candidate = match.group(1) or match.group(2)
+        # A generated version, like xyz7:$(date +%s), becomes latest
+        for name in (candidate, candidate.split(":")[0] + ":latest"):
+            if IMAGE_NAME.match(name):
+                tag = name
+                break
+        if tag is not None:
+            break
+    target = TARGET.search(workflow)
+    return (tag, target.group(1) if target else None, bool(PUSH.search(workflow)))
+
+
+class _Translation:
+    def __init__(self, content: str, workflow: str, context: str) -> None:
+        self.context = context
+        self.global_args, self.stages = stages(content)
+        self.targets: Dict[str, str] = {}
+        for index, stage in enumerate(self.stages):
+            name = stage.name
+            if name == str(index):
+                # Unnamed, the last one is usually the image
+                name = "docker" if index == len(self.stages) - 1 else "stage"
+            target = _target_name(name, list(self.targets.values()))
+            self.targets[stage.name] = target
+            self.targets.setdefault(str(index), target)
+        self.tag, image_stage, self.push = image_settings(workflow)
+        if image_stage not in self.targets:
+            image_stage = self.stages[-1].name
+        self.image_stage = image_stage
+        self.saved: Dict[str, Dict[str, str]] = {s.name: {} for s in self.stages}
+        self.used: List[str] = []
+        self.current: Optional[Stage] = None
+
+    # Only earlier stages can be referred to, later names are images
+    def stage(self, reference: str, before: Stage = None) -> Optional[Stage]:
+        for index, stage in enumerate(self.stages):
+            if stage is before:
+                break
+            if reference in (stage.name, str(index)):
+                return stage
+        return None
+
+    # Name under which `source` of `stage` is saved, adding a SAVE ARTIFACT
+    def artifact(self, stage: Stage, source: str, line: int) -> str:
+        if "*" in source or "?" in source:
+            raise UnsupportedInstruction("COPY --from with a wildcard", line)
+        saved = self.saved[stage.name]
+        if source not in saved:
+            name = source.rstrip("/").split("/")[-1] or "root"
+            if name in saved.values():
+                name = source.strip("./").rstrip("/")
+            saved[source] = name
+        self.used.append(stage.name)
+        return saved[source]
+
+    # Flags come before the paths, which can be a JSON list. Earthly has no
+    # JSON form, so paths with whitespace or quotes in them aren't supported.
+    def copy(self, instruction: Instruction) -> str:
+        words = instruction.args.split()
+        flags = [w for w in words if w.startswith("--")]
+        rest = instruction.args.split(None, len(flags))[len(flags):]
+        rest = rest[0] if rest else ""
+        if rest.startswith("["):
+            try:
+                paths = json.loads(rest)
+            except ValueError:
+                raise UnsupportedInstruction(
+                    f"malformed {instruction.name}", instruction.line
+                ) from None
+        else:
+            paths = rest.split()
+        if len(paths) < 2:
+            raise UnsupportedInstruction(
+                f"{instruction.name} without a destination", instruction.line
+            )
+        if any(not isinstance(p, str) or not p or QUOTED.search(p) for p in paths):
+            raise UnsupportedInstruction(
+                f"{instruction.name} of paths with whitespace or quotes",
+                instruction.line,
+            )
+        flags = [w for w in flags if w not in DROPPED_FLAGS]
+        source = next((f for f in flags if f.startswith("--from=")), None)
+        if source is None:
+            sources = [self.from_root(path, instruction.line) for path in paths[:-1]]
+            return " ".join(["COPY"] + flags + sources + paths[-1:])
+        flags.remove(source)
+        stage = self.stage(source[len("--from="):], self.current)
+        if stage is None:
+            raise UnsupportedInstruction(
+                "COPY --from an image rather than a stage", instruction.line
+            )
+        target = self.targets[stage.name]
+        sources = [
+            f"+{target}/{self.artifact(stage, path, instruction.line)}"
+            for path in paths[:-1]
+        ]
+        return " ".join(["COPY"] + flags + sources + paths[-1:])
+
+    # A path in the build context as one from the Earthfile, at the root
+    def from_root(self, path: str, line: int) -> str:
+        if not self.context:
+            return path
+        relative = posixpath.normpath(path.lstrip("/"))
+        if relative == ".." or relative.startswith("../"):
+            raise UnsupportedInstruction("COPY from outside the build context", line)
+        return posixpath.normpath(posixpath.join(self.context, relative))
+
+    def command(self, instruction: Instruction) -> str:
+        name, args, line = instruction
+        if name in PASSTHROUGH:
+            return f"{name} {args}"
+        if name == "RUN":
+            if "--mount=type=" in args and not re.search(
+                r"--mount=type=cache\S*\s", args + " "
+            ):
+                raise UnsupportedInstruction("RUN --mount other than cache", line)
+            if "<<" in args:
+                raise UnsupportedInstruction("heredoc", line)
+            return f"RUN {args}"
+        if name == "COPY":
+            return self.copy(instruction)
+        if name == "ADD":
+            if "://" in args or ARCHIVE.search(args):
+                raise UnsupportedInstruction("ADD of a URL or archive", line)
+            return self.copy(instruction._replace(name="COPY"))
+        if name == "MAINTAINER":
+            return f"LABEL maintainer={json.dumps(args)}"
+        raise UnsupportedInstruction(f"{name} has no Earthfile equivalent", line)
+
+    def base(self, stage: Stage) -> str:
+        parent = self.stage(stage.image, stage)
+        if parent is not None:
+            self.used.append(parent.name)
+            image = f"+{self.targets[parent.name]}"
+        else:
+            image = stage.image
+        return " ".join(["FROM"] + stage.flags + [image])
+
+    def earthfile(self) -> str:
+        bodies = {}
+        for stage in self.stages:
+            self.current = stage
+            body = [self.base(stage)]
+            body += [self.command(instruction) for instruction in stage.instructions]
+            bodies[stage.name] = body
+
+        lines = ["VERSION 0.7"]
+        lines += [f"ARG --global {i.args}" for i in self.global_args]
+        for stage in self.stages:
+            body = bodies[stage.name]
+            for source, name in self.saved[stage.name].items():
+                # Without the slash the directory is saved, and COPY copies
+                # its contents as the Dockerfile did
+                source = source.rstrip("/") or "/"
+                if source.split("/")[-1] == name:
+                    body.append(f"SAVE ARTIFACT {source}")
+                else:
+                    body.append(f"SAVE ARTIFACT {source} /{name}")
+            if stage.name == self.image_stage:
+                tag = self.tag or f"{self.targets[stage.name]}:latest"
+                push = "--push " if self.push else ""
+                body.append(f"SAVE IMAGE {push}{tag}")
+            lines += ["", f"{self.targets[stage.name]}:"]
+            lines += [INDENT + command for command in body]
+
+        leaves = [
+            self.targets[stage.name]
+            for stage in self.stages
+            if stage.name not in self.used or stage.name == self.image_stage
+        ]
+        lines += ["", "all:"] + [f"{INDENT}BUILD +{name}" for name in leaves]
+        return "\n".join(lines) + "\n"
+
+
+# Translates a Dockerfile without the LLM: each stage becomes a target, COPY
+# --from a stage becomes COPY +target/artifact with a SAVE ARTIFACT in that
+# target, and the stage the workflow builds saves the image. The Earthfile
+# goes at the root, so COPY paths are moved from the build `context`, a
+# directory of the repository. Raises UnsupportedInstruction for anything
+# without a plain Earthfile equivalent.
+def translate(content: str, workflow: str = "", context: str = "") -> str:
+    earthfile = _Translation(content, workflow, context).earthfile()
+    try:
+        parser.parse(earthfile)
+    except parser.EarthfileSyntaxError as e:
+        raise UnsupportedInstruction(f"translation does not parse: {e}", 1) from None
+    return earthfile
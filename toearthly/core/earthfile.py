@@ -0,0 +1,437 @@
+import functools
+import re
+import shlex
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+TARGET = re.compile(r"^([A-Za-z][A-Za-z0-9_.-]*):\s*$")
+QUOTING = re.compile(r"[\"'\\]")
+ARG_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# [path]+target[/artifact], e.g. +build/app, ./lib+deps or github.com/a/b+lint
+REFERENCE = re.compile(
+    r"^(?P<path>[^+\s]*)\+(?P<target>[A-Za-z][A-Za-z0-9_.-]*)(?P<artifact>/\S*)?$"
+)
+
+# Commands whose first word alone doesn't name them
+TWO_WORD = {"SAVE", "GIT", "WITH", "ELSE"}
+COMMANDS = {
+    "ADD", "ARG", "BUILD", "CACHE", "CMD", "COMMAND", "COPY", "DO", "ELSE",
+    "ELSE IF", "END", "ENTRYPOINT", "ENV", "EXPOSE", "FINALLY", "FOR", "FROM",
+    "FROM DOCKERFILE", "FUNCTION", "GIT CLONE", "HEALTHCHECK", "HOST", "IF", "IMPORT",
+    "LABEL", "LET", "LOCALLY", "PIPELINE", "PROJECT", "RUN", "SAVE ARTIFACT",
+    "SAVE IMAGE", "SET", "TRIGGER", "TRY", "USER", "VERSION", "VOLUME", "WAIT",
+    "WITH DOCKER", "WORKDIR",
+}
+# What starts a user defined command, FUNCTION being its current name
+FUNCTIONS = ("COMMAND", "FUNCTION")
+BLOCKS = {"FOR", "IF", "TRY", "WAIT", "WITH DOCKER"}
+# Commands that only continue the block on top of the stack
+CONTINUATIONS = {"ELSE": "IF", "ELSE IF": "IF", "FINALLY": "TRY"}
+MIN_ARGS = {
+    "ARG": 1, "BUILD": 1, "COPY": 2, "DO": 1, "ENV": 1, "FOR": 3, "FROM": 1,
+    "FROM DOCKERFILE": 1, "GIT CLONE": 2, "IF": 1, "IMPORT": 1, "RUN": 1,
+    "SAVE ARTIFACT": 1, "VERSION": 1, "WORKDIR": 1,
+}
+# Flags that take the next word as their value unless written --flag=value
+VALUE_FLAGS = {
+    "--build-arg", "--cache-from", "--chmod", "--chown", "--compose", "--id",
+    "--load", "--mount", "--network", "--platform", "--pull", "--secret",
+    "--service", "--sharing", "--target", "-f",
+}
+
+
+class EarthfileSyntaxError(ValueError):
+    def __init__(
+        self, message: str, line: int, column: int = 1, target: str = None
+    ) -> None:
+        super().__init__(f"line {line}:{column}: {message}")
+        self.message = message
+        self.line = line
+        self.column = column
+        self.target = target
+
+
+class Reference(NamedTuple):
+    path: str
+    target: str
+    artifact: Optional[str]
+    line: int
+    column: int
+
+    @property
+    def local(self) -> bool:
+        return not self.path
+
+
+class Command(NamedTuple):
+    name: str
+    args: Tuple[str, ...]
+    line: int
+    column: int
+    # Flags dropped, for the commands where positions matter
+    positional: Tuple[str, ...]
+    references: Tuple[Reference, ...]
+
+
+class Arg(NamedTuple):
+    name: str
+    default: Optional[str]
+    line: int
+
+
+class Artifact(NamedTuple):
+    source: str
+    destination: Optional[str]
+    local: Optional[str]
+    line: int
+
+
+class Target(NamedTuple):
+    name: str
+    line: int
+    commands: Tuple[Command, ...]
+
+    def find(self, name: str) -> List[Command]:
+        return [command for command in self.commands if command.name == name]
+
+    @property
+    def args(self) -> List[Arg]:
+        return _args(self.commands)
+
+    @property
+    def artifacts(self) -> List[Artifact]:
+        return [_artifact(command) for command in self.find("SAVE ARTIFACT")]
+
+    @property
+    def images(self) -> List[str]:
+        return [name for c in self.find("SAVE IMAGE") for name in c.positional]
+
+
+class Earthfile(NamedTuple):
+    version: Optional[str]
+    base: Tuple[Command, ...]
+    targets: Tuple[Target, ...]
+
+    def target(self, name: str) -> Optional[Target]:
+        for target in self.targets:
+            if target.name == name:
+                return target
+        return None
+
+    @property
+    def args(self) -> List[Arg]:
+        return _args(self.base)
+
+
+def _args(commands: Tuple[Command, ...]) -> List[Arg]:
+    found = []
+    for command in commands:
+        if command.name == "ARG":
+            name, _, default = command.positional[0].partition("=")
+            if not default and command.positional[1:2] == ("=",):
+                default = " ".join(command.positional[2:])
+            found.append(Arg(name, default or None, command.line))
+    return found
+
+
+def _artifact(command: Command) -> Artifact:
+    words = list(command.positional)
+    local = None
+    if len(words) >= 3 and words[-3:-1] == ["AS", "LOCAL"]:
+        local = words[-1]
+        words = words[:-3]
+    destination = words[1] if len(words) > 1 else None
+    return Artifact(words[0], destination, local, command.line)
+
+
+# Joins `\` continued lines, skipping comments and blank lines. Yields the
+# number of the line each statement starts on and its text.
+def _statements(content: str) -> List[Tuple[int, str]]:
+    statements = []
+    pending: Optional[Tuple[int, str]] = None
+    for number, line in enumerate(content.split("\n"), start=1):
+        stripped = line.strip()
+        if pending is not None:
+            if not stripped or stripped.startswith("#"):
+                continue
+            line = pending[1] + " " + stripped
+            number = pending[0]
+            pending = None
+        elif not stripped or stripped.startswith("#"):
+            continue
+        if line.rstrip().endswith("\\"):
+            pending = (number, line.rstrip()[:-1].rstrip())
+            continue
+        statements.append((number, line.rstrip()))
+    if pending is not None:
+        statements.append(pending)
+    return statements
+
+
+def _words(text: str, line: int, column: int) -> List[str]:
+    # shlex is slow, and only needed when there is quoting
+    if not QUOTING.search(text):
+        return text.split()
+    try:
+        return shlex.split(text, comments=False, posix=True)
+    except ValueError:
+        raise EarthfileSyntaxError("unbalanced quotes", line, column) from None
+
+
+def _positional(words: List[str]) -> List[str]:
+    positional = []
+    skip = False
+    for word in words:
+        if skip:
+            skip = False
+        elif word.startswith("-") and word != "-":
+            skip = word in VALUE_FLAGS
+        else:
+            positional.append(word)
+    return positional
+
+
+def _reference(word: str, line: int, column: int) -> Optional[Reference]:
+    if "$" in word:
+        return None
+    match = REFERENCE.match(word.strip("()"))
+    if match is None:
+        return None
+    path = match.group("path")
+    # Plain files with a + in the name, like c++.txt
+    if path and not path.startswith((".", "/")) and "." not in path:
+        return None
+    artifact = match.group("artifact")
+    return Reference(
+        path, match.group("target"), artifact[1:] if artifact else None, line, column
+    )
+
+
+def _references(
+    name: str, positional: List[str], line: int, column: int
+) -> List[Reference]:
+    if name == "COPY":
+        candidates = positional[:-1]
+    elif name in ("FROM", "BUILD", "DO", "IMPORT"):
+        candidates = positional[:1]
+    else:
+        return []
+    references = []
+    for word in candidates:
+        reference = _reference(word, line, column)
+        if reference is not None:
+            references.append(reference)
+    return references
+
+
+def _command(number: int, line: str) -> Command:
+    text = line.lstrip()
+    column = len(line) - len(text) + 1
+    first, rest = (text.split(None, 1) + ["", ""])[:2]
+    name = first
+    if first in TWO_WORD:
+        second, remainder = (rest.split(None, 1) + ["", ""])[:2]
+        if f"{first} {second}" in COMMANDS:
+            name, rest = f"{first} {second}", remainder
+    elif first == "FROM" and rest.lstrip().startswith("DOCKERFILE"):
+        name, rest = "FROM DOCKERFILE", rest.lstrip()[len("DOCKERFILE"):]
+    if name not in COMMANDS:
+        if not name.isupper():
+            message = f"expected a command or a target, found {first!r}"
+        else:
+            message = f"unknown command {name}"
+        raise EarthfileSyntaxError(message, number, column)
+
+    rest = rest.strip()
+    if name in ("RUN", "CMD", "ENTRYPOINT", "HEALTHCHECK", "IF", "ELSE IF"):
+        # Shell snippets are passed through as they are
+        args = [rest] if rest else []
+        positional = [word for word in rest.split() if not word.startswith("-")]
+    else:
+        args = _words(rest, number, column)
+        positional = _positional(args)
+    if len(positional) < MIN_ARGS.get(name, 0):
+        raise EarthfileSyntaxError(
+            f"{name} needs at least {MIN_ARGS[name]} argument(s)", number, column
+        )
+    if name == "ARG" and not ARG_NAME.match(positional[0].partition("=")[0]):
+        raise EarthfileSyntaxError(
+            f"invalid ARG name {positional[0].partition('=')[0]!r}", number, column
+        )
+    references = _references(name, positional, number, column)
+    return Command(
+        name, tuple(args), number, column, tuple(positional), tuple(references)
+    )
+
+
+def _close_blocks(blocks: List[Command], target: Optional[str]) -> None:
+    if blocks:
+        opened = blocks[-1]
+        raise EarthfileSyntaxError(
+            f"{opened.name} is missing its END", opened.line, opened.column, target
+        )
+
+
+def _recipe(
+    statements: List[Tuple[int, str]], target: Optional[str]
+) -> Tuple[Command, ...]:
+    commands = []
+    blocks: List[Command] = []
+    for number, line in statements:
+        try:
+            command = _command(number, line)
+        except EarthfileSyntaxError as e:
+            e.target = target
+            raise
+        if command.name in BLOCKS:
+            blocks.append(command)
+        elif command.name in CONTINUATIONS:
+            if not blocks or blocks[-1].name != CONTINUATIONS[command.name]:
+                raise EarthfileSyntaxError(
+                    f"{command.name} without {CONTINUATIONS[command.name]}",
+                    number,
+                    command.column,
+                    target,
+                )
+        elif command.name == "END":
+            if not blocks:
+                raise EarthfileSyntaxError(
+                    "END without an open block", number, command.column, target
+                )
+            blocks.pop()
+        elif command.name == "VERSION":
+            raise EarthfileSyntaxError(
+                "VERSION must be the first command", number, command.column, target
+            )
+        commands.append(command)
+    _close_blocks(blocks, target)
+    return tuple(commands)
+
+
+def _saves_artifacts(earthfile: Earthfile, name: str, seen: Set[str]) -> bool:
+    target = earthfile.target(name)
+    if target is None or name in seen:
+        return True
+    seen.add(name)
+    if target.find("SAVE ARTIFACT"):
+        return True
+    # FROM another target inherits what it saved
+    for command in target.find("FROM"):
+        for reference in command.references:
+            if reference.local and _saves_artifacts(earthfile, reference.target, seen):
+                return True
+    return False
+
+
+def _check_references(earthfile: Earthfile) -> None:
+    names = {target.name for target in earthfile.targets}
+    recipes = [(None, earthfile.base)]
+    recipes += [(target.name, target.commands) for target in earthfile.targets]
+    for name, commands in recipes:
+        for command in commands:
+            for reference in command.references:
+                if not reference.local:
+                    continue
+                if reference.target not in names:
+                    raise EarthfileSyntaxError(
+                        f"{command.name} refers to unknown target "
+                        f"+{reference.target}",
+                        reference.line,
+                        reference.column,
+                        name,
+                    )
+                if command.name != "COPY":
+                    continue
+                if reference.artifact is None:
+                    raise EarthfileSyntaxError(
+                        f"COPY +{reference.target} needs an artifact path, "
+                        f"e.g. +{reference.target}/file",
+                        reference.line,
+                        reference.column,
+                        name,
+                    )
+                if not _saves_artifacts(earthfile, reference.target, set()):
+                    # Reported on the target that needs the SAVE ARTIFACT
+                    raise EarthfileSyntaxError(
+                        f"+{reference.target} has no SAVE ARTIFACT, but line "
+                        f"{reference.line} copies +{reference.target}/"
+                        f"{reference.artifact}",
+                        earthfile.target(reference.target).line,
+                        1,
+                        reference.target,
+                    )
+
+
+@functools.lru_cache(maxsize=256)
+def _parse(content: str):
+    try:
+        return parse_uncached(content)
+    except EarthfileSyntaxError as e:
+        return e
+
+
+# Cached by content, so checking the same candidate twice is free. Raises
+# EarthfileSyntaxError with the line and column of the first problem.
+def parse(content: str) -> Earthfile:
+    result = _parse(content)
+    if isinstance(result, EarthfileSyntaxError):
+        raise result
+    return result
+
+
+def parse_uncached(content: str) -> Earthfile:
+    version = None
+    base: List[Tuple[int, str]] = []
+    recipes: Dict[str, Tuple[int, List[Tuple[int, str]]]] = {}
+    current: Optional[str] = None
+
+    statements = _statements(content)
+    if statements and statements[0][1].startswith("VERSION"):
+        number, line = statements.pop(0)
+        version_command = _command(number, line)
+        version = version_command.positional[0]
+
+    for number, line in statements:
+        indented = line[0] in " \t"
+        match = TARGET.match(line)
+        if match and not indented:
+            current = match.group(1)
+            if current == "base":
+                raise EarthfileSyntaxError(
+                    "a target can't be named base, it is the implicit base target",
+                    number,
+                    1,
+                    current,
+                )
+            if current in recipes:
+                raise EarthfileSyntaxError(
+                    f"duplicate target {current}", number, 1, current
+                )
+            recipes[current] = (number, [])
+        elif current is None:
+            if indented:
+                raise EarthfileSyntaxError(
+                    "unexpected indentation before the first target",
+                    number,
+                    len(line) - len(line.lstrip()) + 1,
+                )
+            base.append((number, line))
+        elif not indented:
+            raise EarthfileSyntaxError(
+                f"commands in target {current} must be indented",
+                number,
+                1,
+                current,
+            )
+        else:
+            recipes[current][1].append((number, line))
+
+    earthfile = Earthfile(
+        version,
+        _recipe(base, None),
+        tuple(
+            Target(name, number, _recipe(lines, name))
+            for name, (number, lines) in recipes.items()
+        ),
+    )
+    _check_references(earthfile)
+    return earthfile
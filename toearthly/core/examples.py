@@ -0,0 +1,48 @@
+import math
+import re
+from collections import Counter
+from typing import Callable, Dict, List
+
+TOKEN = re.compile(r"[a-z0-9_]+(?:[.\-/:][a-z0-9_]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(text.lower())
+
+
+# TF-IDF over the few-shot examples in toearthly/data, used to send a prompt
+# only the examples closest to its input. Built locally, no network.
+class ExampleIndex:
+    def __init__(
+        self, examples: List[Dict[str, str]], text: Callable[[Dict[str, str]], str]
+    ) -> None:
+        self.examples = examples
+        documents = [Counter(tokenize(text(example))) for example in examples]
+        frequency = Counter(term for document in documents for term in document)
+        self.idf = {
+            term: math.log((1 + len(documents)) / (1 + count)) + 1
+            for term, count in frequency.items()
+        }
+        self.vectors = [self._vector(document) for document in documents]
+
+    def _vector(self, counts: Counter) -> Dict[str, float]:
+        vector = {
+            term: (1 + math.log(count)) * self.idf[term]
+            for term, count in counts.items()
+            if term in self.idf
+        }
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
+
+    def scores(self, query: str) -> List[float]:
+        q = self._vector(Counter(tokenize(query)))
+        return [
+            sum(weight * vector.get(term, 0.0) for term, weight in q.items())
+            for vector in self.vectors
+        ]
+
+    # Most similar first, so trimming from the end drops the least relevant
+    def nearest(self, query: str, k: int) -> List[Dict[str, str]]:
+        scores = self.scores(query)
+        ranked = sorted(range(len(self.examples)), key=lambda i: (-scores[i], i))
+        return [self.examples[i] for i in ranked[:k]]
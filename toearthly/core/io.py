@@ -1,60 +1,136 @@
+import asyncio
+import atexit
 import contextlib
+import contextvars
+import functools
 import glob
 import os
 import subprocess
-import time
-from collections import defaultdict
-from typing import List, Tuple
-
-import openai
-from joblib import Memory
-
-from toearthly.core import constants
-
-openai.api_key = os.getenv("OPENAI_API_KEY")
+import sys
+import threading
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from toearthly.core import (
+    cache,
+    client,
+    constants,
+    provider,
+    stream,
+    trace,
+)
+from toearthly.core import earthfile as parser
+
+# Overrides constants.DEBUG_DIR for the current context, so batch workers
+# converting different repositories each get their own debug directory.
+_debug_dir: contextvars.ContextVar = contextvars.ContextVar("debug_dir", default=None)
+
+
+def debug_dir() -> str:
+    return _debug_dir.get() or constants.DEBUG_DIR
+
+
+# Once the last block using a directory exits, its log and trace handles are
+# closed and its spans forgotten, so batch runs don't hold on to them.
+@contextlib.contextmanager
+def use_debug_dir(path: str):
+    token = _debug_dir.set(path)
+    with _appenders_lock:
+        _debug_dir_users[path] = _debug_dir_users.get(path, 0) + 1
+    try:
+        yield
+    finally:
+        _debug_dir.reset(token)
+        with _appenders_lock:
+            _debug_dir_users[path] -= 1
+            last = not _debug_dir_users[path]
+            if last:
+                del _debug_dir_users[path]
+        if last:
+            _close_appenders(path)
+            trace.forget(path)
+
+
+# Conversions run side by side in one debug directory, like one per workflow,
+# each keep their debug files and checkpoints in a folder of their own. The
+# log, trace and caches stay shared. Folders nest, e.g. a job's folder inside
+# its workflow's.
+_debug_subdir: contextvars.ContextVar = contextvars.ContextVar(
+    "debug_subdir", default=None
+)
+
+
+def debug_subdir() -> Optional[str]:
+    return _debug_subdir.get()
+
+
+@contextlib.contextmanager
+def use_debug_subdir(name: str):
+    if debug_subdir() is not None:
+        name = os.path.join(debug_subdir(), name)
+    token = _debug_subdir.set(name)
+    try:
+        yield
+    finally:
+        _debug_subdir.reset(token)
+
+
+def _debug_path(subfolder: str = None) -> str:
+    directory = debug_dir()
+    if debug_subdir() is not None:
+        directory = os.path.join(directory, debug_subdir())
+    if subfolder is not None:
+        directory = os.path.join(directory, subfolder)
+    return directory
 
 def call_chat_completion_api_cached(max_tokens, messages, temperature):
-    cache = constants.DEBUG_DIR+"/data/gpt_cache"
-    memory = Memory(location=cache, verbose=1)
-    print(f"Caching GPT to {cache}")
-
-    @memory.cache
-    def inner_function(max_tokens, messages, temperature):
-        print("running prompt")
-        return call_chat_completion_api(max_tokens, messages, temperature)
-
-    return inner_function(max_tokens, messages, temperature)
-
+    llm_cache = cache.llm_cache
+    key = llm_cache.key(constants.LLM_MODEL, messages, temperature, max_tokens)
+    if key in llm_cache:
+        return llm_cache[key]
+    content = call_chat_completion_api(max_tokens, messages, temperature)
+    llm_cache[key] = content
+    return content
+
+# Raises client.RetriesExhausted when the API keeps failing, or the API's own
+# error when retrying can't help. With constants.STREAM, prints tokens as they
+# arrive; the policy's deadline covers waiting for the first of them.
 def call_chat_completion_api(max_tokens, messages, temperature):
-    max_retries = 3
-    initial_delay = 1
-    factor = 2
-
-    retries = 0
-    delay = initial_delay
+    sender = provider.get()
 
-    while retries < max_retries:
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
+    async def complete() -> str:
+        response = await client.call(
+            lambda: sender.create(
+                model=constants.LLM_MODEL,
                 max_tokens=max_tokens,
                 temperature=temperature,
                 messages=messages,
+                stream=constants.STREAM,
             )
+        )
+        if not constants.STREAM:
             print(response.choices[0].message.content)
             return response.choices[0].message.content
-        except Exception as e:
-            print(f"Error: {e}, Retrying...")
-            time.sleep(delay)
-            retries += 1
-            delay *= factor
-    print("Max retries reached. Returning 'Error'.")
-    return "Error: Max Retry Hit"
+        content = ""
+        async for token in provider.text(response):
+            print(token, end="", flush=True)
+            content += token
+        print()
+        return content
+
+    with trace.span("llm", "chat"):
+        return asyncio.run(complete())
 
 def read(filepath: str) -> str:
     with open(filepath, "r") as outfile:
         return outfile.read()
 
+# Paths relative to the toearthly package, for use with relative_read
+def relative_glob(pattern: str) -> List[str]:
+    package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    matches = glob.glob(os.path.join(package_dir, pattern))
+    return sorted(os.path.relpath(match, package_dir) for match in matches)
+
+@functools.lru_cache(maxsize=None)
 def relative_read(relative_filepath: str) -> str:
     # Get the directory of the current script file
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -75,33 +151,24 @@ def write(contents: str, filepath: str) -> None:
 
 
 def write_debug(filename: str, contents: str, subfolder: str = None) -> None:
-    debug_dir = constants.DEBUG_DIR
-    if subfolder is not None:
-        debug_dir = os.path.join(debug_dir, subfolder)
-    filepath = os.path.join(debug_dir, filename)
-    os.makedirs(debug_dir, exist_ok=True)
+    directory = _debug_path(subfolder)
+    filepath = os.path.join(directory, filename)
+    os.makedirs(directory, exist_ok=True)
     with open(filepath, "w") as outfile:
         outfile.write(contents)
 
 
 def find_first_workflow(path=None) -> Tuple[str, str]:
-    if path is None:
-        path = os.getcwd()
-
-    if not path.endswith("/"):
-        path += "/"
-
-    yml_files = glob.glob(path + ".github/workflows/*.yml")
-
-    if not yml_files:
-        raise Exception("No yml files found. Process will stop.")
-
+    yml_files = find_workflows(path)
     with open(yml_files[0], "r") as file:
         yml = file.read()
     write_debug("workflow.yml", yml)
     return (yml_files[0], yml)
 
 
+WORKFLOW_PATTERNS = (".github/workflows/*.yml", ".github/workflows/*.yaml")
+
+
 def find_workflows(path=None) -> List[str]:
     if path is None:
         path = os.getcwd()
@@ -109,7 +176,9 @@ def find_workflows(path=None) -> List[str]:
     if not path.endswith("/"):
         path += "/"
 
-    yml_files = glob.glob(path + ".github/workflows/*.yml")
+    yml_files = sorted(
+        file for pattern in WORKFLOW_PATTERNS for file in glob.glob(path + pattern)
+    )
 
     if not yml_files:
         raise Exception("No yml files found. Process will stop.")
@@ -117,89 +186,143 @@ def find_workflows(path=None) -> List[str]:
     return yml_files
 
 
-def find_first_dockerfile(path=None) -> Tuple[str, str]:
-    if path is None:
-        path = os.getcwd()
+_appenders: Dict[str, TextIO] = {}
+_appenders_lock = threading.Lock()
+# How many use_debug_dir blocks are in each directory
+_debug_dir_users: Dict[str, int] = {}
 
-    if not path.endswith("/"):
-        path += "/"
 
-    docker_files = glob.glob(path + "Dockerfile")
+# A line buffered handle per file, for the log and the trace, kept open until
+# its use_debug_dir block or the process ends. Writes through it are safe from
+# several threads.
+def appender(filepath: str) -> TextIO:
+    with _appenders_lock:
+        if filepath not in _appenders:
+            directory = os.path.dirname(filepath)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            _appenders[filepath] = open(filepath, "a", buffering=1)
+        return _appenders[filepath]
 
-    if not docker_files:
-        return ("","")
 
-    with open(docker_files[0], "r") as file:
-        dockerfile = file.read()
-    write_debug("Dockerfile", dockerfile)
-    return (docker_files[0], dockerfile)
+# Closes the handles of files in `directory`, or all of them
+@atexit.register
+def _close_appenders(directory: str = None) -> None:
+    with _appenders_lock:
+        for filepath in list(_appenders):
+            folder = os.path.normpath(os.path.dirname(filepath))
+            if directory is None or folder == os.path.normpath(directory):
+                _appenders.pop(filepath).close()
 
 
-# Like tree but less output
-def print_directory(path, prefix="", level=0, max_level=1) -> str:
-    if level > max_level:
-        return ""
+def log(message: str) -> None:
+    appender(os.path.join(debug_dir(), "log.txt")).write(message + "\n")
 
-    dir_structure = ""
-    dir_items = defaultdict(list)
+class _ThreadStream:
+    # contextlib.redirect_stdout swaps sys.stdout for the whole process, which
+    # breaks when two stages run at once. This routes writes per thread instead.
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
 
-    # Group files by extension and directories separately
-    for item in os.listdir(path):
-        # Ignore hidden files and directories
-        if item.startswith("."):
-            continue
+    def _target(self):
+        return getattr(self._local, "target", None) or self._default
 
-        if os.path.isfile(os.path.join(path, item)):
-            ext = os.path.splitext(item)[1]
-            dir_items[ext].append(item)
-        else:
-            dir_items["folders"].append(item)
+    def write(self, s):
+        return self._target().write(s)
 
-    # Generate directory structure, combining files with same extension if more than 3
-    for ext, items in dir_items.items():
-        if ext != "folders":
-            if len(items) > 3:
-                dir_structure += f"{prefix}├── *{ext}\n"
-            else:
-                for item in items:
-                    dir_structure += f"{prefix}├── {item}\n"
-        else:
-            for item in items:
-                dir_structure += f"{prefix}├── {item}/\n"
-                if level < max_level:
-                    subdir_structure = print_directory(
-                        os.path.join(path, item), prefix + "│   ", level + 1, max_level
-                    )
-                    dir_structure += subdir_structure
-    write_debug("files.txt", dir_structure)
-    return dir_structure
+    def flush(self):
+        self._target().flush()
 
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    @contextlib.contextmanager
+    def redirect(self, target):
+        previous = getattr(self._local, "target", None)
+        self._local.target = target
+        try:
+            yield
+        finally:
+            self._local.target = previous
+
+
+_stream_lock = threading.Lock()
 
-def log(message: str) -> None:
-    log_file_path = os.path.join(constants.DEBUG_DIR, "log.txt")
-    os.makedirs(constants.DEBUG_DIR, exist_ok=True)
 
-    with open(log_file_path, "a") as log_file:
-        log_file.write(message + "\n")
+def _thread_streams() -> Tuple[_ThreadStream, _ThreadStream]:
+    with _stream_lock:
+        if not isinstance(sys.stdout, _ThreadStream):
+            sys.stdout = _ThreadStream(sys.stdout)
+        if not isinstance(sys.stderr, _ThreadStream):
+            sys.stderr = _ThreadStream(sys.stderr)
+    return (sys.stdout, sys.stderr)
+
 
 def run_llm_program(program, *args, **kwargs):
-    with open(constants.DEBUG_DIR + "log.txt", "a") as f, contextlib.redirect_stdout(
-        f
-    ), contextlib.redirect_stderr(f):
-        return program(*args, **kwargs)
-
-def verify(earthfile: str) -> None:
-    debug_earthfile_path = os.path.join(constants.DEBUG_DIR, "Earthfile")
-    write(earthfile, debug_earthfile_path)
-    result = subprocess.run(
-        ["earthly", "debug", "ast", debug_earthfile_path],
-        capture_output=True,
-        text=True,
-    )
-    if result.returncode != 0:
-        error_message = f"Verification failed with errors:\n{result.stderr}"
-        if constants.VERIFY_EARTHFILE:
-            raise ValueError(error_message)
-        else:
-            print(error_message)
-            print("Continuing despite the verification failure.")
+    stdout, stderr = _thread_streams()
+    f = appender(os.path.join(debug_dir(), "log.txt"))
+    with stdout.redirect(f), stderr.redirect(f):
+        return _raise_failure(program(*args, **kwargs))
+
+# guidance keeps the exception a program failed with instead of raising it,
+# which would otherwise surface later as a missing variable
+def _raise_failure(out):
+    if out is not None and out._exception is not None:
+        raise out._exception
+    return out
+
+# Like run_llm_program, but streams. Each partial program is passed to
+# on_update outside the log redirect, so it can print progress. Once it returns
+# True the running gen is stopped and the program finishes with what it has.
+# A stopped gen's answer, up to where it stopped, is cached like a whole one,
+# so a rerun answers from the cache.
+def stream_llm_program(program, on_update, *args, **kwargs):
+    stdout, stderr = _thread_streams()
+    partial = None
+    stopping = False
+    f = appender(os.path.join(debug_dir(), "log.txt"))
+    with stream.tracking() as streams:
+        steps = program(*args, stream=True, **kwargs)
+        while True:
+            with stdout.redirect(f), stderr.redirect(f):
+                step = next(steps, None)
+            if step is None:
+                break
+            partial = step
+            if not stopping and on_update(partial):
+                stopping = True
+                if partial._executor is not None:
+                    partial._executor.should_stop = True
+    _raise_failure(partial)
+    if stopping:
+        for key, chunks in streams.items():
+            # The gen stops on the chunk after the stop, without using it
+            if len(chunks) > 1:
+                cache.llm_cache[key] = chunks[:-1]
+    return partial
+
+def verify(earthfile: str, subfolder: str = None) -> None:
+    with trace.span("verify", subfolder or "Earthfile"):
+        directory = _debug_path(subfolder)
+        debug_earthfile_path = os.path.join(directory, "Earthfile")
+        write(earthfile, debug_earthfile_path)
+        error_message = None
+        try:
+            parser.parse(earthfile)
+        except parser.EarthfileSyntaxError as e:
+            error_message = f"Verification failed with errors:\n{e}"
+        if error_message is None and constants.VERIFY_WITH_EARTHLY:
+            result = subprocess.run(
+                ["earthly", "debug", "ast", debug_earthfile_path],
+                capture_output=True,
+                text=True,
+            )
+            if result.returncode != 0:
+                error_message = f"Verification failed with errors:\n{result.stderr}"
+        if error_message is not None:
+            if constants.VERIFY_EARTHFILE:
+                raise ValueError(error_message)
+            else:
+                print(error_message)
+                print("Continuing despite the verification failure.")
@@ -0,0 +1,99 @@
+import re
+import sys
+import threading
+from typing import Dict, List
+
+from toearthly.core import cache, client, constants, provider, stream
+
+_lock = threading.Lock()
+_llms: Dict[str, object] = {}
+
+
+# About four characters a token, as for English and code, with whitespace
+# riding along with what follows it. A word is split into pieces of up to four
+# characters, rounding up per word, so the estimate is a little high.
+WORD = re.compile(r"\s*\S{1,4}|\s+")
+
+
+# Stands in for a tiktoken encoding that can't be loaded, as tiktoken
+# downloads it on first use. Token counts are only estimates, which is enough
+# for budgets and routing.
+class EstimatedEncoding:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._ids: Dict[str, int] = {}
+        self._words: List[str] = []
+        self._lock = threading.Lock()
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        with self._lock:
+            tokens = []
+            for word in WORD.findall(text):
+                if word not in self._ids:
+                    self._ids[word] = len(self._words)
+                    self._words.append(word)
+                tokens.append(self._ids[word])
+            return tokens
+
+    def decode(self, tokens: List[int]) -> str:
+        with self._lock:
+            return "".join(self._words[token] for token in tokens)
+
+
+# guidance loads the model's encoding when the client is made, so one that
+# can't be loaded offline is replaced by an estimate first
+def _ensure_encoding(model: str) -> None:
+    import tiktoken
+
+    try:
+        name = tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        return
+    try:
+        tiktoken.get_encoding(name)
+    except Exception as e:
+        print(f"Can't load the {name} tokenizer ({type(e).__name__}), estimating")
+        tiktoken.registry.ENCODINGS[name] = EstimatedEncoding(name)
+
+
+# Records streamed gens for stream.tracking as they arrive
+def _track_streams(openai_llm) -> None:
+    stream_then_save = openai_llm.stream_then_save
+
+    async def tracked(gen, key, stop_regex, n):
+        chunks = stream.opened(key)
+        async for chunk in stream_then_save(gen, key, stop_regex, n):
+            if chunks is not None:
+                chunks.append(chunk)
+            yield chunk
+        stream.closed(key)
+
+    openai_llm.stream_then_save = tracked
+
+
+# guidance and openai take most of a second to import and build a tokenizer,
+# so the client for each model is created on first use and then shared by
+# every prompt module. Its requests are sent by the process's provider, under
+# the client policy: deadlines, retries and hedging.
+def get(model: str = None):
+    model = model or constants.LLM_MODEL
+    with _lock:
+        if model not in _llms:
+            sender = provider.get()
+            import guidance
+
+            guidance.llms.OpenAI.cache = cache.llm_cache
+            _ensure_encoding(model)
+            openai_llm = guidance.llms.OpenAI(model)
+            openai_llm.caller = client.wrap(sender.guidance_caller(openai_llm.encode))
+            _track_streams(openai_llm)
+            _llms[model] = openai_llm
+        return _llms[model]
+
+
+# For `except` clauses: openai is only imported once a request is made, and
+# nothing can raise its errors before then.
+def invalid_request_error():
+    if "openai" not in sys.modules:
+        return ()
+    return sys.modules["openai"].error.InvalidRequestError
@@ -1,22 +1,63 @@
 from typing import List
 
+from toearthly.core import trace
 
-def extract_code_blocks(markdown: str) -> List[str]:
-    in_code_block = False
-    code_blocks: List[str] = []
-    current_block: List[str] = []
 
-    lines = markdown.split("\n")
-    for line in lines:
+# Incremental extract_code_blocks: feed text as it streams in and get back
+# each block as soon as its closing fence arrives.
+class CodeBlockStream:
+    def __init__(self, min_lines: int = 3) -> None:
+        self.min_lines = min_lines
+        self.in_code_block = False
+        self._current_block: List[str] = []
+        self._partial_line = ""
+
+    def _line(self, line: str) -> List[str]:
         if line.strip().startswith("```"):
-            if in_code_block:  # End of a block
+            code_blocks = []
+            if self.in_code_block:  # End of a block
                 # Small blocks are usually just an description
                 # of how to run the code, and not actual code
-                if len(current_block) > 2:
-                    code_blocks.append("\n".join(current_block))
-                current_block = []
-            in_code_block = not in_code_block
-        elif in_code_block:  # Inside a block
-            current_block.append(line)
-
-    return code_blocks
+                if len(self._current_block) >= self.min_lines:
+                    code_blocks.append("\n".join(self._current_block))
+                self._current_block = []
+            self.in_code_block = not self.in_code_block
+            return code_blocks
+        if self.in_code_block:  # Inside a block
+            self._current_block.append(line)
+        return []
+
+    def feed(self, text: str) -> List[str]:
+        *lines, self._partial_line = (self._partial_line + text).split("\n")
+        code_blocks: List[str] = []
+        for line in lines:
+            code_blocks += self._line(line)
+        # A closing fence needs no newline after it to be complete
+        if self.in_code_block and self._partial_line.strip() == "```":
+            code_blocks += self._line(self._partial_line)
+            self._partial_line = ""
+        return code_blocks
+
+    def close(self) -> List[str]:
+        line, self._partial_line = self._partial_line, ""
+        return self._line(line)
+
+
+def extract_code_blocks(markdown: str, min_lines: int = 3) -> List[str]:
+    with trace.span("extract", "code blocks"):
+        stream = CodeBlockStream(min_lines)
+        return stream.feed(markdown) + stream.close()
+
+
+class UnexpectedCodeBlocks(ValueError):
+    pass
+
+
+# The code blocks of an answer that has to have exactly `count` of them
+def expect_code_blocks(markdown: str, count: int, min_lines: int = 3) -> List[str]:
+    results = extract_code_blocks(markdown, min_lines)
+    if len(results) != count:
+        raise UnexpectedCodeBlocks(
+            f"{count} Files exepected back. Instead got {len(results)}."
+        )
+    return results
@@ -0,0 +1,305 @@
+import os
+import re
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from toearthly.core import earthfile as parser
+
+ALL = "all"
+# Base commands that can't simply be copied into a target
+NOT_INLINABLE = {"IMPORT", "LOCALLY", "PROJECT"}
+
+
+class MergeConflict(ValueError):
+    pass
+
+
+# An Earthfile split into its preamble (the base target, without VERSION)
+# and the raw lines of each target, so merged output keeps the original text.
+class Source:
+    def __init__(self, content: str, name: str) -> None:
+        self.name = name
+        try:
+            self.ast = parser.parse(content)
+        except parser.EarthfileSyntaxError as e:
+            raise MergeConflict(f"{name} does not parse: {e}") from None
+        lines = content.split("\n")
+        starts = [target.line for target in self.ast.targets] + [len(lines) + 1]
+        self.preamble = _trimmed(
+            [line for line in lines[: starts[0] - 1] if not line.startswith("VERSION")]
+        )
+        self.raw = {
+            target.name: _trimmed(lines[start - 1 : end - 1])
+            for target, start, end in zip(self.ast.targets, starts, starts[1:])
+        }
+        self.base = [_text(command) for command in self.ast.base]
+        self.base_from = next(
+            (c.positional[0] for c in self.ast.base if c.name == "FROM"), None
+        )
+
+    def targets(self) -> List[parser.Target]:
+        return [target for target in self.ast.targets if target.name != ALL]
+
+    # What `all` builds, or the targets nothing else uses if there is no `all`
+    def wanted(self) -> List[str]:
+        target = self.ast.target(ALL)
+        if target is not None:
+            return [
+                reference.target
+                for command in target.find("BUILD")
+                for reference in command.references
+                if reference.local
+            ]
+        used = {
+            reference.target
+            for target in self.targets()
+            for command in target.commands
+            for reference in command.references
+            if reference.local
+        }
+        return [
+            target.name
+            for target in self.targets()
+            if target.name not in used and not _is_command(target)
+        ]
+
+    # Everything a target runs, with the base it inherits written out
+    def body(self, target: parser.Target) -> Tuple[str, ...]:
+        commands = [_text(command) for command in target.commands]
+        if not commands or not commands[0].startswith(("FROM ", *parser.FUNCTIONS)):
+            commands = self.base + commands
+        return tuple(commands)
+
+
+def _trimmed(lines: List[str]) -> List[str]:
+    while lines and not lines[0].strip():
+        lines = lines[1:]
+    while lines and not lines[-1].strip():
+        lines = lines[:-1]
+    return lines
+
+
+def _text(command: parser.Command) -> str:
+    return " ".join((command.name,) + command.args)
+
+
+def _is_command(target: parser.Target) -> bool:
+    return bool(target.commands) and target.commands[0].name in parser.FUNCTIONS
+
+
+def _rename(text: str, renames: Dict[str, str]) -> str:
+    for old, new in renames.items():
+        if old != new:
+            text = re.sub(
+                rf"(^|[\s(=])\+{re.escape(old)}(?=[/\s)]|$)", rf"\g<1>+{new}", text
+            )
+    return text
+
+
+def _version(*candidates: Optional[str]) -> Optional[str]:
+    versions = [version for version in candidates if version]
+    if not versions:
+        return None
+    return max(
+        versions, key=lambda v: tuple(int(part) for part in re.findall(r"\d+", v))
+    )
+
+
+# Name clashes are prefixed with the image the second file builds on, as in
+# alpine-build, or with its project name when both use the same image.
+def _prefix(first: Source, second: Source) -> str:
+    if second.base_from and second.base_from != first.base_from:
+        name = second.base_from.split("/")[-1].split(":")[0].split("@")[0]
+    else:
+        name = os.path.splitext(os.path.basename(second.name))[0]
+    return _slug(name)
+
+
+def _slug(name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-") or "other"
+
+
+def _unique(name: str, taken: Set[str]) -> str:
+    candidate, n = name, 2
+    while candidate in taken:
+        candidate = f"{name}{n}"
+        n += 1
+    return candidate
+
+
+# Targets of `second` that repeat one of `bodies`, mapped to its name. Bodies
+# are compared with the matches found so far applied until nothing changes,
+# so chains like deps <- build <- lint match as a whole.
+def _duplicates(
+    bodies: Dict[Tuple[str, ...], str], second: Source
+) -> Dict[str, str]:
+    same: Dict[str, str] = {}
+    changed = True
+    while changed:
+        changed = False
+        for target in second.targets():
+            if target.name in same:
+                continue
+            body = tuple(_rename(line, same) for line in second.body(target))
+            if body in bodies:
+                same[target.name] = bodies[body]
+                changed = True
+    return same
+
+
+def _inline_base(
+    source: Source, target: parser.Target, lines: List[str]
+) -> List[str]:
+    if target.commands and target.commands[0].name in ("FROM", *parser.FUNCTIONS):
+        return lines
+    for command in source.ast.base:
+        if command.name in NOT_INLINABLE:
+            raise MergeConflict(f"{source.name} has {command.name} in its base")
+        if command.name == "ARG" and "--global" in command.args:
+            raise MergeConflict(f"{source.name} has global ARGs")
+    if source.base_from is None:
+        raise MergeConflict(f"{source.name} has targets without a FROM")
+    indent = " " * (target.commands[0].column - 1) if target.commands else "  "
+    return lines[:1] + [indent + line for line in source.base] + lines[1:]
+
+
+def _all(first: Source, second: Source, renames: Dict[str, str]) -> List[str]:
+    other = second.ast.target(ALL)
+    if other is not None and any(c.name != "BUILD" for c in other.commands):
+        raise MergeConflict(f"{ALL} in {second.name} does more than BUILD")
+
+    existing = first.ast.target(ALL)
+    if existing is not None:
+        lines = list(first.raw[ALL])
+        built = first.wanted()
+        indent = " " * (existing.commands[0].column - 1) if existing.commands else "  "
+        wanted = []
+    else:
+        lines = [f"{ALL}:"]
+        built = []
+        indent = "  "
+        wanted = first.wanted()
+    wanted += [renames.get(name, name) for name in second.wanted()]
+    for name in wanted:
+        if name not in built:
+            built.append(name)
+            lines.append(f"{indent}BUILD +{name}")
+    return lines if built else []
+
+
+# Merges two Earthfiles without the LLM. Targets of the second file that
+# repeat one of the first are dropped, clashing names get a prefix, the base
+# of the second file is written into its targets when the bases differ, and
+# `all` builds everything either file built. Raises MergeConflict when the
+# files can't be combined this way.
+def merge(file1: str, name1: str, file2: str, name2: str) -> str:
+    first, second = Source(file1, name1), Source(file2, name2)
+
+    bodies = {first.body(target): target.name for target in first.targets()}
+    duplicates = _duplicates(bodies, second)
+    renames = dict(duplicates)
+    taken = {target.name for target in first.ast.targets}
+    prefix = _prefix(first, second)
+    for target in second.targets():
+        if target.name in duplicates:
+            continue
+        name = target.name
+        if name in taken:
+            name = _unique(f"{prefix}-{name}", taken)
+        renames[target.name] = name
+        taken.add(name)
+
+    sections = [first.raw[target.name] for target in first.targets()]
+    for target in second.targets():
+        if target.name in duplicates:
+            continue
+        lines = [_rename(line, renames) for line in second.raw[target.name]]
+        lines[0] = f"{renames[target.name]}:"
+        if first.base != second.base:
+            lines = _inline_base(second, target, lines)
+        sections.append(lines)
+    all_lines = _all(first, second, renames)
+    if all_lines:
+        sections.append(all_lines)
+
+    out = []
+    version = _version(first.ast.version, second.ast.version)
+    if version:
+        out.append(f"VERSION {version}")
+    out += first.preamble
+    for lines in sections:
+        out += [""] + lines
+    merged = "\n".join(out) + "\n"
+    try:
+        parser.parse(merged)
+    except parser.EarthfileSyntaxError as e:
+        raise MergeConflict(f"merged Earthfile does not parse: {e}") from None
+    return merged
+
+
+# Combines the Earthfiles of a workflow's jobs, converted one at a time and
+# given as (job id, Earthfile, ids of the jobs it needs) with needed jobs
+# first. Targets repeated across jobs are kept once, names that clash get the
+# job's id as a prefix, and bases that differ from the first job's are written
+# into the targets, as in merge. Each job gets a target named after it that
+# BUILDs the jobs it needs and what its own `all` built, and `all` builds the
+# jobs no other job needs. Raises MergeConflict when the files can't be
+# combined this way.
+def stitch(jobs: Sequence[Tuple[str, str, Sequence[str]]]) -> str:
+    sources = [Source(content, id) for id, content, _ in jobs]
+    first = sources[0]
+    names = {id: _slug(id) for id, _, _ in jobs}
+    if len(set(names.values())) < len(names) or ALL in names.values():
+        raise MergeConflict(f"job ids {', '.join(names)} clash as target names")
+
+    taken = set(names.values())
+    bodies: Dict[Tuple[str, ...], str] = {}
+    sections: List[List[str]] = []
+    wanted: Dict[str, List[str]] = {}
+    for (id, _, _), source in zip(jobs, sources):
+        other = source.ast.target(ALL)
+        if other is not None and any(c.name != "BUILD" for c in other.commands):
+            raise MergeConflict(f"{ALL} in {id} does more than BUILD")
+        duplicates = _duplicates(bodies, source)
+        renames = dict(duplicates)
+        for target in source.targets():
+            if target.name in duplicates:
+                continue
+            name = target.name
+            if name == names[id]:
+                name = _unique(f"{name}-steps", taken)
+            elif name in taken:
+                name = _unique(f"{names[id]}-{name}", taken)
+            renames[target.name] = name
+            taken.add(name)
+        for target in source.targets():
+            if target.name in duplicates:
+                continue
+            lines = [_rename(line, renames) for line in source.raw[target.name]]
+            lines[0] = f"{renames[target.name]}:"
+            if source.base != first.base:
+                lines = _inline_base(source, target, lines)
+            sections.append(lines)
+            body = tuple(_rename(line, renames) for line in source.body(target))
+            bodies[body] = renames[target.name]
+        wanted[id] = [renames.get(name, name) for name in source.wanted()]
+
+    needed = {need for _, _, needs in jobs for need in needs}
+    for id, _, needs in jobs:
+        builds = [names[need] for need in needs if need in names] + wanted[id]
+        sections.append([f"{names[id]}:"] + [f"  BUILD +{name}" for name in builds])
+    leaves = [names[id] for id, _, _ in jobs if id not in needed]
+    sections.append([f"{ALL}:"] + [f"  BUILD +{name}" for name in leaves])
+
+    out = []
+    version = _version(*(source.ast.version for source in sources))
+    if version:
+        out.append(f"VERSION {version}")
+    out += first.preamble
+    for lines in sections:
+        out += [""] + lines
+    stitched = "\n".join(out) + "\n"
+    try:
+        parser.parse(stitched)
+    except parser.EarthfileSyntaxError as e:
+        raise MergeConflict(f"stitched Earthfile does not parse: {e}") from None
+    return stitched
@@ -0,0 +1,148 @@
+import json
+import re
+import threading
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from toearthly.core import checkpoint, client, constants, io, stream, trace
+
+ROLE_MARKER = re.compile(r"<\|im_(start|end)\|>")
+TAG = re.compile(r"{{.*?}}", re.S)
+ROLE_TAG = re.compile(r"{{#(system|user|assistant)")
+MAX_TOKENS = re.compile(r"max_tokens=(\w+)")
+
+# Per message formatting the API adds on top of the content
+TOKENS_PER_MESSAGE = 4
+# Room the short plan in front of a fast answer gets
+FAST_PLAN_TOKENS = 200
+
+
+# A guidance program split in two. The prefix (system prompt, docs and
+# few-shot examples) is the same for every request, so it is rendered to text
+# once per LLM. The suffix is compiled once per LLM behind a `{{prefix}}`
+# variable holding that text, so only the per-request part is templated per
+# call.
+#
+# `trim` names static variables that can be cut when the prompt is too long,
+# in the order they should go: a list loses its last item per step, a string
+# is emptied. Level n is the prefix with the first n steps applied.
+#
+# A call can replace static variables, e.g. with few-shot examples picked for
+# that request. Each distinct choice gets its own rendered prefixes.
+#
+# `name` is the stage its LLM requests are made for, which picks their
+# client policy.
+#
+# `fast` is the suffix used instead with constants.FAST: one turn that asks
+# for the answer straight away, after at most a short plan, rather than a
+# separate plan turn first.
+class Template:
+    def __init__(
+        self,
+        prefix: str,
+        suffix: str,
+        static: Callable[[], Dict[str, Any]],
+        trim: Sequence[str] = (),
+        name: str = None,
+        fast: str = None,
+    ) -> None:
+        self.prefix = prefix
+        self.suffix = suffix
+        self.fast = fast
+        self.static = static
+        self.trim = trim
+        self.name = name
+        self._rendered: Dict[Tuple[int, str, int], str] = {}
+        self._programs: Dict[Tuple[int, bool], Any] = {}
+        self._levels: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def levels(self, static: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        key = json.dumps(static, sort_keys=True)
+        with self._lock:
+            if key not in self._levels:
+                variables = {**self.static(), **(static or {})}
+                levels = [dict(variables)]
+                for name in self.trim:
+                    if isinstance(variables[name], list):
+                        while variables[name]:
+                            variables[name] = variables[name][:-1]
+                            levels.append(dict(variables))
+                    elif variables[name]:
+                        variables[name] = ""
+                        levels.append(dict(variables))
+                self._levels[key] = levels
+            return self._levels[key]
+
+    def rendered_prefix(
+        self, llm, level: int = 0, static: Dict[str, Any] = None
+    ) -> str:
+        variables = self.levels(static)[level]
+        key = (id(llm), json.dumps(static, sort_keys=True), level)
+        with self._lock:
+            if key not in self._rendered:
+                import guidance
+
+                prefix = guidance(self.prefix, llm=llm, silent=True)
+                self._rendered[key] = str(prefix(**variables))
+            return self._rendered[key]
+
+    def is_fast(self) -> bool:
+        return constants.FAST and self.fast is not None
+
+    def active_suffix(self) -> str:
+        return self.fast if self.is_fast() else self.suffix
+
+    # The gen sizes a call asks budget.fit for. A fast call only has the
+    # gens of its suffix, the first one with room for the plan.
+    def outputs(self, outputs: Dict[str, int]) -> Dict[str, int]:
+        if not self.is_fast():
+            return outputs
+        names = MAX_TOKENS.findall(self.fast)
+        fast = {name: outputs[name] for name in names}
+        fast[names[0]] += FAST_PLAN_TOKENS
+        return fast
+
+    def program(self, llm):
+        key = (id(llm), self.is_fast())
+        with self._lock:
+            if key not in self._programs:
+                import guidance
+
+                self._programs[key] = guidance(
+                    "{{prefix}}" + self.active_suffix(), llm=llm
+                )
+            return self._programs[key]
+
+    # Prompt tokens for a call, not counting what the gens will add
+    def measure(
+        self, llm, level: int = 0, static: Dict[str, Any] = None, **kwargs
+    ) -> int:
+        prefix = self.rendered_prefix(llm, level, static)
+        suffix = self.active_suffix()
+        text = ROLE_MARKER.sub("", prefix) + TAG.sub("", suffix)
+        text += "".join(str(v) for v in kwargs.values())
+        messages = prefix.count("<|im_start|>") + len(ROLE_TAG.findall(suffix))
+        return len(llm.encode(text)) + messages * TOKENS_PER_MESSAGE
+
+    def __call__(
+        self,
+        llm,
+        level: int = 0,
+        static: Dict[str, Any] = None,
+        progress: stream.Progress = None,
+        **kwargs,
+    ):
+        checkpoint.check_cancelled()
+        prefix = self.rendered_prefix(llm, level, static)
+        span = trace.span(
+            "llm", self.name, level=level, model=llm.model_name, fast=self.is_fast()
+        )
+        with client.use_stage(self.name), span:
+            if progress is None:
+                return io.run_llm_program(self.program(llm), prefix=prefix, **kwargs)
+            progress.start()
+            out = io.stream_llm_program(
+                self.program(llm), progress, prefix=prefix, **kwargs
+            )
+        progress.finish()
+        return out
@@ -0,0 +1,234 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, NamedTuple, Optional
+
+from toearthly.core import boot, constants, trace
+
+# Put on the queue when a stream has no more chunks
+_END = object()
+# How often a worker waiting for a slot checks whether it's still wanted
+SLOT_POLL = 0.1
+
+
+class Config(NamedTuple):
+    model: str
+    # An OpenAI compatible API, or None for OPENAI_API_BASE or OpenAI itself
+    base_url: Optional[str]
+    connect_timeout: float
+    read_timeout: float
+    concurrency: int
+
+
+def config() -> Config:
+    return Config(
+        constants.LLM_MODEL,
+        constants.LLM_BASE_URL or os.environ.get("OPENAI_API_BASE"),
+        constants.LLM_CONNECT_TIMEOUT,
+        max([constants.LLM_TIMEOUT, *constants.LLM_STAGE_TIMEOUTS.values()]),
+        constants.LLM_CONCURRENCY,
+    )
+
+
+# One request's hold on a concurrency slot. A caller that gives up, like the
+# loser of a hedge or a request past its deadline, can't stop the worker's
+# blocking read, so it gives the slot back itself and the worker's response is
+# dropped.
+class _Slot:
+    def __init__(self, slots: threading.BoundedSemaphore) -> None:
+        self.slots = slots
+        self.cancelled = threading.Event()
+        self.held = False
+        self.lock = threading.Lock()
+
+    # False once cancelled, without sending the request
+    def acquire(self) -> bool:
+        while not self.slots.acquire(timeout=SLOT_POLL):
+            if self.cancelled.is_set():
+                return False
+        with self.lock:
+            if self.cancelled.is_set():
+                self.slots.release()
+                return False
+            self.held = True
+        return True
+
+    def release(self) -> None:
+        with self.lock:
+            if self.held:
+                self.held = False
+                self.slots.release()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        self.release()
+
+
+# Sends every LLM request in the process over one pooled HTTP session, so
+# stages and batch workers running at once reuse connections, and at most
+# `concurrency` requests are in flight.
+#
+# guidance runs each program in a new event loop, which rules out sharing an
+# aiohttp session, so requests are made with requests on worker threads. A
+# worker owns its request until the response is read, handing stream chunks
+# to the caller's loop as they arrive.
+class Provider:
+    def __init__(self, config: Config) -> None:
+        import openai
+        import requests
+
+        self.config = config
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=config.concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        openai.requestssession = self.session
+        self._slots = threading.BoundedSemaphore(config.concurrency)
+        # Workers waiting for a slot don't hold up the ones that have one
+        self._workers = ThreadPoolExecutor(
+            max_workers=config.concurrency * 4, thread_name_prefix="llm"
+        )
+
+    def _send(self, kwargs: dict) -> Any:
+        import openai
+
+        return openai.ChatCompletion.create(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            api_base=self.config.base_url,
+            request_timeout=(self.config.connect_timeout, self.config.read_timeout),
+            **kwargs,
+        )
+
+    def _request(self, kwargs: dict, slot: _Slot) -> Any:
+        if not slot.acquire():
+            return None
+        try:
+            return self._send(kwargs)
+        finally:
+            slot.release()
+
+    # A chat completion, or with stream=True an async iterator of its chunks
+    # once the response has started
+    async def create(self, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        slot = _Slot(self._slots)
+        if not kwargs.get("stream"):
+            try:
+                response = await loop.run_in_executor(
+                    self._workers, functools.partial(self._request, kwargs, slot)
+                )
+            except asyncio.CancelledError:
+                slot.cancel()
+                raise
+            usage = response.get("usage") or {}
+            trace.count("prompt_tokens", usage.get("prompt_tokens", 0))
+            trace.count("completion_tokens", usage.get("completion_tokens", 0))
+            return response
+
+        started: asyncio.Future = loop.create_future()
+        chunks: asyncio.Queue = asyncio.Queue()
+        stop = slot.cancelled
+
+        def deliver(item: Any) -> None:
+            if started.done():
+                chunks.put_nowait(item)
+            elif isinstance(item, BaseException):
+                started.set_exception(item)
+            else:
+                started.set_result(None)
+
+        def post(item: Any) -> None:
+            try:
+                loop.call_soon_threadsafe(deliver, item)
+            except RuntimeError:
+                # The loop is closed, nobody is reading any more
+                stop.set()
+
+        def produce() -> None:
+            if not slot.acquire():
+                return
+            try:
+                response = self._send(kwargs)
+                post(None)
+                for chunk in response:
+                    if stop.is_set():
+                        response.close()
+                        return
+                    post(chunk)
+                post(_END)
+            except Exception as e:
+                post(e)
+            finally:
+                slot.release()
+
+        self._workers.submit(produce)
+        try:
+            await started
+        except BaseException:
+            slot.cancel()
+            raise
+        return self._stream(chunks, slot, trace.current())
+
+    # Streams don't report usage, each chunk is about a token
+    async def _stream(self, chunks: asyncio.Queue, slot: _Slot, span: "trace.Span"):
+        try:
+            while True:
+                item = await chunks.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                trace.count("completion_tokens", at=span)
+                yield item
+        finally:
+            slot.cancel()
+
+    # A replacement for guidance's OpenAI caller, which makes its own session
+    # per request. `encode` counts the prompt tokens of streamed requests.
+    def guidance_caller(self, encode: Callable[[str], list]) -> Callable[..., Any]:
+        from guidance.llms._openai import add_text_to_chat_mode, prompt_to_messages
+
+        async def caller(**kwargs) -> Any:
+            if kwargs.get("stream"):
+                trace.count("prompt_tokens", len(encode(kwargs["prompt"])))
+            kwargs["messages"] = prompt_to_messages(kwargs.pop("prompt"))
+            kwargs.pop("echo", None)
+            kwargs.pop("logprobs", None)
+            return add_text_to_chat_mode(await self.create(**kwargs))
+
+        return caller
+
+
+_lock = threading.Lock()
+_provider: Optional[Provider] = None
+
+
+# With constants.CASSETTE requests are recorded to or replayed from that
+# file, see core/cassette.py. Replaying needs no API key.
+def get() -> Provider:
+    global _provider
+    with _lock:
+        if _provider is None:
+            if constants.CASSETTE:
+                from toearthly.core import cassette
+
+                _provider = cassette.provider_for(config())
+            else:
+                boot.check_api_key()
+                _provider = Provider(config())
+        return _provider
+
+
+# Replaces the provider, before the first LLM client is made
+def install(replacement: Provider) -> None:
+    global _provider
+    with _lock:
+        _provider = replacement
+
+
+# The chunks' text, for callers that don't go through guidance
+async def text(chunks: AsyncIterator[Any]) -> AsyncIterator[str]:
+    async for chunk in chunks:
+        yield chunk.choices[0].delta.get("content", "")
@@ -0,0 +1,54 @@
+from typing import Callable, List, Tuple
+
+from toearthly.core import earthfile as parser
+from toearthly.core import io
+
+# fix(snippet, error, outline) returns the corrected snippet
+Fixer = Callable[[str, str, str], str]
+
+
+# Lines [start, end) of the target the error is in, or of the base target
+# when the error comes before the first target
+def region(content: str, error: parser.EarthfileSyntaxError) -> Tuple[int, int]:
+    lines = content.split("\n")
+    headers = [n for n, line in enumerate(lines) if parser.TARGET.match(line)]
+    start = max([header for header in headers if header <= error.line - 1] or [0])
+    end = min([header for header in headers if header > start] or [len(lines)])
+    while end > start + 1 and not lines[end - 1].strip():
+        end -= 1
+    return (start, end)
+
+
+# The file with the region left out, so the model can see the other targets
+def outline(content: str, start: int, end: int) -> str:
+    lines = content.split("\n")
+    return "\n".join(lines[:start] + ["<part to fix>"] + lines[end:]).strip()
+
+
+def splice(content: str, start: int, end: int, replacement: str) -> str:
+    lines = content.split("\n")
+    return "\n".join(lines[:start] + replacement.strip("\n").split("\n") + lines[end:])
+
+
+# Re-parses the Earthfile, and while the parser finds an error sends only the
+# offending target with the error to `fix` and splices the answer back in.
+# Gives up after `attempts` fixes, or when a fix changes nothing, returning
+# the last version for io.verify to report.
+def repair(content: str, fix: Fixer, attempts: int) -> str:
+    seen: List[str] = []
+    for attempt in range(attempts + 1):
+        try:
+            parser.parse(content)
+            return content
+        except parser.EarthfileSyntaxError as e:
+            error = e
+        if attempt == attempts or content in seen:
+            break
+        seen.append(content)
+        start, end = region(content, error)
+        io.log(f"Repair {attempt + 1}/{attempts}: {error}")
+        snippet = "\n".join(content.split("\n")[start:end])
+        content = splice(
+            content, start, end, fix(snippet, str(error), outline(content, start, end))
+        )
+    return content
@@ -0,0 +1,350 @@
+import json
+import os
+import re
+import threading
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from toearthly.core import constants, io, scanner, trace, workflow
+
+INDEX = "index.json"
+# Bump when what the index holds changes, so old files are rebuilt
+VERSION = 1
+MANIFESTS = {
+    "requirements.txt",
+    "pyproject.toml",
+    "setup.py",
+    "Pipfile",
+    "package.json",
+    "go.mod",
+    "Cargo.toml",
+    "pom.xml",
+    "build.gradle",
+    "build.gradle.kts",
+    "Gemfile",
+    "composer.json",
+    "Makefile",
+}
+# Levels of a relevant directory listed under it
+SUBTREE_DEPTH = 2
+GLOB = re.compile(r"[*?\[]")
+EXPRESSION = re.compile(r"\$\{\{")
+# Separators around file names in run scripts and action inputs
+WORD = re.compile(r"[^\s'\"=,;:()]+")
+
+
+class Entry(NamedTuple):
+    # Relative to the root, with "/" separators
+    path: str
+    directory: bool
+    # "dockerfile", "manifest", or a file's extension
+    kind: str
+    size: int
+
+
+class Index(NamedTuple):
+    root: str
+    entries: Tuple[Entry, ...]
+    # Scanned directories: their mtime and their .gitignore's, to tell when
+    # the index is stale, and whether the scan finished them
+    directories: Dict[str, Tuple[int, int, bool]]
+    truncated: Optional[str]
+
+    def paths(self) -> Dict[str, Entry]:
+        return {entry.path: entry for entry in self.entries}
+
+    def dockerfiles(self) -> List[Entry]:
+        return [entry for entry in self.entries if entry.kind == "dockerfile"]
+
+    def manifests(self) -> List[Entry]:
+        return [entry for entry in self.entries if entry.kind == "manifest"]
+
+
+def kind(name: str) -> str:
+    if name == "Dockerfile" or name.startswith("Dockerfile."):
+        return "dockerfile"
+    if name.endswith(".Dockerfile") or name.endswith(".dockerfile"):
+        return "dockerfile"
+    if name in MANIFESTS:
+        return "manifest"
+    return os.path.splitext(name)[1]
+
+
+def _mtime(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _signature(root: str, relative: str) -> Tuple[int, int]:
+    directory = os.path.join(root, relative)
+    return (_mtime(directory), _mtime(os.path.join(directory, scanner.GITIGNORE)))
+
+
+def _walk(node: scanner.Node, relative: str) -> Iterator[Tuple[str, scanner.Node]]:
+    for child in node.children:
+        path = f"{relative}/{child.name}" if relative else child.name
+        yield path, child
+        yield from _walk(child, path)
+
+
+def build(root: str) -> Index:
+    scan = scanner.scan(root, sizes=True)
+    entries = []
+    directories = {"": (*_signature(root, ""), scan.root.complete)}
+    for path, node in _walk(scan.root, ""):
+        if node.directory:
+            entries.append(Entry(path, True, "", 0))
+            if node.complete or node.children:
+                directories[path] = (*_signature(root, path), node.complete)
+        else:
+            entries.append(Entry(path, False, kind(node.name), node.size))
+    return Index(root, tuple(entries), directories, scan.truncated)
+
+
+def index_path() -> str:
+    return os.path.join(io.debug_dir(), "data", INDEX)
+
+
+def _settings() -> List[Any]:
+    return [VERSION, constants.SCAN_IGNORE, constants.SCAN_MAX_DEPTH]
+
+
+def _load(root: str) -> Optional[Index]:
+    try:
+        with open(index_path(), "r") as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if saved.get("root") != root or saved.get("settings") != _settings():
+        return None
+    directories = {path: tuple(d) for path, d in saved["directories"].items()}
+    for path, (mtime, ignore_mtime, _) in directories.items():
+        if _signature(root, path) != (mtime, ignore_mtime):
+            return None
+    entries = tuple(Entry(*entry) for entry in saved["entries"])
+    return Index(root, entries, directories, None)
+
+
+def _save(index: Index) -> None:
+    saved = {
+        "root": index.root,
+        "settings": _settings(),
+        "entries": index.entries,
+        "directories": index.directories,
+    }
+    io.write(json.dumps(saved), index_path())
+
+
+_lock = threading.Lock()
+_indexes: Dict[str, Index] = {}
+
+
+# The index of a repository, built once per process and saved in the debug
+# directory for the next run. A saved index is used while none of the
+# directories it scanned, or their .gitignore files, have changed. One cut
+# short by the scan budgets isn't saved.
+def get(root: str) -> Index:
+    root = os.path.abspath(root)
+    with _lock:
+        if root in _indexes:
+            return _indexes[root]
+        with trace.span("index", root) as span:
+            index = _load(root)
+            span.attributes["reused"] = index is not None
+            if index is None:
+                index = build(root)
+                if index.truncated is None:
+                    _save(index)
+        _indexes[root] = index
+        return index
+
+
+# Glob filters match below the part before the first wildcard
+def _glob_prefix(pattern: str) -> str:
+    parts = []
+    for part in _normalize(pattern).split("/"):
+        if GLOB.search(part):
+            break
+        parts.append(part)
+    return "/".join(parts)
+
+
+def _normalize(path: str) -> str:
+    path = os.path.normpath(path.strip()).replace(os.sep, "/")
+    return "" if path == "." else path.lstrip("/")
+
+
+def _triggers(raw: Dict[str, Any]) -> Any:
+    # YAML reads an unquoted `on` key as True
+    return raw.get("on", raw.get(True))
+
+
+def _paths_filters(raw: Dict[str, Any]) -> List[str]:
+    triggers = _triggers(raw)
+    if not isinstance(triggers, dict):
+        return []
+    filters = []
+    for trigger in triggers.values():
+        if isinstance(trigger, dict):
+            filters += [p for p in trigger.get("paths") or [] if not p.startswith("!")]
+    return filters
+
+
+def _working_directories(parsed: workflow.Workflow) -> Iterator[Tuple[str, Any]]:
+    for job in parsed.jobs:
+        default = parsed.run_default(job, "working-directory")
+        for step in job.steps:
+            yield (step.working_directory or default or ""), step
+
+
+# Directories of the repository the workflow works in: its working
+# directories, the directories its `paths` filters match, and those of the
+# nested files and directories its steps refer to. Empty when it works on the
+# whole repository, like a filter matching everywhere, or can't be read.
+def relevant(index: Index, content: str) -> List[str]:
+    try:
+        parsed = workflow.parse(content)
+    except ValueError:
+        return []
+    paths = index.paths()
+
+    # Paths that aren't in the index, like hidden ones, give None
+    def directory(path: str) -> Optional[str]:
+        entry = paths.get(_normalize(path))
+        if entry is None:
+            return None
+        return entry.path if entry.directory else os.path.dirname(entry.path)
+
+    found = []
+    for pattern in _paths_filters(parsed.raw):
+        prefix = _glob_prefix(pattern)
+        if not prefix:
+            return []
+        found.append(directory(prefix))
+    for working_directory, step in _working_directories(parsed):
+        working_directory = str(working_directory)
+        if EXPRESSION.search(working_directory):
+            working_directory = ""
+        found.append(directory(working_directory))
+        text = " ".join(
+            [step.run or ""] + [str(value) for value in step.inputs.values()]
+        )
+        for word in WORD.findall(text):
+            # Names at the root say little about which part is used
+            if EXPRESSION.search(word) or "/" not in word.strip("./"):
+                continue
+            for candidate in (os.path.join(working_directory, word), word):
+                match = directory(candidate)
+                if match is not None:
+                    found.append(match)
+                    break
+    # Root entries are always listed
+    found = sorted(set(path for path in found if path))
+    # Leave out directories inside another one
+    return [
+        path
+        for path in found
+        if not any(path.startswith(other + "/") for other in found if other != path)
+    ]
+
+
+# The index as a scanner tree. With `prefixes` only their subtrees, down to
+# SUBTREE_DEPTH levels, and the directories leading to them are kept below
+# the root's own entries. Paths in `exclude` are left out.
+def tree(
+    index: Index, prefixes: List[str] = None, exclude: Sequence[str] = ()
+) -> scanner.Node:
+    root = scanner.Node(os.path.basename(index.root), True)
+    root.complete = index.directories.get("", (0, 0, False))[2]
+    nodes = {"": root}
+
+    def keep(path: str) -> bool:
+        if not prefixes:
+            return True
+        if "/" not in path:
+            return True
+        for prefix in prefixes:
+            if prefix.startswith(path + "/") or prefix == path:
+                return True
+            if path.startswith(prefix + "/"):
+                return path[len(prefix) + 1:].count("/") < SUBTREE_DEPTH
+        return False
+
+    for entry in index.entries:
+        parent = nodes.get(os.path.dirname(entry.path))
+        if parent is None or entry.path in exclude or not keep(entry.path):
+            continue
+        node = scanner.Node(os.path.basename(entry.path), entry.directory)
+        node.size = entry.size
+        if entry.directory:
+            node.complete = index.directories.get(entry.path, (0, 0, False))[2]
+            nodes[entry.path] = node
+        parent.children.append(node)
+    return root
+
+
+# The files listing stages are given: the repository one level deep, or for a
+# workflow that only touches part of it, the parts it touches. `exclude` are
+# files the conversion writes, like the Earthfile, so the listing (and the
+# checkpoints keyed on it) is the same on the next run.
+def file_structure(root: str, content: str, exclude: Sequence[str] = ()) -> str:
+    index = get(root)
+    exclude = [_normalize(os.path.relpath(path, index.root)) for path in exclude]
+    prefixes = relevant(index, content)
+    if prefixes:
+        io.log(f"Files relevant to the workflow: {', '.join(prefixes)}")
+        depth = max(prefix.count("/") for prefix in prefixes) + SUBTREE_DEPTH
+        structure = scanner.render(tree(index, prefixes, exclude), depth)
+    else:
+        structure = scanner.render(tree(index, exclude=exclude), 1)
+    io.write_debug("files.txt", structure)
+    return structure
+
+
+# The Dockerfile for a workflow: the one at the root, else the first in the
+# directories the workflow touches. Any other is likely some other part's, so
+# without either there is none.
+def find_dockerfile(root: str, content: str = None) -> Optional[str]:
+    index = get(root)
+    dockerfiles = index.dockerfiles()
+    for entry in dockerfiles:
+        if entry.path == "Dockerfile":
+            return os.path.join(index.root, entry.path)
+    prefixes = relevant(index, content) if content else []
+    for entry in dockerfiles:
+        if any(entry.path.startswith(prefix + "/") for prefix in prefixes):
+            return os.path.join(index.root, entry.path)
+    return None
+
+
+# The path and content of the Dockerfile for a workflow, see find_dockerfile,
+# or ("", "") without one
+def find_first_dockerfile(root: str = None, workflow: str = None) -> Tuple[str, str]:
+    root = root or os.getcwd()
+    path = os.path.join(root, "Dockerfile")
+    if not os.path.isfile(path):
+        path = find_dockerfile(root, workflow)
+    if path is None:
+        return ("", "")
+    dockerfile = io.read(path)
+    io.write_debug("Dockerfile", dockerfile)
+    return (path, dockerfile)
+
+
+# The build context of a Dockerfile, taken to be its directory, as a path
+# from the root: "" for the root's own Dockerfile
+def build_context(root: str, dockerfile_path: str) -> str:
+    if not dockerfile_path:
+        return ""
+    directory = os.path.dirname(os.path.abspath(dockerfile_path))
+    return _normalize(os.path.relpath(directory, os.path.abspath(root)))
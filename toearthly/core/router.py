@@ -0,0 +1,72 @@
+import functools
+import json
+from typing import Any, Callable, Dict, List, Sequence, TypeVar
+
+from toearthly.core import budget, constants, io, llm, markdown, trace
+from toearthly.core import earthfile as parser
+
+T = TypeVar("T")
+# Answers from a cheaper model that are asked again on constants.LLM_MODEL:
+# the wrong number of code blocks, or an Earthfile that doesn't parse
+ESCALATE_ON = (markdown.UnexpectedCodeBlocks, parser.EarthfileSyntaxError)
+# Rule keys that aren't conditions on the stage's facts
+RULE_KEYS = ("model", "max_input_tokens")
+
+
+class RouteError(ValueError):
+    pass
+
+
+# The routing config, constants.LLM_ROUTES: a JSON object of rules by stage (a
+# prompt module's template name). A rule names a model and when to use it:
+# `max_input_tokens` for the stage's inputs, and any other key has to equal
+# the fact of that name the stage passes, like `parses`. The first rule that
+# matches picks the model, a stage without one uses constants.LLM_MODEL.
+@functools.lru_cache(maxsize=None)
+def routes(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    config = json.loads(io.relative_read(path))
+    for stage, rules in config.items():
+        for rule in rules:
+            if rule.get("model") not in budget.CONTEXT_WINDOWS:
+                raise RouteError(f"{path}: {stage} routes to unknown model {rule}")
+    return config
+
+
+def input_tokens(inputs: Sequence[str]) -> int:
+    return len(llm.get().encode("".join(inputs)))
+
+
+def choose(stage: str, tokens: int, **facts: Any) -> str:
+    for rule in routes(constants.LLM_ROUTES).get(stage, []):
+        if tokens > rule.get("max_input_tokens", tokens):
+            continue
+        if all(facts.get(k) == v for k, v in rule.items() if k not in RULE_KEYS):
+            return rule["model"]
+    return constants.LLM_MODEL
+
+
+# Runs `attempt` with the model the stage's route picks for these inputs. If
+# that is a cheaper model whose answer has the wrong code blocks, or fails
+# `check` (the parse io.verify does, for stages that answer with an
+# Earthfile), the stage is run again on constants.LLM_MODEL.
+def run(
+    stage: str,
+    inputs: Sequence[str],
+    attempt: Callable[[str], T],
+    check: Callable[[T], Any] = None,
+    **facts: Any,
+) -> T:
+    if not constants.LLM_ROUTES:
+        return attempt(constants.LLM_MODEL)
+    model = choose(stage, input_tokens(inputs), **facts)
+    if model == constants.LLM_MODEL:
+        return attempt(model)
+    try:
+        result = attempt(model)
+        if check is not None:
+            check(result)
+        return result
+    except ESCALATE_ON as e:
+        io.log(f"{stage}: answer from {model} rejected, escalating: {e}")
+        trace.count("escalations")
+    return attempt(constants.LLM_MODEL)
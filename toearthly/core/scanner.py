@@ -0,0 +1,201 @@
+import os
+import re
+import time
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from toearthly.core import constants, io, trace
+
+GITIGNORE = ".gitignore"
+
+
+class Rule(NamedTuple):
+    # Directory of the .gitignore, relative to the scan root, "" for the root
+    base: str
+    pattern: re.Pattern
+    negate: bool
+    directory_only: bool
+
+
+class Node:
+    def __init__(self, name: str, directory: bool) -> None:
+        self.name = name
+        self.directory = directory
+        self.children: List["Node"] = []
+        # Bytes, for files of a scan with sizes
+        self.size = 0
+        # False for a directory the scan didn't get to, or only got partway
+        # through, because of its depth or budget
+        self.complete = not directory
+
+
+class Scan(NamedTuple):
+    root: Node
+    entries: int
+    # Why the scan stopped early, None when it saw everything up to its depth
+    truncated: Optional[str]
+
+
+def _translate(pattern: str) -> str:
+    out = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            out += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            out += "/.*"
+            i += 3
+        elif pattern[i] == "*":
+            out += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            out += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            out += "[" + pattern[i + 1:end].replace("!", "^", 1) + "]"
+            i = end + 1
+        else:
+            if pattern[i] == "\\" and i + 1 < len(pattern):
+                i += 1
+            out += re.escape(pattern[i])
+            i += 1
+    return out
+
+
+# The rules of a .gitignore, in order. A pattern with a slash other than a
+# trailing one is relative to the file's directory, otherwise it matches a
+# name at any depth below it.
+def parse_gitignore(text: str, base: str = "") -> List[Rule]:
+    rules = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            continue
+        prefix = "" if "/" in line else "(?:.*/)?"
+        pattern = re.compile(prefix + _translate(line.lstrip("/")) + r"\Z")
+        rules.append(Rule(base, pattern, negate, directory_only))
+    return rules
+
+
+# The last rule that matches decides, like git
+def ignored(rules: List[Rule], relative: str, directory: bool) -> bool:
+    result = False
+    for rule in rules:
+        if rule.directory_only and not directory:
+            continue
+        if rule.base:
+            if not relative.startswith(rule.base + "/"):
+                continue
+            path = relative[len(rule.base) + 1:]
+        else:
+            path = relative
+        if rule.pattern.match(path):
+            result = not rule.negate
+    return result
+
+
+# Walks the tree breadth first, so shallow levels are complete before deeper
+# ones are started. Hidden entries are skipped, and so is anything the
+# .gitignore files met on the way, or constants.SCAN_IGNORE, exclude. Ignored
+# directories aren't entered. The scan stops once it has seen
+# constants.SCAN_MAX_ENTRIES entries or run for SCAN_MAX_SECONDS, leaving
+# the directories it didn't finish incomplete. Getting file sizes costs a
+# stat per file, so they are only read when asked for.
+def scan(path: str, max_depth: int = None, sizes: bool = False) -> Scan:
+    if max_depth is None:
+        max_depth = constants.SCAN_MAX_DEPTH
+    with trace.span("scan", path) as span:
+        root = Node(os.path.basename(os.path.abspath(path)), True)
+        defaults = parse_gitignore("\n".join(constants.SCAN_IGNORE))
+        deadline = time.perf_counter() + constants.SCAN_MAX_SECONDS
+        pending: Deque[Tuple[Node, str, str, int, List[Rule]]] = deque(
+            [(root, path, "", 0, defaults)]
+        )
+        seen: Set[Tuple[int, int]] = set()
+        entries = 0
+        truncated = None
+        while pending and truncated is None:
+            node, directory, relative, depth, rules = pending.popleft()
+            try:
+                # A symlink back up the tree is entered once
+                stat = os.stat(directory)
+                if (stat.st_dev, stat.st_ino) in seen:
+                    continue
+                seen.add((stat.st_dev, stat.st_ino))
+                with os.scandir(directory) as it:
+                    found = sorted(it, key=lambda entry: entry.name)
+                if any(entry.name == GITIGNORE for entry in found):
+                    text = io.read(os.path.join(directory, GITIGNORE))
+                    rules = rules + parse_gitignore(text, relative)
+            except OSError as e:
+                io.log(f"Scan skipped {directory}: {e}")
+                continue
+            for entry in found:
+                if entries >= constants.SCAN_MAX_ENTRIES:
+                    truncated = f"more than {entries} entries"
+                    break
+                if time.perf_counter() > deadline:
+                    truncated = f"over {constants.SCAN_MAX_SECONDS:g}s"
+                    break
+                if entry.name.startswith("."):
+                    continue
+                is_file = entry.is_file()
+                child_relative = f"{relative}/{entry.name}" if relative else entry.name
+                if ignored(rules, child_relative, not is_file):
+                    continue
+                entries += 1
+                child = Node(entry.name, not is_file)
+                if sizes and is_file:
+                    child.size = entry.stat().st_size
+                node.children.append(child)
+                if child.directory and depth < max_depth:
+                    queued = (child, entry.path, child_relative, depth + 1, rules)
+                    pending.append(queued)
+            else:
+                node.complete = True
+        span.attributes["entries"] = entries
+        if truncated is not None:
+            span.attributes["truncated"] = truncated
+            io.log(f"Scan of {path} stopped early, {truncated}")
+        return Scan(root, entries, truncated)
+
+
+# The directory's entries `max_level` levels of subdirectories deep, like
+# tree but shorter: when a directory has more than `group` files with the
+# same extension they are shown as one `*<ext>` line. Groups come in the
+# order their first entry sorts, folders being one group.
+def render(node: Node, max_level: int = 1, group: int = 3) -> str:
+    lines: List[str] = []
+    _render(node, "", 0, max_level, group, lines)
+    return "".join(lines)
+
+
+def _render(
+    node: Node, prefix: str, level: int, max_level: int, group: int, lines: List[str]
+) -> None:
+    groups: Dict[str, List[Node]] = {}
+    for child in node.children:
+        key = "folders" if child.directory else os.path.splitext(child.name)[1]
+        groups.setdefault(key, []).append(child)
+    for key, children in groups.items():
+        if key != "folders":
+            if len(children) > group:
+                lines.append(f"{prefix}├── *{key}\n")
+            else:
+                lines += [f"{prefix}├── {child.name}\n" for child in children]
+            continue
+        for child in children:
+            lines.append(f"{prefix}├── {child.name}/\n")
+            if level < max_level:
+                _render(child, prefix + "│   ", level + 1, max_level, group, lines)
+    if not node.complete and level <= max_level:
+        lines.append(f"{prefix}├── ...\n")
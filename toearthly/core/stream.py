@@ -0,0 +1,104 @@
+import contextlib
+import contextvars
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from toearthly.core import constants, markdown
+
+# Seconds between progress lines for a stage
+REPORT_INTERVAL = 5.0
+
+
+# Watches a streaming guidance program for one stage. Reports how far each gen
+# has got and collects code blocks from the last gen as their closing fence
+# arrives. Once `blocks` code blocks are complete it asks for generation to
+# stop, so the stage moves on without waiting for trailing prose.
+class Progress:
+    def __init__(self, stage: str, gens: Sequence[str], blocks: int = 1) -> None:
+        self.stage = stage
+        self.gens = gens
+        self.wanted = blocks
+        self.blocks: List[str] = []
+        self.first_output: Optional[float] = None
+        self.stopped = False
+        self._code = markdown.CodeBlockStream()
+        self._lengths: Dict[str, int] = {}
+        self._start = time.perf_counter()
+        self._reported = self._start
+
+    def _print(self, message: str) -> None:
+        print(f"[{self.stage}] {message}", flush=True)
+
+    def start(self) -> None:
+        self._start = self._reported = time.perf_counter()
+        self._print("started")
+
+    def __call__(self, partial) -> bool:
+        now = time.perf_counter()
+        for name in self.gens:
+            text = partial.get(name) or ""
+            seen = self._lengths.get(name, 0)
+            if len(text) == seen:
+                continue
+            self._lengths[name] = len(text)
+            if self.first_output is None:
+                self.first_output = now - self._start
+                self._print(f"first output after {self.first_output:.1f}s")
+            if name == self.gens[-1]:
+                for block in self._code.feed(text[seen:]):
+                    self.blocks.append(block)
+                    self._print(f"code block {len(self.blocks)} complete")
+        if now - self._reported >= REPORT_INTERVAL:
+            self._reported = now
+            # A fast program has no plan gen
+            sizes = ", ".join(
+                f"{n} {self._lengths[n]} chars" for n in self.gens if n in self._lengths
+            )
+            self._print(f"{sizes or 'waiting'} ({now - self._start:.0f}s)")
+        self.stopped = bool(self.wanted) and len(self.blocks) >= self.wanted
+        return self.stopped
+
+    def finish(self) -> None:
+        message = f"done in {time.perf_counter() - self._start:.1f}s"
+        if self.stopped:
+            message += ", stopped after the last code block"
+        self._print(message)
+
+
+# guidance caches a streamed gen once its stream ends, which it never does
+# when the program is stopped early. The chunks of the gens still streaming,
+# by cache key, are kept here so io.stream_llm_program can cache what the
+# program used of them itself.
+_open: contextvars.ContextVar = contextvars.ContextVar("open_streams", default=None)
+
+
+@contextlib.contextmanager
+def tracking() -> Iterator[Dict[str, List[Any]]]:
+    streams: Dict[str, List[Any]] = {}
+    token = _open.set(streams)
+    try:
+        yield streams
+    finally:
+        _open.reset(token)
+
+
+# The list to add the chunks of a gen's stream to, None when not tracking
+def opened(key: str) -> Optional[List[Any]]:
+    streams = _open.get()
+    if streams is None:
+        return None
+    streams[key] = []
+    return streams[key]
+
+
+def closed(key: str) -> None:
+    streams = _open.get()
+    if streams is not None:
+        streams.pop(key, None)
+
+
+# None unless streaming is on, so prompts can always pass the result along
+def progress(stage: str, gens: Sequence[str], blocks: int = 1) -> Optional[Progress]:
+    if not constants.STREAM:
+        return None
+    return Progress(stage, gens, blocks)
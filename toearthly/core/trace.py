@@ -0,0 +1,125 @@
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from toearthly.core import io
+
+TRACE = "trace.jsonl"
+# Counted on the span they happen in and added to every span around it
+COUNTERS = (
+    "requests",
+    "cache_hits",
+    "retries",
+    "hedges",
+    "escalations",
+    "prompt_tokens",
+    "completion_tokens",
+    "tokens_saved",
+)
+
+
+class Span:
+    def __init__(self, kind: str, name: str, parent: Optional["Span"]) -> None:
+        self.id = next(_ids)
+        self.kind = kind
+        self.name = name
+        self.parent = parent
+        self.attributes: Dict[str, Any] = {}
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.start = time.time()
+        self.seconds = 0.0
+        self.error: Optional[str] = None
+
+    def record(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "parent": self.parent.id if self.parent else None,
+            "kind": self.kind,
+            "name": self.name,
+            "start": round(self.start, 3),
+            "seconds": round(self.seconds, 3),
+            "error": self.error,
+            **self.counts,
+            **self.attributes,
+        }
+
+
+_ids = itertools.count(1)
+_current: contextvars.ContextVar = contextvars.ContextVar("span", default=None)
+_lock = threading.Lock()
+# Finished spans by debug directory, for the summary
+_finished: Dict[str, List[Span]] = {}
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+# Times the block as a span inside the current one. When it ends the span is
+# appended to trace.jsonl in the debug directory, one JSON object per line.
+# Spans nest across threads started with contextvars.copy_context, and across
+# the event loop guidance runs programs in.
+@contextlib.contextmanager
+def span(kind: str, name: str, **attributes: Any):
+    opened = Span(kind, name, _current.get())
+    opened.attributes.update(attributes)
+    token = _current.set(opened)
+    start = time.perf_counter()
+    try:
+        yield opened
+    except BaseException as e:
+        opened.error = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        opened.seconds = time.perf_counter() - start
+        _current.reset(token)
+        directory = io.debug_dir()
+        line = json.dumps(opened.record(), default=str)
+        io.appender(os.path.join(directory, TRACE)).write(line + "\n")
+        with _lock:
+            _finished.setdefault(directory, []).append(opened)
+
+
+# Adds to a counter of the current span, or of `at`, and the spans around it
+def count(name: str, n: int = 1, at: Span = None) -> None:
+    target = at or _current.get()
+    with _lock:
+        while target is not None:
+            target.counts[name] += n
+            target = target.parent
+
+
+# Spans finished so far for the debug directory, oldest first
+def spans() -> List[Span]:
+    with _lock:
+        return sorted(_finished.get(io.debug_dir(), []), key=lambda s: s.start)
+
+
+# Drops the finished spans of a debug directory once it is summarized
+def forget(directory: str = None) -> None:
+    with _lock:
+        _finished.pop(directory or io.debug_dir(), None)
+
+
+# A table of the outermost spans traced into the debug directory
+def summary() -> str:
+    rows = [s for s in spans() if s.parent is None]
+    if not rows:
+        return ""
+    labels = [f"{s.kind} {s.name}" for s in rows] + ["total"]
+    width = max(len(label) for label in labels)
+    header = ["seconds", *COUNTERS]
+    out = [" " * width + "  " + "  ".join(header)]
+    wall = max(s.start + s.seconds for s in rows) - min(s.start for s in rows)
+    values = [[s.seconds] + [s.counts[c] for c in COUNTERS] for s in rows]
+    values.append([wall] + [sum(s.counts[c] for s in rows) for c in COUNTERS])
+    for label, row in zip(labels, values):
+        cells = [f"{row[0]:>{len(header[0])}.1f}"]
+        cells += [f"{v:>{len(c)}}" for c, v in zip(COUNTERS, row[1:])]
+        out.append(f"{label:<{width}}  " + "  ".join(cells))
+    return "\n".join(out)
@@ -0,0 +1,432 @@
+import re
+import shlex
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from toearthly.core import dockerfile as docker
+
+DEFAULT_IMAGE = "alpine:latest"
+# Steps that only install dependencies go into build.Dockerfile
+INSTALL = re.compile(
+    r"^\s*(python -m pip|pip3?|poetry|pipenv|npm|yarn|pnpm|go mod|bundle|composer"
+    r"|apt-get|apk|cargo fetch)\b.*\b(install|ci|download|add|fetch|update)\b"
+    r"|^\s*if \[ -f requirements[\w.-]*\.txt \]; then pip3? install\b"
+)
+EXPRESSION = re.compile(r"\$\{\{")
+# Shells a step's run block can be pasted into build.sh from
+SHELLS = {None, "bash", "sh"}
+
+
+class Step(NamedTuple):
+    name: Optional[str]
+    uses: Optional[str]
+    run: Optional[str]
+    inputs: Dict[str, Any]
+    env: Dict[str, Any]
+    working_directory: Optional[str]
+    shell: Optional[str]
+    condition: Optional[str]
+    raw: Dict[str, Any]
+
+    @property
+    def action(self) -> Optional[str]:
+        return self.uses.split("@")[0] if self.uses else None
+
+    @property
+    def title(self) -> str:
+        return self.name or self.uses or (self.run or "").split("\n")[0]
+
+
+class Job(NamedTuple):
+    id: str
+    runs_on: Any
+    needs: Tuple[str, ...]
+    env: Dict[str, Any]
+    container: Optional[str]
+    steps: Tuple[Step, ...]
+    raw: Dict[str, Any]
+
+
+class Workflow(NamedTuple):
+    name: Optional[str]
+    env: Dict[str, Any]
+    jobs: Tuple[Job, ...]
+    raw: Dict[str, Any]
+
+    # A `defaults: run:` setting, like working-directory, for the job's steps:
+    # the job's, else the workflow's
+    def run_default(self, job: Job, name: str) -> Any:
+        for raw in (job.raw, self.raw):
+            value = ((raw.get("defaults") or {}).get("run") or {}).get(name)
+            if value is not None:
+                return value
+        return None
+
+    def job(self, id: str) -> Optional[Job]:
+        for job in self.jobs:
+            if job.id == id:
+                return job
+        return None
+
+    # Jobs ordered so that each comes after the jobs it needs
+    def ordered(self) -> List[Job]:
+        done: List[str] = []
+        pending = list(self.jobs)
+        while pending:
+            ready = [j for j in pending if all(n in done for n in j.needs)]
+            if not ready:
+                raise ValueError("Workflow jobs have circular or unknown needs.")
+            for job in ready:
+                done.append(job.id)
+                pending.remove(job)
+        return [self.job(id) for id in done]
+
+
+def _needs(value: Any) -> Tuple[str, ...]:
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+def _container(value: Any) -> Optional[str]:
+    if isinstance(value, dict):
+        return value.get("image")
+    return value
+
+
+def _step(raw: Dict[str, Any]) -> Step:
+    return Step(
+        raw.get("name"),
+        raw.get("uses"),
+        raw.get("run"),
+        dict(raw.get("with") or {}),
+        dict(raw.get("env") or {}),
+        raw.get("working-directory"),
+        raw.get("shell"),
+        raw.get("if"),
+        raw,
+    )
+
+
+def parse(content: str) -> Workflow:
+    import yaml
+
+    try:
+        raw = yaml.safe_load(content)
+    except yaml.YAMLError as e:
+        raise ValueError(f"Workflow is not valid YAML: {e}") from None
+    if not isinstance(raw, dict) or not isinstance(raw.get("jobs"), dict):
+        raise ValueError("Workflow has no jobs.")
+    jobs = []
+    for id, job in raw["jobs"].items():
+        job = job or {}
+        jobs.append(
+            Job(
+                str(id),
+                job.get("runs-on"),
+                _needs(job.get("needs")),
+                dict(job.get("env") or {}),
+                _container(job.get("container")),
+                tuple(_step(step) for step in job.get("steps") or []),
+                job,
+            )
+        )
+    return Workflow(raw.get("name"), dict(raw.get("env") or {}), tuple(jobs), raw)
+
+
+# What a known action contributes to the build
+class Action(NamedTuple):
+    image: Optional[str] = None
+    # Input holding the version to put into `image`, and its default
+    version_input: Optional[str] = None
+    default_version: str = "latest"
+    install: Tuple[str, ...] = ()
+    # Commands for run.sh, for actions that act on the app image
+    host: Optional[Callable[[Step], List[str]]] = None
+
+
+def _build_push(step: Step) -> List[str]:
+    inputs = step.inputs
+    tags = str(inputs.get("tags") or "").replace(",", "\n").split()
+    command = ["docker", "build"]
+    if inputs.get("file"):
+        command += ["--file", str(inputs["file"])]
+    if inputs.get("target"):
+        command += ["--target", str(inputs["target"])]
+    for tag in tags:
+        command += ["--tag", tag]
+    command.append(str(inputs.get("context") or "."))
+    commands = [" ".join(command)]
+    if str(inputs.get("push")).lower() == "true":
+        commands += [f"docker push {tag}" for tag in tags]
+    return commands
+
+
+# Known actions, by name without the version. Add entries here to teach the
+# converter more actions; anything else is sent to the LLM.
+ACTIONS: Dict[str, Action] = {
+    "actions/checkout": Action(),
+    "actions/cache": Action(),
+    "actions/upload-artifact": Action(),
+    "actions/download-artifact": Action(),
+    "actions/setup-python": Action("python:{version}", "python-version", "3"),
+    "actions/setup-node": Action("node:{version}", "node-version", "lts"),
+    "actions/setup-go": Action("golang:{version}", "go-version", "1"),
+    "actions/setup-java": Action("eclipse-temurin:{version}", "java-version", "17"),
+    "ruby/setup-ruby": Action("ruby:{version}", "ruby-version", "3"),
+    "docker/setup-buildx-action": Action(),
+    "docker/setup-qemu-action": Action(),
+    "docker/login-action": Action(),
+    "docker/build-push-action": Action(host=_build_push),
+}
+
+
+def _version(value: Any, default: str) -> str:
+    text = str(value) if value is not None else ""
+    if EXPRESSION.search(text):
+        return default
+    # >=1.20.0 -> 1.20.0, 3.x -> 3
+    version = re.sub(r"(\.[xX*])+$", "", re.sub(r"^[^0-9]*", "", text))
+    return version if re.match(r"^[0-9][\w.-]*$", version) else default
+
+
+def _image(action: Action, step: Step) -> Optional[str]:
+    if action.image is None:
+        return None
+    value = step.inputs.get(action.version_input) if action.version_input else None
+    return action.image.format(version=_version(value, action.default_version))
+
+
+def _string(value: Any) -> str:
+    # YAML reads true as a bool, the runner passes it on as "true"
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+
+def _exports(env: Dict[str, Any]) -> List[str]:
+    return [f"export {name}={shlex.quote(_string(v))}" for name, v in env.items()]
+
+
+def _uses_variable(run: str, name: str) -> bool:
+    return re.search(rf"\$\{{?{re.escape(name)}\b", run) is not None
+
+
+def _is_docker(run: str) -> bool:
+    lines = [line.strip() for line in run.split("\n")]
+    lines = [line for line in lines if line and not line.startswith("#")]
+    return bool(lines) and all(line.startswith("docker ") for line in lines)
+
+
+def _is_install(run: str) -> bool:
+    lines = [line.strip() for line in run.split("\n")]
+    lines = [line for line in lines if line and not line.startswith("#")]
+    return bool(lines) and all(INSTALL.match(line) for line in lines)
+
+
+class Conversion(NamedTuple):
+    run: str
+    dockerfile: str
+    build: str
+    # Steps the rules couldn't convert, by job, one entry per run of steps
+    # with nothing converted between them
+    unknown: List[Dict[str, List[Step]]]
+
+
+UNKNOWN_MARKER = "# {{unknown steps {}}}"
+# More runs than this and the whole workflow is better sent to the LLM
+MAX_UNKNOWN_RUNS = 3
+
+
+# Converts a workflow into run.sh, build.Dockerfile and build.sh by rule.
+# Steps that can't be converted are listed in `unknown`, and
+# UNKNOWN_MARKER.format(index) marks where the build.sh commands of each run
+# of them belong.
+def convert(workflow: Workflow) -> Conversion:
+    image: Optional[str] = None
+    installs: List[str] = []
+    build: List[str] = []
+    host: List[str] = []
+    unknown: List[Dict[str, List[Step]]] = []
+
+    def skip(job: Job, step: Step) -> None:
+        if not build or build[-1] != UNKNOWN_MARKER.format(len(unknown) - 1):
+            build.append(UNKNOWN_MARKER.format(len(unknown)))
+            unknown.append({})
+        unknown[-1].setdefault(job.id, []).append(step)
+
+    for job in workflow.ordered():
+        runs_on = str(job.runs_on)
+        unsupported_job = (
+            "windows" in runs_on
+            or "macos" in runs_on
+            or bool(job.raw.get("services"))
+            or job.raw.get("if") is not None
+        )
+        if job.container:
+            if image not in (None, job.container):
+                unsupported_job = True
+            image = job.container
+        for step in job.steps:
+            if unsupported_job or step.condition is not None:
+                skip(job, step)
+                continue
+            if step.uses is not None:
+                action = ACTIONS.get(step.action)
+                if action is None:
+                    skip(job, step)
+                    continue
+                step_image = _image(action, step)
+                if step_image is not None:
+                    if image not in (None, step_image):
+                        skip(job, step)
+                        continue
+                    image = step_image
+                installs += list(action.install)
+                if action.host is not None:
+                    if EXPRESSION.search(str(step.inputs)):
+                        skip(job, step)
+                        continue
+                    host += action.host(step)
+                continue
+            run = step.run or ""
+            shell = step.shell or workflow.run_default(job, "shell")
+            directory = step.working_directory or workflow.run_default(
+                job, "working-directory"
+            )
+            if (
+                shell not in SHELLS
+                or EXPRESSION.search(run + str(directory or ""))
+                or not run.strip()
+            ):
+                skip(job, step)
+                continue
+            # Values from ${{ }} expressions aren't available here, a step
+            # that uses one is left to the LLM
+            hidden = [n for n, v in step.env.items() if EXPRESSION.search(str(v))]
+            if any(_uses_variable(run, name) for name in hidden):
+                skip(job, step)
+                continue
+            scoped = _exports({n: v for n, v in step.env.items() if n not in hidden})
+            if directory:
+                scoped.append(f"cd {shlex.quote(str(directory))}")
+            if _is_docker(run):
+                lines = run.strip().split("\n")
+                if scoped:
+                    lines = ["("] + scoped + lines + [")"]
+                host += lines
+                continue
+            if not build and not scoped and _is_install(run):
+                installs += [line.strip() for line in run.strip().split("\n")]
+                continue
+            build.append(f"# {step.title}")
+            if scoped:
+                build += ["("] + scoped + [run.rstrip()] + [")"]
+            else:
+                build.append(run.rstrip())
+
+    # Values from ${{ }} expressions, usually secrets, aren't available here
+    env = {**workflow.env}
+    for job in workflow.jobs:
+        env.update(job.env)
+    env = {k: v for k, v in env.items() if not EXPRESSION.search(str(v))}
+
+    dockerfile = [f"FROM {image or DEFAULT_IMAGE}", "", "WORKDIR /app", "", "COPY . ."]
+    dockerfile += [f"RUN {command}" for command in installs]
+    build_sh = ["#!/bin/bash", "set -e", ""] + _exports(env)
+    build_sh += build or ['echo "No build steps"']
+    run_sh = [
+        "#!/bin/bash",
+        "set -e",
+        "",
+        "# Build the build image and run the build inside it",
+        "docker build -t build -f build.Dockerfile .",
+        "docker run --rm build ./build.sh",
+    ]
+    if host:
+        run_sh += ["", "# Application image steps"] + host
+    return Conversion(
+        "\n".join(run_sh) + "\n",
+        "\n".join(dockerfile) + "\n",
+        "\n".join(build_sh) + "\n",
+        unknown,
+    )
+
+
+# The workflow cut down to the given steps, for sending to the LLM
+def subset(workflow: Workflow, steps: Dict[str, List[Step]]) -> str:
+    import yaml
+
+    raw = {
+        key: value
+        for key, value in workflow.raw.items()
+        if key in ("name", "env", "defaults")
+    }
+    raw["jobs"] = {}
+    for job in workflow.jobs:
+        if job.id in steps:
+            kept = {k: v for k, v in job.raw.items() if k not in ("steps", "needs")}
+            kept["steps"] = [step.raw for step in steps[job.id]]
+            raw["jobs"][job.id] = kept
+    return yaml.safe_dump(raw, sort_keys=False)
+
+
+# Each job as a workflow of its own, for converting jobs one at a time: (job
+# id, workflow, ids of the jobs it needs), with needed jobs first. The jobs
+# keep the workflow's name, env and defaults, and leave out their needs.
+def split(workflow: Workflow) -> List[Tuple[str, str, Tuple[str, ...]]]:
+    return [
+        (job.id, subset(workflow, {job.id: list(job.steps)}), job.needs)
+        for job in workflow.ordered()
+    ]
+
+
+def _lines(script: str) -> List[str]:
+    return [
+        line
+        for line in script.strip().split("\n")
+        if not line.startswith("#!") and line.strip() != "set -e"
+    ]
+
+
+# Adds what the LLM made of the unknown steps to a conversion: one (run.sh,
+# build.Dockerfile, build.sh) answer per entry of `conversion.unknown`, each
+# put where its marker is
+def splice(
+    conversion: Conversion, answers: List[Tuple[str, str, str]]
+) -> Conversion:
+    if len(answers) != len(conversion.unknown):
+        raise ValueError(
+            f"Expected {len(conversion.unknown)} answers, got {len(answers)}."
+        )
+    build_sh = conversion.build
+    own = conversion.dockerfile.split("\n")
+    extra: List[str] = []
+    host: List[str] = []
+    for index, (run, dockerfile, build) in enumerate(answers):
+        build_sh = build_sh.replace(
+            UNKNOWN_MARKER.format(index), "\n".join(_lines(build)).strip()
+        )
+
+        instructions = docker.instructions(dockerfile)
+        images = [i.args for i in instructions if i.name == "FROM"]
+        if own[0] == f"FROM {DEFAULT_IMAGE}" and images:
+            own[0] = f"FROM {images[0]}"
+        for i in instructions:
+            line = f"{i.name} {i.args}"
+            if i.name in ("RUN", "ENV", "ARG") and "build.sh" not in i.args:
+                if line not in extra:
+                    extra.append(line)
+
+        host += [
+            line
+            for line in _lines(run)
+            if "build.Dockerfile" not in line and "build.sh" not in line
+        ]
+    dockerfile = "\n".join(own).rstrip("\n") + "\n" + "".join(f"{e}\n" for e in extra)
+
+    run_sh = conversion.run
+    if any(line.strip() and not line.startswith("#") for line in host):
+        run_sh += "\n" + "\n".join(host).strip() + "\n"
+    return Conversion(run_sh, dockerfile, build_sh, [])
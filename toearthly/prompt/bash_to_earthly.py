@@ -1,24 +1,30 @@
 
 from textwrap import dedent
+from typing import Dict, List
 
-import guidance
+from toearthly.core import (
+    budget,
+    compress,
+    io,
+    llm,
+    markdown,
+    program,
+    router,
+    stream,
+)
+from toearthly.core import earthfile as parser
 
-from toearthly.core import io, markdown
 
-gpt4 = guidance.llms.OpenAI("gpt-4")
+def examples() -> List[Dict[str, str]]:
+    return [{
+            "files":  io.relative_read("data/python_lint/files.md"),
+            "plan":   io.relative_read("data/python_lint/bash_to_earthly/plan.md"),
+            "result": io.relative_read("data/python_lint/Earthfile"),
+        }]
 
-earthly_basics = io.relative_read("data/earthly_docs/basics.md")
-earthly_reference = io.relative_read("data/earthly_docs/summary.md")
-earthly_tips = io.relative_read("data/earthly_docs/tips.md")
-
-input1 = io.relative_read("data/python_lint/files.md")
-cot1 = io.relative_read("data/python_lint/bash_to_earthly/plan.md")
-result1 = io.relative_read("data/python_lint/Earthfile")
-
-def prompt(files: str, run: str, docker: str, build: str) -> str:
-    program = guidance(
-        dedent(
-            """
+template = program.Template(
+    dedent(
+        """
     {{#system~}}
     You are creating an Earthfile from several bash and dockerfiles. I'll share Earthly
     documentation with you and then describe the conversion process.
@@ -38,18 +44,23 @@ def prompt(files: str, run: str, docker: str, build: str) -> str:
     * `build.sh` A bash file that runs the build steps. These steps should become
     targets in the Earthfile.
     {{~/system}}
+    {{~#each examples}}
     {{#user~}}
-    {input1}
+    {{this.files}}
     {{~/user}}
     {{#assistant~}}
-    {{cot1}}
+    {{this.plan}}
     {{~/assistant}}
     {{#user~}}
     Ok, produce the files. Files that are needed need to be copied in.
     {{~/user}}
     {{#assistant~}}
-    {{result1}}
+    {{this.result}}
     {{~/assistant}}
+    {{~/each}}"""
+    ),
+    dedent(
+        """
     {{#user~}}
     `Files:`
     ```
@@ -81,34 +92,94 @@ def prompt(files: str, run: str, docker: str, build: str) -> str:
     be ported to Earthly.
     {{~/user}}
     {{#assistant~}}
-    {{gen "discuss" temperature=0 max_tokens=2000}}
+    {{gen "discuss" temperature=0 max_tokens=max_discuss}}
     {{~/assistant}}
     {{#user~}}
     Ok, produce the files. Files that are needed need to be copied in.
     {{~/user}}
     {{#assistant~}}
-    {{gen "Earthfile" temperature=0 max_tokens=2000}}
+    {{gen "Earthfile" temperature=0 max_tokens=max_earthfile}}
     {{~/assistant}}
     """
-        ),
-        llm=gpt4,
+    ),
+    lambda: {
+        "earthly_basics": compress.digest("bash_to_earthly"),
+        "examples": examples(),
+    },
+    trim=["examples", "earthly_basics"],
+    name="bash_to_earthly",
+    fast=dedent(
+        """
+    {{#user~}}
+    `Files:`
+    ```
+    {{files}}
+    ```
+
+    `run.sh`:
+    ```
+    {{run}}
+    ```
+
+    build.Dockerfile
+    ```
+    {{docker}}
+    ```
+
+    `build.sh`:
+    ```
+    {{build}}
+    ```
+
+    An Earthfile is a better way to represent this build process because it combines the
+    concepts of running bash commands to build something with the ideas of
+    containerisation made popular by Docker and dockerfile.
+
+    Task:
+    Produce the Earthfile. Before it, note how you would port the steps in a few
+    short lines at most. Files that are needed need to be copied in.
+    {{~/user}}
+    {{#assistant~}}
+    {{gen "Earthfile" temperature=0 max_tokens=max_earthfile}}
+    {{~/assistant}}
+    """
+    ),
+)
+
+def ask(model: str, files: str, run: str, docker: str, build: str) -> str:
+    plan = budget.fit(
+        template,
+        model,
+        template.outputs({"max_discuss": 2000, "max_earthfile": 2000}),
+        files=files,
+        run=run,
+        docker=docker,
+        build=build,
     )
-    out = io.run_llm_program(
-        program,
-        earthly_basics=earthly_basics,
-        input1=input1,
-        cot1=cot1,
-        result1=result1,
+    if template.levels()[plan.level]["earthly_basics"]:
+        compress.report(template.name, compress.digest_saving(template.name))
+    out = template(
+        llm.get(plan.model),
+        plan.level,
         files=files,
         run=run,
         docker=docker,
         build=build,
+        progress=stream.progress("bash_to_earthly", ["discuss", "Earthfile"]),
+        **plan.max_tokens,
     )
-    io.write_debug("plan.md", out["discuss"], "bash_to_earthly")
+    if not template.is_fast():
+        io.write_debug("plan.md", out["discuss"], "bash_to_earthly")
     io.write_debug("result.md", out["Earthfile"], "bash_to_earthly")
-    results = markdown.extract_code_blocks(out["Earthfile"])
-    if len(results) != 1:
-        raise ValueError(f"1 Files exepected back. Instead got {len(results)}.")
+    results = markdown.expect_code_blocks(out["Earthfile"], 1)
     earthfile = results[0]
     io.write_debug("Earthfile", earthfile, "bash_to_earthly")
     return earthfile
+
+def prompt(files: str, run: str, docker: str, build: str) -> str:
+    return router.run(
+        template.name,
+        [files, run, docker, build],
+        lambda model: ask(model, files, run, docker, build),
+        check=parser.parse,
+    )
@@ -1,47 +1,60 @@
 
+import functools
+import os
 from textwrap import dedent
+from typing import Dict, List
+
+from toearthly.core import (
+    budget,
+    compress,
+    dockerfile,
+    examples,
+    io,
+    llm,
+    markdown,
+    program,
+    router,
+    stream,
+)
+from toearthly.core import earthfile as parser
+
+# Few-shot examples sent with each request, picked by similarity
+EXAMPLE_COUNT = 2
+# Put above a Dockerfile built in a subdirectory, as the Earthfile is at the root
+CONTEXT_NOTE = (
+    "# This Dockerfile is built in {context}/. The Earthfile is at the repository\n"
+    "# root, so prefix the paths COPY takes from the build context with {context}/.\n"
+)
+
+
+# Any data/<name>/ with a Dockerfile, a workflow.yml and a
+# dockerfile_to_earthfile/ plan.md and result.md is an example.
+def load_examples() -> List[Dict[str, str]]:
+    found = []
+    for result in io.relative_glob("data/*/dockerfile_to_earthfile/result.md"):
+        stage_dir = os.path.dirname(result)
+        example_dir = os.path.dirname(stage_dir)
+        found.append({
+            "docker":   io.relative_read(os.path.join(example_dir, "Dockerfile")),
+            "workflow": compress.workflow(
+                io.relative_read(os.path.join(example_dir, "workflow.yml"))
+            ),
+            "plan":     io.relative_read(os.path.join(stage_dir, "plan.md")),
+            "result":   io.relative_read(result),
+        })
+    return found
+
+
+@functools.lru_cache(maxsize=None)
+def example_index() -> examples.ExampleIndex:
+    return examples.ExampleIndex(
+        load_examples(), lambda example: example["docker"] + example["workflow"]
+    )
 
-import guidance
-
-from toearthly.core import io, markdown
-
-gpt4 = guidance.llms.OpenAI("gpt-4")
-
-earthly_basics = io.relative_read("data/earthly_docs/basics.md")
-earthly_reference = io.relative_read("data/earthly_docs/summary.md")
-earthly_tips = io.relative_read("data/earthly_docs/tips.md")
-
-examples = [{
-        "docker":   io.relative_read("data/docker_simple2/Dockerfile"),
-        "workflow": io.relative_read("data/docker_simple2/workflow.yml"),
-        "plan":     io.relative_read("data/docker_simple2/dockerfile_to_earthfile/plan.md"),  # noqa: E501
-        "result":   io.relative_read("data/docker_simple2/dockerfile_to_earthfile/result.md")  # noqa: E501
-    },
-    {
-        "docker":   io.relative_read("data/docker_multistage1/Dockerfile"),
-        "workflow": io.relative_read("data/docker_multistage1/workflow.yml"),
-        "plan":     io.relative_read("data/docker_multistage1/dockerfile_to_earthfile/plan.md"),  # noqa: E501
-        "result":   io.relative_read("data/docker_multistage1/dockerfile_to_earthfile/result.md")  # noqa: E501
-    },
-    {
-        "docker":   io.relative_read("data/docker_multistage2/Dockerfile"),
-        "workflow": io.relative_read("data/docker_multistage2/workflow.yml"),
-        "plan":     io.relative_read("data/docker_multistage2/dockerfile_to_earthfile/plan.md"),  # noqa: E501
-        "result":   io.relative_read("data/docker_multistage2/dockerfile_to_earthfile/result.md")  # noqa: E501
-    },
-    ]
-
-
-# Throws openai.error.InvalidRequestError
-# This model's maximum context length is 8192 tokens. However, you requested 8480
-# tokens (7480 in the messages, 1000 in the completion). Please reduce the length
-# of the messages or completion.
-# ToDo: recover from this by downgrading to GPT3.5
-def prompt(docker: str, build: str) -> str:
 
-    program = guidance(
-        dedent(
-            """
+template = program.Template(
+    dedent(
+        """
     {{#system~}}
     You are creating an Earthfile from a Dockerfile and a GitHub Actions workflow. I'll
     share Earthly documentation with you and then describe the conversion process.
@@ -92,7 +105,10 @@ def prompt(docker: str, build: str) -> str:
     {{#assistant~}}
     {{this.result}}
     {{~/assistant}}
-    {{~/each}}
+    {{~/each}}"""
+    ),
+    dedent(
+        """
     {{#user~}}
     Github Actions Workflow:
     ```
@@ -119,32 +135,101 @@ def prompt(docker: str, build: str) -> str:
     Let me go step by step through the dockerfile and convert it to a Earthfile.
     {{~/user}}
     {{#assistant~}}
-    {{gen "discuss" temperature=0 max_tokens=1000}}
+    {{gen "discuss" temperature=0 max_tokens=max_discuss}}
     {{~/assistant}}
     {{#user~}}
     Ok, produce the Earthfile in backticks.
     {{~/user}}
     {{#assistant~}}
-    {{gen "Earthfile" temperature=0 max_tokens=500}}
+    {{gen "Earthfile" temperature=0 max_tokens=max_earthfile}}
+    {{~/assistant}}
+    """
+    ),
+    lambda: {
+        "earthly_basics": compress.digest("dockerfile_to_earthfile"),
+        "earthly_tips": io.relative_read("data/earthly_docs/tips.md"),
+        "examples": load_examples(),
+    },
+    trim=["examples", "earthly_tips", "earthly_basics"],
+    name="dockerfile_to_earthfile",
+    fast=dedent(
+        """
+    {{#user~}}
+    Github Actions Workflow:
+    ```
+    {{build}}
+    ```
+
+    Dockerfile:
+    ```Dockerfile
+    {{docker}}
+    ```
+
+    Task:
+    Produce the Earthfile in backticks. Before it, note how you would port the
+    dockerfile in a few short lines at most.
+
+    Remember:
+    - an Earthfile can't have a target named base.
+    - an Earthfile `COPY` from another target works like a Dockerfile multistage COPY
+       but it has a different syntax.
+    - To copy `example` from target `+build` use `COPY +build/example .`
+    - Also, `example` will need to be saved using `SAVE ARTIFACT` in `+build`
+    {{~/user}}
+    {{#assistant~}}
+    {{gen "Earthfile" temperature=0 max_tokens=max_earthfile}}
     {{~/assistant}}
     """
-        ),
-        llm=gpt4,
+    ),
+)
+
+# `context` is the directory of the repository the Dockerfile is built in, for
+# one that isn't at the root
+def prompt(docker: str, build: str, context: str = "") -> str:
+    # Most Dockerfiles translate by rule, only the rest need the LLM
+    try:
+        earthfile = dockerfile.translate(docker, build, context)
+        io.write_debug("Earthfile", earthfile, "dockerfile_to_earthfile")
+        return earthfile
+    except dockerfile.UnsupportedInstruction as e:
+        io.log(f"Rule based translation failed, translating with the LLM: {e}")
+    if context:
+        docker = CONTEXT_NOTE.format(context=context) + docker
+    compact = compress.workflow(build)
+    compress.report(template.name, compress.saving(build, compact))
+    build = compact
+    return router.run(
+        template.name,
+        [docker, build],
+        lambda model: ask(model, docker, build),
+        check=parser.parse,
+    )
+
+def ask(model: str, docker: str, build: str) -> str:
+    static = {"examples": example_index().nearest(docker + build, EXAMPLE_COUNT)}
+    plan = budget.fit(
+        template,
+        model,
+        template.outputs({"max_discuss": 1000, "max_earthfile": 500}),
+        static,
+        docker=docker,
+        build=build,
     )
-    out = io.run_llm_program(
-        program,
-        earthly_basics=earthly_basics,
-        earthly_reference=earthly_reference,
-        earthly_tips=earthly_tips,
-        examples=examples,
+    if template.levels(static)[plan.level]["earthly_basics"]:
+        compress.report(template.name, compress.digest_saving(template.name))
+    out = template(
+        llm.get(plan.model),
+        plan.level,
+        static,
         docker=docker,
         build=build,
+        progress=stream.progress("dockerfile_to_earthfile", ["discuss", "Earthfile"]),
+        **plan.max_tokens,
     )
-    io.write_debug("plan.md", out["discuss"], "dockerfile_to_earthfile")
+    if not template.is_fast():
+        io.write_debug("plan.md", out["discuss"], "dockerfile_to_earthfile")
     io.write_debug("result.md", out["Earthfile"], "dockerfile_to_earthfile")
-    results = markdown.extract_code_blocks(out["Earthfile"])
-    if len(results) != 1:
-        raise ValueError(f"1 Files exepected back. Instead got {len(results)}.")
+    results = markdown.expect_code_blocks(out["Earthfile"], 1)
     earthfile = results[0]
     io.write_debug("Earthfile", earthfile, "dockerfile_to_earthfile")
     return earthfile
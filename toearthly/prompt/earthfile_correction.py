@@ -1,19 +1,20 @@
 from textwrap import dedent
 
-import guidance
+from toearthly.core import (
+    budget,
+    compress,
+    io,
+    llm,
+    markdown,
+    program,
+    router,
+    stream,
+)
+from toearthly.core import earthfile as parser
 
-from toearthly.core import io, markdown
-
-gpt4 = guidance.llms.OpenAI("gpt-4")
-
-earthly_basics = io.relative_read("data/earthly_docs/basics.md")
-earthly_reference = io.relative_read("data/earthly_docs/summary.md")
-earthly_tips = io.relative_read("data/earthly_docs/tips.md")
-
-def prompt(earthfile: str, gha: str, files: str) -> str:
-    program = guidance(
-        dedent(
-            """
+template = program.Template(
+    dedent(
+        """
         {{#system~}}
         Use the below documentation on Earthfiles to do a code conversion task.
         <<Article>>
@@ -39,7 +40,10 @@ def prompt(earthfile: str, gha: str, files: str) -> str:
         problem. Then go through the Earthfile section by section and discuss any
         changes that need to be made.
 
-        {{~/system}}
+        {{~/system}}"""
+    ),
+    dedent(
+        """
         {{#user~}}
         Files:
         ```
@@ -57,32 +61,96 @@ def prompt(earthfile: str, gha: str, files: str) -> str:
         ```
         {{~/user}}
         {{#assistant~}}
-        {{gen "discuss" temperature=0 max_tokens=2000}}
+        {{gen "discuss" temperature=0 max_tokens=max_discuss}}
         {{~/assistant}}
         {{#user~}}
         Ok, produce the Earthfile in backticks.
         {{~/user}}
         {{#assistant~}}
-        {{gen "Earthfile" temperature=0 max_tokens=2000}}
+        {{gen "Earthfile" temperature=0 max_tokens=max_earthfile}}
         {{~/assistant}}
 
     """
-        ),
-        llm=gpt4,
+    ),
+    lambda: {
+        "earthly_basics": compress.digest("earthfile_correction"),
+        "earthly_tips": io.relative_read("data/earthly_docs/tips.md"),
+    },
+    trim=["earthly_tips", "earthly_basics"],
+    name="earthfile_correction",
+    fast=dedent(
+        """
+        {{#user~}}
+        Files:
+        ```
+        {{files}}
+        ```
+
+        Git Hub Actions:
+        ```
+        {{gha}}
+        ```
+
+        Earthfile:
+        ```
+        {{earthfile}}
+        ```
+
+        Skip the separate discussion this time. Produce the corrected Earthfile in
+        backticks, and before it list the changes it needs in a few short lines at most.
+        {{~/user}}
+        {{#assistant~}}
+        {{gen "Earthfile" temperature=0 max_tokens=max_earthfile}}
+        {{~/assistant}}
+
+    """
+    ),
+)
+
+def ask(model: str, earthfile: str, gha: str, files: str) -> str:
+    plan = budget.fit(
+        template,
+        model,
+        template.outputs({"max_discuss": 2000, "max_earthfile": 2000}),
+        files=files,
+        gha=gha,
+        earthfile=earthfile,
     )
-    out = io.run_llm_program(
-        program,
-        earthly_basics=earthly_basics,
-        earthly_tips=earthly_tips,
+    if template.levels()[plan.level]["earthly_basics"]:
+        compress.report(template.name, compress.digest_saving(template.name))
+    out = template(
+        llm.get(plan.model),
+        plan.level,
         files=files,
         gha=gha,
         earthfile=earthfile,
+        progress=stream.progress("earthfile_correction", ["discuss", "Earthfile"]),
+        **plan.max_tokens,
     )
-    io.write_debug("plan.md", out["discuss"], "earthfile_correction")
+    if not template.is_fast():
+        io.write_debug("plan.md", out["discuss"], "earthfile_correction")
     io.write_debug("result.md", out["earthfile"], "earthfile_correction")
-    results = markdown.extract_code_blocks(out["Earthfile"])
-    if len(results) != 1:
-        raise ValueError(f"1 Files exepected back. Instead got {len(results)}.")
+    results = markdown.expect_code_blocks(out["Earthfile"], 1)
     earthfile = results[0]
     io.write_debug("Earthfile", earthfile, "earthfile_correction")
     return earthfile
+
+def parses(earthfile: str) -> bool:
+    try:
+        parser.parse(earthfile)
+    except parser.EarthfileSyntaxError:
+        return False
+    return True
+
+# An Earthfile that already parses only needs its practices corrected
+def prompt(earthfile: str, gha: str, files: str) -> str:
+    compact = compress.workflow(gha)
+    compress.report(template.name, compress.saving(gha, compact))
+    gha = compact
+    return router.run(
+        template.name,
+        [earthfile, gha, files],
+        lambda model: ask(model, earthfile, gha, files),
+        check=parser.parse,
+        parses=parses(earthfile),
+    )
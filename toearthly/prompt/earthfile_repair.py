@@ -0,0 +1,75 @@
+from textwrap import dedent
+
+from toearthly.core import budget, io, llm, markdown, program, router, stream
+
+template = program.Template(
+    dedent(
+        """
+        {{#system~}}
+        You fix syntax errors in Earthfiles. Here is a summary of Earthfile commands:
+        {{earthly_summary}}
+
+        You will be given one part of an Earthfile, the error reported for it and an
+        outline of the rest of the file. Fix only that part, changing as little as
+        possible, and give back the whole corrected part in backticks. Keep the target
+        name line if there is one. Don't add targets.
+        {{~/system}}"""
+    ),
+    dedent(
+        """
+        {{#user~}}
+        Rest of the Earthfile:
+        ```
+        {{outline}}
+        ```
+
+        Error:
+        {{error}}
+
+        Part to fix:
+        ```Earthfile
+        {{snippet}}
+        ```
+        {{~/user}}
+        {{#assistant~}}
+        {{gen "Earthfile" temperature=0 max_tokens=max_earthfile}}
+        {{~/assistant}}
+    """
+    ),
+    lambda: {
+        "earthly_summary": io.relative_read("data/earthly_docs/summary.md"),
+    },
+    trim=["earthly_summary"],
+    name="earthfile_repair",
+)
+
+def ask(model: str, snippet: str, error: str, outline: str) -> str:
+    plan = budget.fit(
+        template,
+        model,
+        {"max_earthfile": 1000},
+        snippet=snippet,
+        error=error,
+        outline=outline,
+    )
+    out = template(
+        llm.get(plan.model),
+        plan.level,
+        snippet=snippet,
+        error=error,
+        outline=outline,
+        progress=stream.progress("earthfile_repair", ["Earthfile"]),
+        **plan.max_tokens,
+    )
+    io.write_debug("result.md", out["Earthfile"], "earthfile_repair")
+    # The part can be a single line, so keep short blocks
+    results = markdown.expect_code_blocks(out["Earthfile"], 1, min_lines=1)
+    return results[0]
+
+# The part alone needn't parse, repair.repair checks the whole file
+def prompt(snippet: str, error: str, outline: str) -> str:
+    return router.run(
+        template.name,
+        [snippet, error, outline],
+        lambda model: ask(model, snippet, error, outline),
+    )
@@ -1,24 +1,39 @@
+import contextlib
 from textwrap import dedent
-from typing import Tuple
-
-import guidance
-
-from toearthly.core import io, markdown
-
-gpt4 = guidance.llms.OpenAI("gpt-4")
-
-input1 = io.relative_read("data/python_lint/workflow.yml")
-cot1 = io.relative_read("data/python_lint/gha_to_bash/plan.md")
-result1 = io.relative_read("data/python_lint/gha_to_bash/result.md")
-
-input2 = io.relative_read("data/docker_simple/workflow.yml")
-cot2 = io.relative_read("data/docker_simple/gha_to_bash/plan.md")
-result2 = io.relative_read("data/docker_simple/gha_to_bash/result.md")
-
-def prompt(gha: str, files: str) -> Tuple[str, str, str]:
-    program = guidance(
-        dedent(
-            """
+from typing import Dict, List, Tuple
+
+from toearthly.core import (
+    budget,
+    compress,
+    io,
+    llm,
+    markdown,
+    program,
+    router,
+    stream,
+    workflow,
+)
+
+
+def examples() -> List[Dict[str, str]]:
+    return [{
+            "workflow": compress.workflow(
+                io.relative_read("data/python_lint/workflow.yml")
+            ),
+            "plan":     io.relative_read("data/python_lint/gha_to_bash/plan.md"),
+            "result":   io.relative_read("data/python_lint/gha_to_bash/result.md"),
+        },
+        {
+            "workflow": compress.workflow(
+                io.relative_read("data/docker_simple/workflow.yml")
+            ),
+            "plan":     io.relative_read("data/docker_simple/gha_to_bash/plan.md"),
+            "result":   io.relative_read("data/docker_simple/gha_to_bash/result.md"),
+        }]
+
+template = program.Template(
+    dedent(
+        """
     {{#system~}}
     Given a GitHub Actions workflow YAML file, summarize how you would recreate the
     steps of this build using bash and docker.
@@ -69,12 +84,12 @@ def prompt(gha: str, files: str) -> Tuple[str, str, str]:
     be adapted to the new format.
     {{~/system}}
 
-    {{~! Training Example 1 ~}}
+    {{~#each examples}}
     {{#user~}}
-    {input1}
+    {{this.workflow}}
     {{~/user}}
     {{#assistant~}}
-    {{cot1}}
+    {{this.plan}}
     {{~/assistant}}
     {{#user~}}
     Ok, produce `run.sh`,`build.Dockerfile` and `build.sh`.
@@ -83,15 +98,27 @@ def prompt(gha: str, files: str) -> Tuple[str, str, str]:
     And three files should be produced, even if they are just place holders.
     {{~/user}}
     {{#assistant~}}
-    {{result1}}
+    {{this.result}}
     {{~/assistant}}
+    {{~/each}}"""
+    ),
+    dedent(
+        """
 
-    {{~! Training Example 2 ~}}
+    {{~! Generate Answer~}}
     {{#user~}}
-    {input2}
+    Files:
+    ```
+    {{files}}
+    ```
+
+    GitHub Actions workflow:
+    ```
+    {{gha}}
+    ```
     {{~/user}}
     {{#assistant~}}
-    {{cot2}}
+    {{gen "discuss" temperature=0 max_tokens=max_discuss}}
     {{~/assistant}}
     {{#user~}}
     Ok, produce `run.sh`,`build.Dockerfile` and `build.sh`.
@@ -100,8 +127,15 @@ def prompt(gha: str, files: str) -> Tuple[str, str, str]:
     And three files should be produced, even if they are just place holders.
     {{~/user}}
     {{#assistant~}}
-    {{result2}}
+    {{gen "files" temperature=0 max_tokens=max_files}}
     {{~/assistant}}
+    """
+    ),
+    lambda: {"examples": examples()},
+    trim=["examples"],
+    name="gha_to_bash",
+    fast=dedent(
+        """
 
     {{~! Generate Answer~}}
     {{#user~}}
@@ -114,41 +148,80 @@ def prompt(gha: str, files: str) -> Tuple[str, str, str]:
     ```
     {{gha}}
     ```
-    {{~/user}}
-    {{#assistant~}}
-    {{gen "discuss" temperature=0 max_tokens=2000}}
-    {{~/assistant}}
-    {{#user~}}
-    Ok, produce `run.sh`,`build.Dockerfile` and `build.sh`.
+
+    Skip the separate discussion this time. Produce `run.sh`,`build.Dockerfile` and
+    `build.sh`, and before them note which steps go in which file in a few short lines
+    at most.
     Remember `build.Dockerfile` should work without volume mounting: files that are
     needed need to be copied in.
     And three files should be produced, even if they are just place holders.
     {{~/user}}
     {{#assistant~}}
-    {{gen "files" temperature=0 max_tokens=500}}
+    {{gen "files" temperature=0 max_tokens=max_files}}
     {{~/assistant}}
     """
-        ),
-        llm=gpt4,
+    ),
+)
+
+def ask(model: str, gha: str, files: str) -> Tuple[str, str, str]:
+    plan = budget.fit(
+        template,
+        model,
+        template.outputs({"max_discuss": 2000, "max_files": 500}),
+        gha=gha,
+        files=files,
     )
-
-    out = io.run_llm_program(
-        program,
-        gha=dedent(gha),
+    out = template(
+        llm.get(plan.model),
+        plan.level,
+        gha=gha,
         files=files,
-        input1=input1,
-        cot1=cot1,
-        result1=result1,
-        input2=input2,
-        cot2=cot2,
-        result2=result2,
+        progress=stream.progress("gha_to_bash", ["discuss", "files"], blocks=3),
+        **plan.max_tokens,
     )
-    io.write_debug("plan.md", out["discuss"], "gha_to_bash")
+    if not template.is_fast():
+        io.write_debug("plan.md", out["discuss"], "gha_to_bash")
     io.write_debug("result.md", out["files"], "gha_to_bash")
-    results = markdown.extract_code_blocks(out["files"])
-    if len(results) != 3:
-        raise ValueError(f"3 Files exepected back. Instead got {len(results)}")
+    results = markdown.expect_code_blocks(out["files"], 3)
+    return (results[0], results[1], results[2])
+
+def generate(gha: str, files: str) -> Tuple[str, str, str]:
+    compact = compress.workflow(gha)
+    compress.report(template.name, compress.saving(gha, compact))
+    gha = compact
+    return router.run(
+        template.name, [gha, files], lambda model: ask(model, gha, files)
+    )
+
+def prompt(gha: str, files: str) -> Tuple[str, str, str]:
+    gha = dedent(gha)
+    # Known actions and plain run steps convert by rule, only the remaining
+    # steps are sent to the LLM
+    try:
+        parsed = workflow.parse(gha)
+        conversion = workflow.convert(parsed)
+    except ValueError as e:
+        io.log(f"Rule based conversion failed, converting with the LLM: {e}")
+        results = generate(gha, files)
+    else:
+        if len(conversion.unknown) > workflow.MAX_UNKNOWN_RUNS:
+            io.log("Many steps need the LLM, converting the whole workflow with it")
+            results = generate(gha, files)
+        else:
+            # Each run of unknown steps is converted on its own, so its answer
+            # goes where those steps were
+            answers = []
+            for index, steps in enumerate(conversion.unknown):
+                unknown = workflow.subset(parsed, steps)
+                debug = contextlib.nullcontext()
+                if len(conversion.unknown) > 1:
+                    debug = io.use_debug_subdir(f"unknown-{index}")
+                with debug:
+                    io.write_debug("unknown_steps.yml", unknown, "gha_to_bash")
+                    answers.append(generate(unknown, files))
+            conversion = workflow.splice(conversion, answers)
+            results = (conversion.run, conversion.dockerfile, conversion.build)
     io.write_debug("run.sh", results[0], "gha_to_bash")
     io.write_debug("build.Dockerfile", results[1], "gha_to_bash")
     io.write_debug("build.sh", results[2], "gha_to_bash")
-    return (results[0], results[1], results[2])
+    return results
@@ -1,35 +1,50 @@
+import functools
+import os
 from textwrap import dedent
+from typing import Dict, List
 
-import guidance
+from toearthly.core import (
+    budget,
+    compress,
+    examples,
+    io,
+    llm,
+    markdown,
+    merger,
+    program,
+    router,
+    stream,
+)
+from toearthly.core import earthfile as parser
 
-from toearthly.core import io, markdown
+# Few-shot examples sent with each request, picked by similarity
+EXAMPLE_COUNT = 1
 
-gpt4 = guidance.llms.OpenAI("gpt-4")
 
-earthly_basics = io.relative_read("data/earthly_docs/basics.md")
-examples = [{
-        "file1":   io.relative_read("data/merge/in1a.Earthfile"),
-        "name1":    "workflow.yml",
-        "file2":     io.relative_read("data/merge/in1b.Earthfile"),
-        "name2":    "Dockerfile",
-        "result":   io.relative_read("data/merge/out1.md"),
-    },
-    {
-        "file1":   io.relative_read("data/merge/in2a.Earthfile"),
-        "name1":    "workflow.yml",
-        "file2":     io.relative_read("data/merge/in2b.Earthfile"),
-        "name2":    "Dockerfile",
-        "result":   io.relative_read("data/merge/out2.md"),
-    }]
+# data/merge/in<N>a.Earthfile and in<N>b.Earthfile merge into out<N>.md
+def load_examples() -> List[Dict[str, str]]:
+    found = []
+    for first in io.relative_glob("data/merge/in*a.Earthfile"):
+        n = os.path.basename(first)[len("in"):-len("a.Earthfile")]
+        found.append({
+            "file1":   io.relative_read(first),
+            "name1":    "workflow.yml",
+            "file2":     io.relative_read(f"data/merge/in{n}b.Earthfile"),
+            "name2":    "Dockerfile",
+            "result":   io.relative_read(f"data/merge/out{n}.md"),
+        })
+    return found
 
-def prompt(file1: str, name1: str, file2: str, name2: str) -> str:
-    if not file1:
-        return file2
-    if not file2:
-        return file1
-    program = guidance(
-        dedent(
-            """
+
+@functools.lru_cache(maxsize=None)
+def example_index() -> examples.ExampleIndex:
+    return examples.ExampleIndex(
+        load_examples(), lambda example: example["file1"] + example["file2"]
+    )
+
+template = program.Template(
+    dedent(
+        """
         {{#system~}}
         Here is an explanation of Earthfiles:
         {{earthly_basics}}
@@ -64,7 +79,10 @@ def prompt(file1: str, name1: str, file2: str, name2: str) -> str:
         {{#assistant~}}
         {{this.result}}
         {{~/assistant}}
-        {{~/each}}
+        {{~/each}}"""
+    ),
+    dedent(
+        """
         {{#user~}}
         First Earthfile:
         Project: {{name1}}
@@ -86,25 +104,64 @@ def prompt(file1: str, name1: str, file2: str, name2: str) -> str:
         ```
         {{~/user}}
         {{#assistant~}}
-        {{gen "Earthfile" temperature=0 max_tokens=2000}}
+        {{gen "Earthfile" temperature=0 max_tokens=max_earthfile}}
         {{~/assistant}}
     """
-        ),
-        llm=gpt4,
+    ),
+    lambda: {
+        "earthly_basics": compress.digest("merge"),
+        "examples": load_examples(),
+    },
+    trim=["examples", "earthly_basics"],
+    name="merge",
+)
+
+def prompt(file1: str, name1: str, file2: str, name2: str) -> str:
+    if not file1:
+        return file2
+    if not file2:
+        return file1
+    # Most merges are mechanical, only conflicts need the LLM
+    try:
+        earthfile = merger.merge(file1, name1, file2, name2)
+        io.write_debug("Earthfile", earthfile, "merge")
+        return earthfile
+    except merger.MergeConflict as e:
+        io.log(f"Structural merge failed, merging with the LLM: {e}")
+    return router.run(
+        template.name,
+        [file1, file2],
+        lambda model: ask(model, file1, name1, file2, name2),
+        check=parser.parse,
+    )
+
+def ask(model: str, file1: str, name1: str, file2: str, name2: str) -> str:
+    static = {"examples": example_index().nearest(file1 + file2, EXAMPLE_COUNT)}
+    plan = budget.fit(
+        template,
+        model,
+        {"max_earthfile": 2000},
+        static,
+        file1=file1,
+        name1=name1,
+        file2=file2,
+        name2=name2,
     )
-    out = io.run_llm_program(
-        program,
-        earthly_basics=earthly_basics,
+    if template.levels(static)[plan.level]["earthly_basics"]:
+        compress.report(template.name, compress.digest_saving(template.name))
+    out = template(
+        llm.get(plan.model),
+        plan.level,
+        static,
         file1=file1,
         name1=name1,
         file2=file2,
         name2=name2,
-        examples=examples,
+        progress=stream.progress("merge", ["Earthfile"]),
+        **plan.max_tokens,
     )
     io.write_debug("result.md", out["Earthfile"], "merge")
-    results = markdown.extract_code_blocks(out["Earthfile"])
-    if len(results) != 1:
-        raise ValueError(f"1 Files exepected back. Instead got {len(results)}.")
+    results = markdown.expect_code_blocks(out["Earthfile"], 1)
     earthfile = results[0]
     io.write_debug("Earthfile", earthfile, "merge")
     return earthfile
@@ -0,0 +1,201 @@
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple
+
+from toearthly.core import boot, budget, constants, io, repository  # noqa: F401
+from toearthly.scripts import run
+
+DEFAULT_WORKERS = 4
+DEFAULT_CACHE_PATH = ".to_earthly/data/llm_cache.sqlite3"
+DEBUG_DIR_NAME = ".to_earthly/"
+
+
+class RepoResult(NamedTuple):
+    input_dir: str
+    ok: bool
+    seconds: float
+    error: str
+
+
+def read_manifest(path: str) -> List[str]:
+    base = os.path.dirname(os.path.abspath(path))
+    dirs = []
+    for line in io.read(path).splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        dirs.append(os.path.join(base, line))
+    return dirs
+
+
+# Non-interactive: the first workflow is used, as in scripts/dockerfile.py
+def convert_repo(input_dir: str, concurrent: bool) -> RepoResult:
+    start = time.perf_counter()
+    with io.use_debug_dir(os.path.join(input_dir, DEBUG_DIR_NAME)):
+        try:
+            _, workflow_content = io.find_first_workflow(input_dir)
+            dockerfile_path, dockerfile_content = repository.find_first_dockerfile(
+                input_dir, workflow_content
+            )
+            run.convert(
+                input_dir,
+                os.path.join(input_dir, "Earthfile"),
+                workflow_content,
+                dockerfile_content,
+                concurrent,
+                repository.build_context(input_dir, dockerfile_path),
+            )
+            error = ""
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            io.log(f"Error Type: {type(e).__name__} \n Error details: {e}")
+            io.log(f"Stack Trace: {traceback.format_exc()}")
+    seconds = time.perf_counter() - start
+    return RepoResult(input_dir, not error, seconds, error)
+
+
+def print_summary(results: List[RepoResult], wall: float) -> None:
+    succeeded = [r for r in results if r.ok]
+    print("\nBatch summary:")
+    for r in sorted(results, key=lambda r: r.seconds, reverse=True):
+        status = "ok  " if r.ok else "FAIL"
+        print(f"  {status}\t{r.seconds:7.1f}s\t{r.input_dir}")
+        if r.error:
+            print(f"\t\t\t{r.error.splitlines()[0]}")
+    print(
+        f"{len(succeeded)} succeeded, {len(results) - len(succeeded)} failed "
+        f"in {wall:.1f}s"
+    )
+
+
+def main(input_dirs: List[str], workers: int, concurrent: bool) -> List[RepoResult]:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(lambda d: convert_repo(d, concurrent), input_dirs)
+        )
+    print_summary(results, time.perf_counter() - start)
+    return results
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "input_dirs", help="Repositories to convert", nargs="*", default=[]
+    )
+    parser.add_argument(
+        "--manifest", help="File listing one repository directory per line"
+    )
+    parser.add_argument(
+        "--workers",
+        help="Repositories converted at once",
+        default=DEFAULT_WORKERS,
+        type=int,
+    )
+    parser.add_argument(
+        "--cache",
+        help="LLM response cache shared by all repositories",
+        default=DEFAULT_CACHE_PATH,
+    )
+    parser.add_argument(
+        "--verify", help="Verify Earthfile", default=True, type=bool
+    )
+    parser.add_argument(
+        "--repair_attempts",
+        help="Times to ask the LLM to fix an Earthfile that doesn't parse",
+        default=constants.REPAIR_ATTEMPTS,
+        type=int,
+    )
+    parser.add_argument(
+        "--verify_with_earthly",
+        help="Also verify with `earthly debug ast` (needs the earthly binary)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--concurrent",
+        help="Convert each workflow and Dockerfile at the same time",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Skip stages whose inputs are unchanged since the last run",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--llm_model",
+        help="Model for stages the routing config doesn't route, and to escalate to",
+        default=constants.LLM_MODEL,
+        choices=sorted(budget.CONTEXT_WINDOWS),
+    )
+    parser.add_argument(
+        "--llm_routes",
+        help="Config routing stages to models, like toearthly/data/router.json. "
+        "Without it every LLM request goes to --llm_model",
+    )
+    parser.add_argument(
+        "--llm_base_url",
+        help="OpenAI compatible API to send requests to",
+        default=constants.LLM_BASE_URL,
+    )
+    parser.add_argument(
+        "--llm_concurrency",
+        help="LLM requests in flight at once",
+        default=constants.LLM_CONCURRENCY,
+        type=int,
+    )
+    parser.add_argument(
+        "--llm_timeout",
+        help="Seconds an LLM request may take before it is retried",
+        default=constants.LLM_TIMEOUT,
+        type=float,
+    )
+    parser.add_argument(
+        "--hedge",
+        help="Send a second copy of LLM requests slower than the usual p95",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--split_jobs",
+        help="Convert workflows with at least this many jobs a job at a time, "
+        "0 converts them whole",
+        default=constants.SPLIT_JOBS,
+        type=int,
+    )
+    parser.add_argument(
+        "--fast",
+        help="Ask each stage for its answer in one generation, without a plan turn",
+        action="store_true",
+    )
+    return parser
+
+if __name__ == "__main__":
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    constants.VERIFY_EARTHFILE = args.verify
+    constants.VERIFY_WITH_EARTHLY = args.verify_with_earthly
+    constants.REPAIR_ATTEMPTS = args.repair_attempts
+    constants.CACHE_PATH = os.path.abspath(args.cache)
+    constants.RESUME = args.resume
+    constants.FAST = args.fast
+    constants.SPLIT_JOBS = args.split_jobs
+    constants.LLM_MODEL = args.llm_model
+    if args.llm_routes:
+        constants.LLM_ROUTES = os.path.abspath(args.llm_routes)
+    constants.LLM_BASE_URL = args.llm_base_url
+    constants.LLM_CONCURRENCY = args.llm_concurrency
+    constants.LLM_TIMEOUT = args.llm_timeout
+    constants.LLM_HEDGE = args.hedge
+
+    input_dirs = list(args.input_dirs)
+    if args.manifest:
+        input_dirs += read_manifest(args.manifest)
+    if not input_dirs:
+        parser.error("No input directories given.")
+
+    results = main(input_dirs, args.workers, args.concurrent)
+    sys.exit(0 if all(r.ok for r in results) else 1)
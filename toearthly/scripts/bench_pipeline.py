@@ -0,0 +1,355 @@
+import argparse
+import contextvars
+import difflib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path.insert(0, os.path.abspath(ROOT))
+
+from toearthly.core import (  # noqa: E402
+    cache,
+    cassette,
+    constants,
+    earthfile,
+    io,
+    markdown,
+    provider,
+    repository,
+    trace,
+)
+
+DATA = os.path.join(ROOT, "toearthly", "data")
+# Seeded from the fixtures on first use, outside the package
+DEFAULT_CASSETTE = os.path.abspath(
+    os.path.join(ROOT, "build", "cassettes", "pipeline.json")
+)
+DEFAULT_RUNS = 3
+# Local work reported on its own, by span kind
+PARTS = ["scan", "extract", "verify"]
+# Stages that answer with the Earthfile they were given, corrected
+ECHO_STAGES = ("earthfile_correction", "earthfile_repair")
+
+
+class Case(NamedTuple):
+    name: str
+    run: Callable[[], str]
+    # Saved answers for each stage's requests in order, for seeding the
+    # cassette: the plan, then the result
+    answers: Dict[str, List[str]]
+    # The fixture's Earthfile the result is scored against, if it has one
+    expected: Optional[str]
+
+
+_answers: contextvars.ContextVar = contextvars.ContextVar("answers", default={})
+
+
+def _saved_answers(fixture: str) -> Dict[str, List[str]]:
+    answers = {}
+    for stage in sorted(os.listdir(fixture)):
+        folder = os.path.join(fixture, stage)
+        if not os.path.isdir(folder):
+            continue
+        saved = []
+        if os.path.exists(os.path.join(folder, "plan.md")):
+            saved.append(io.read(os.path.join(folder, "plan.md")))
+        if os.path.exists(os.path.join(folder, "result.md")):
+            saved.append(io.read(os.path.join(folder, "result.md")))
+        elif os.path.exists(os.path.join(folder, "Earthfile")):
+            earthfile = io.read(os.path.join(folder, "Earthfile"))
+            saved.append(f"```Earthfile\n{earthfile}```\n")
+        answers[stage] = saved
+    return answers
+
+
+def _expected(answer: str) -> Optional[str]:
+    blocks = markdown.extract_code_blocks(answer)
+    return blocks[0] if blocks else None
+
+
+def cases() -> List[Case]:
+    from toearthly.prompt import merge
+    from toearthly.scripts import run
+
+    found = []
+    for name in sorted(os.listdir(DATA)):
+        fixture = os.path.join(DATA, name)
+        workflow = os.path.join(fixture, "workflow.yml")
+        if not os.path.exists(workflow):
+            continue
+        workflow = io.read(workflow)
+        answers = _saved_answers(fixture)
+        expected = os.path.join(fixture, "Earthfile")
+        expected = io.read(expected) if os.path.exists(expected) else None
+
+        def convert_workflow(fixture=fixture, workflow=workflow) -> str:
+            structure = repository.file_structure(fixture, workflow)
+            return run.workflow_convert(workflow, structure)
+
+        # Only fixtures of the whole pipeline, with its Earthfile, have saved
+        # answers for every stage of it
+        if expected is not None:
+            found.append(
+                Case(f"workflow_convert {name}", convert_workflow, answers, expected)
+            )
+        dockerfile = os.path.join(fixture, "Dockerfile")
+        if os.path.exists(dockerfile):
+            dockerfile = io.read(dockerfile)
+
+            def convert_dockerfile(dockerfile=dockerfile, workflow=workflow) -> str:
+                return run.dockerfile_convert(dockerfile, workflow)
+
+            saved = answers.get("dockerfile_to_earthfile") or [""]
+            found.append(
+                Case(
+                    f"dockerfile_convert {name}",
+                    convert_dockerfile,
+                    answers,
+                    _expected(saved[-1]),
+                )
+            )
+
+    n = 1
+    while os.path.exists(os.path.join(DATA, "merge", f"in{n}a.Earthfile")):
+        first = io.read(os.path.join(DATA, "merge", f"in{n}a.Earthfile"))
+        second = io.read(os.path.join(DATA, "merge", f"in{n}b.Earthfile"))
+
+        def merge_earthfiles(first=first, second=second) -> str:
+            return merge.prompt(first, "workflow.yml", second, "Dockerfile")
+
+        answer = io.read(os.path.join(DATA, "merge", f"out{n}.md"))
+        found.append(
+            Case(
+                f"merge in{n}", merge_earthfiles, {"merge": [answer]}, _expected(answer)
+            )
+        )
+        n += 1
+    return found
+
+
+# Seeds the cassette: the fixture's next saved answer for the stage (a fast
+# stage asks once, so it gets the result without the plan), otherwise
+# the Earthfile the request was given, for stages that correct one
+def seed(stage: str, request: Dict[str, Any]) -> str:
+    saved = _answers.get().get(stage)
+    if saved:
+        return saved.pop(0) if len(saved) > 1 else saved[0]
+    if stage in ECHO_STAGES:
+        for message in reversed(request["messages"]):
+            if message["role"] != "user":
+                continue
+            blocks = markdown.extract_code_blocks(message["content"], min_lines=1)
+            if blocks:
+                return f"```Earthfile\n{blocks[-1]}\n```\n"
+    raise cassette.CassetteMiss(f"{stage}: no saved answer in the fixture")
+
+
+# How good the result is, apart from how long it took: whether it parses, and
+# how much of it matches the fixture's Earthfile line by line
+def quality(result: str, expected: Optional[str]) -> Dict[str, Any]:
+    try:
+        earthfile.parse(result)
+        parses = True
+    except earthfile.EarthfileSyntaxError:
+        parses = False
+    similarity = None
+    if expected is not None:
+        matcher = difflib.SequenceMatcher(
+            None, result.strip().splitlines(), expected.strip().splitlines()
+        )
+        similarity = round(matcher.ratio(), 3)
+    return {"parses": parses, "similarity": similarity}
+
+
+# Seconds in spans of `kind` inside `span`, not counting ones nested in
+# another span of that kind
+def _seconds(spans: List[trace.Span], span: trace.Span, kind: str) -> float:
+    total = 0.0
+    for candidate in spans:
+        if candidate.kind != kind:
+            continue
+        parent = candidate.parent
+        while parent is not None and parent is not span and parent.kind != kind:
+            parent = parent.parent
+        if parent is span:
+            total += candidate.seconds
+    return total
+
+
+def _row(spans: List[trace.Span], span: trace.Span) -> Dict[str, Any]:
+    llm = _seconds(spans, span, "request")
+    row = {
+        "wall_ms": span.seconds * 1000,
+        "llm_ms": llm * 1000,
+        "local_ms": (span.seconds - llm) * 1000,
+    }
+    for part in PARTS:
+        row[f"{part}_ms"] = _seconds(spans, span, part) * 1000
+    row["requests"] = span.counts["requests"]
+    return {name: round(value, 2) for name, value in row.items()}
+
+
+# Runs every case in its own debug directory and returns its timings, and
+# each stage's, from the trace
+def run_case(case: Case, root: str) -> Dict[str, Any]:
+    directory = os.path.join(root, case.name.replace(" ", "-"))
+    answers = {stage: list(saved) for stage, saved in case.answers.items()}
+    if constants.FAST:
+        answers = {stage: saved[-1:] for stage, saved in answers.items()}
+    token = _answers.set(answers)
+    try:
+        with io.use_debug_dir(directory):
+            with trace.span("case", case.name) as span:
+                output = case.run()
+            spans = trace.spans()
+    finally:
+        _answers.reset(token)
+    result = _row(spans, span)
+    result.update(quality(output, case.expected))
+    result["stages"] = {
+        s.name: _row(spans, s) for s in spans if s.kind == "stage" and s.parent is span
+    }
+    return result
+
+
+def main(
+    cassette_path: str,
+    runs: int,
+    latency: float,
+    mode: str,
+    as_json: bool,
+    fast: bool = False,
+) -> int:
+    constants.FAST = fast
+    if mode == "replay" and not os.path.exists(cassette_path):
+        print(f"No cassette at {cassette_path}, seeding it from the fixtures")
+        mode = "seed"
+    if mode == "record":
+        constants.CASSETTE = cassette_path
+        constants.CASSETTE_MODE = cassette.RECORD
+    else:
+        player = cassette.Player(
+            cassette.Cassette(cassette_path),
+            latency,
+            seed if mode == "seed" else None,
+        )
+        provider.install(player)
+    constants.VERIFY_EARTHFILE = False
+
+    results: Dict[str, Dict[str, Any]] = {}
+    failures: Dict[str, str] = {}
+    skipped: Dict[str, str] = {}
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as root:
+        for case in cases():
+            samples = []
+            for n in range(runs):
+                # Every request has to reach the cassette, not the LLM cache
+                constants.CACHE_PATH = os.path.join(root, f"llm_cache{n}.sqlite3")
+                cache.llm_cache.clear()
+                try:
+                    samples.append(run_case(case, os.path.join(root, str(n))))
+                except cassette.CassetteMiss as e:
+                    # A fixture without answers for every stage can't seed
+                    (skipped if mode == "seed" else failures)[case.name] = str(e)
+                    break
+                except Exception as e:
+                    failures[case.name] = f"{type(e).__name__}: {e}"
+                    break
+            if samples:
+                # Best of n: the run least disturbed by the rest of the machine
+                results[case.name] = min(samples, key=lambda s: s["local_ms"])
+    wall = time.perf_counter() - start
+
+    if as_json:
+        print(
+            json.dumps(
+                {
+                    "wall_s": round(wall, 2),
+                    "fast": fast,
+                    "cases": results,
+                    "skipped": skipped,
+                    "failures": failures,
+                },
+                indent=2,
+            )
+        )
+    else:
+        columns = ["wall_ms", "llm_ms", "local_ms"] + [f"{p}_ms" for p in PARTS]
+        width = max([len(name) for name in results] + [30]) + 2
+        header = "".join(f"{c:>12}" for c in columns + ["parses", "similarity"])
+        print(" " * width + header)
+        for name, result in results.items():
+            rows = [(name, result)]
+            rows += [(f"  {stage}", row) for stage, row in result["stages"].items()]
+            for label, row in rows:
+                cells = "".join(f"{row[c]:>12.1f}" for c in columns)
+                if "parses" in row:
+                    similarity = row["similarity"]
+                    cells += f"{str(row['parses']):>12}"
+                    cells += f"{'-' if similarity is None else similarity:>12}"
+                print(f"{label:<{width}}{cells}")
+        if fast:
+            print("fast mode: one generation per stage")
+        print(f"total wall time: {wall:.2f}s")
+        for name, reason in skipped.items():
+            print(f"skipped {name}: {reason}")
+        for name, error in failures.items():
+            print(f"FAILED {name}: {error}")
+    return 1 if failures else 0
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Runs the conversion pipeline over the fixtures in "
+        "toearthly/data with LLM answers from a cassette, and reports where the "
+        "local time goes."
+    )
+    parser.add_argument(
+        "--cassette", help="Cassette file", default=DEFAULT_CASSETTE
+    )
+    parser.add_argument(
+        "--runs", help="Best of this many runs", default=DEFAULT_RUNS, type=int
+    )
+    parser.add_argument(
+        "--latency",
+        help="Replay answers taking this share of their recorded time",
+        default=0.0,
+        type=float,
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--record",
+        help="Send requests to the API and record the answers",
+        dest="mode",
+        action="store_const",
+        const="record",
+        default="replay",
+    )
+    mode.add_argument(
+        "--seed",
+        help="Answer requests missing from the cassette with the fixtures' saved "
+        "answers, and record them",
+        dest="mode",
+        action="store_const",
+        const="seed",
+    )
+    parser.add_argument(
+        "--fast",
+        help="Run stages in fast mode, to compare against a normal run",
+        action="store_true",
+    )
+    parser.add_argument("--json", help="Print JSON for tracking", action="store_true")
+    return parser
+
+if __name__ == "__main__":
+    parser = get_arg_parser()
+    args = parser.parse_args()
+
+    sys.exit(
+        main(args.cassette, args.runs, args.latency, args.mode, args.json, args.fast)
+    )
@@ -2,9 +2,7 @@ import argparse
 import traceback
 from textwrap import dedent
 
-import openai
-
-from toearthly.core import boot, constants, io  # noqa: F401
+from toearthly.core import boot, constants, io, llm, repository  # noqa: F401
 from toearthly.prompt import dockerfile_to_earthfile
 
 # Default directories
@@ -42,8 +40,10 @@ or via https://github.com/adamgordonbell/to-earthly
 def main(input_dir: str, earthfile_path: str) -> None:
     try:
         print(intro)
-        dockerfile_path, dockerfile_content = io.find_first_dockerfile(input_dir)
         workflow_path, workflow_content = io.find_first_workflow(input_dir)
+        dockerfile_path, dockerfile_content = repository.find_first_dockerfile(
+            input_dir, workflow_content
+        )
         print(
             dedent(
                 f"""
@@ -58,11 +58,15 @@ def main(input_dir: str, earthfile_path: str) -> None:
 
         print("Starting...\n (This may take 10 minutes)")
         print("Running Stage 1 - Dockerfile To Earthfile")
-        earthfile = dockerfile_to_earthfile.prompt(dockerfile_content, workflow_content)
+        earthfile = dockerfile_to_earthfile.prompt(
+            dockerfile_content,
+            workflow_content,
+            repository.build_context(input_dir, dockerfile_path),
+        )
 
         io.verify(earthfile)
         io.write(constants.EARTHLY_WARNING + earthfile, earthfile_path)
-    except openai.error.InvalidRequestError as e:
+    except llm.invalid_request_error() as e:
         print("Error: We were unable to convert this workflow.")
         io.log(f"Error Type: openai.error.InvalidRequestError \n Error details: {e}")
     except (ValueError, TypeError, IndexError, KeyError) as e:
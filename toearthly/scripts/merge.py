@@ -2,9 +2,7 @@ import argparse
 import traceback
 from textwrap import dedent
 
-import openai
-
-from toearthly.core import boot, constants, io  # noqa: F401
+from toearthly.core import boot, constants, io, llm  # noqa: F401
 from toearthly.prompt import merge
 
 # Default directories
@@ -34,7 +32,7 @@ def main(input_dir: str, earthfile_path: str) -> None:
         earthfile = merge.prompt(file1, "python.yml", file2, "Dockerfile")
         io.verify(earthfile)
         io.write(constants.EARTHLY_WARNING + earthfile, earthfile_path)
-    except openai.error.InvalidRequestError as e:
+    except llm.invalid_request_error() as e:
         print("Error: We were unable to convert this workflow.")
         io.log(f"Error Type: openai.error.InvalidRequestError \n Error details: {e}")
     except (ValueError, TypeError, IndexError, KeyError) as e:
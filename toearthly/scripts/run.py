@@ -1,16 +1,31 @@
 import argparse
+import contextvars
+import os
+import threading
+import time
 import traceback
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from textwrap import dedent
-from typing import Tuple
+from typing import Callable, Dict, List, Sequence, Tuple
 
-import inquirer
-import openai
-
-from toearthly.core import boot, constants, io  # noqa: F401
+from toearthly.core import (  # noqa: F401
+    boot,
+    budget,
+    checkpoint,
+    constants,
+    io,
+    llm,
+    merger,
+    repair,
+    repository,
+    trace,
+)
+from toearthly.core import workflow as gha
 from toearthly.prompt import (
     bash_to_earthly,
     dockerfile_to_earthfile,
     earthfile_correction,
+    earthfile_repair,
     gha_to_bash,
     merge,
 )
@@ -48,6 +63,8 @@ or via https://github.com/adamgordonbell/to-earthly
 def select_workflow(input_dir: str) -> Tuple[str, str]:
     ymls = io.find_workflows(input_dir)
     if len(ymls) != 1:
+        import inquirer
+
         questions = [
             inquirer.List(
                 "option",
@@ -63,33 +80,311 @@ def select_workflow(input_dir: str) -> Tuple[str, str]:
         yml = file.read()
     return (path, yml)
 
+# Repairs what the parser rejects, a target at a time, before verifying
+def verify(earthfile: str, subfolder: str = None) -> str:
+    earthfile = repair.repair(
+        earthfile, earthfile_repair.prompt, constants.REPAIR_ATTEMPTS
+    )
+    io.verify(earthfile, subfolder)
+    return earthfile
+
+def correct_earthfile(earthfile: str, workflow: str, file_structure: str) -> str:
+    earthfile = earthfile_correction.prompt(earthfile, workflow, file_structure)
+    return verify(earthfile, "earthfile_correction")
+
+def translate_dockerfile(
+    dockerfile_content: str, workflow_content: str, context: str = ""
+) -> str:
+    earthfile = dockerfile_to_earthfile.prompt(
+        dockerfile_content, workflow_content, context
+    )
+    return verify(earthfile, "dockerfile_to_earthfile")
+
+def merge_earthfiles(
+    earthfile1: str,
+    earthfile2: str,
+    name1: str = "workflow.yml",
+    name2: str = "Dockerfile",
+) -> str:
+    earthfile = merge.prompt(earthfile1, name1, earthfile2, name2)
+    return verify(earthfile)
+
 def workflow_convert(workflow: str, file_structure : str)-> str:
+    jobs = split_jobs(workflow)
+    if jobs:
+        return jobs_convert(jobs, file_structure)
+    return stages_convert(workflow, file_structure)
+
+def stages_convert(workflow: str, file_structure : str)-> str:
     print("Running Stage 1 - GitHub Actions to Bash")
-    runfile, dockerfile, buildfile = gha_to_bash.prompt(workflow, file_structure)
+    runfile, dockerfile, buildfile = checkpoint.run_stage(
+        "gha_to_bash", gha_to_bash.prompt, workflow, file_structure
+    )
 
     print("Running Stage 2 - Bash to Earthly")
-    earthfile = bash_to_earthly.prompt(
-        file_structure, runfile, dockerfile, buildfile
+    earthfile = checkpoint.run_stage(
+        "bash_to_earthly",
+        bash_to_earthly.prompt,
+        file_structure,
+        runfile,
+        dockerfile,
+        buildfile,
     )
 
     print("Running Stage 3 - Earthfile Correction")
-    earthfile = earthfile_correction.prompt(earthfile, workflow, file_structure)
-    io.verify(earthfile)
-    return earthfile
+    return checkpoint.run_stage(
+        "earthfile_correction", correct_earthfile, earthfile, workflow, file_structure
+    )
+
+# The workflow's jobs, if it has constants.SPLIT_JOBS or more, see jobs_convert
+def split_jobs(workflow: str) -> List[Tuple[str, str, Tuple[str, ...]]]:
+    if not constants.SPLIT_JOBS:
+        return []
+    try:
+        parsed = gha.parse(workflow)
+        if len(parsed.jobs) < constants.SPLIT_JOBS:
+            return []
+        return gha.split(parsed)
+    except ValueError as e:
+        io.log(f"Converting the workflow whole, it can't be split by job: {e}")
+        return []
 
-def dockerfile_convert(dockerfile_content: str, workflow_content : str)-> str:
+# Converts each job as a workflow of its own, all at once, so prompts and
+# answers stay the size of one job however many the workflow has. The jobs'
+# Earthfiles are stitched together with BUILDs that follow `needs:`, or merged
+# like separate workflows' if they can't be.
+def jobs_convert(
+    jobs: Sequence[Tuple[str, str, Tuple[str, ...]]], file_structure: str
+) -> str:
+    def branch(id: str, content: str) -> Callable[[], str]:
+        def run() -> str:
+            with io.use_debug_subdir(f"job-{id}"):
+                io.write_debug("workflow.yml", content)
+                return stages_convert(content, file_structure)
+
+        return run
+
+    print(f"Converting the workflow's {len(jobs)} jobs separately...")
+    results = run_branches({id: branch(id, content) for id, content, _ in jobs}, True)
+    parts = [(id, results[id], needs) for id, _, needs in jobs]
+    try:
+        earthfile = merger.stitch(parts)
+    except merger.MergeConflict as e:
+        io.log(f"Stitching the jobs failed, merging them instead: {e}")
+        return merge_tree([(id, earthfile) for id, earthfile, _ in parts])
+    return verify(earthfile, "stitch")
+
+# `context` is the Dockerfile's build context, see repository.build_context
+def dockerfile_convert(
+    dockerfile_content: str, workflow_content: str, context: str = ""
+) -> str:
     if not dockerfile_content:
         return ""
     print("Running Stage 1 - Dockerfile To Earthfile")
-    earthfile = dockerfile_to_earthfile.prompt(dockerfile_content, workflow_content)
-    io.verify(earthfile)
-    return earthfile
+    return checkpoint.run_stage(
+        "dockerfile_to_earthfile",
+        translate_dockerfile,
+        dockerfile_content,
+        workflow_content,
+        context,
+    )
+
+def run_branches(
+    branches: Dict[str, Callable[[], str]], concurrent: bool
+) -> Dict[str, str]:
+    timings: Dict[str, float] = {}
+    failed = threading.Event()
+
+    def timed(name: str, branch: Callable[[], str]) -> str:
+        start = time.perf_counter()
+        try:
+            with checkpoint.cancellable(failed):
+                return branch()
+        finally:
+            timings[name] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results: Dict[str, str] = {}
+    if concurrent:
+        executor = ThreadPoolExecutor(max_workers=len(branches))
+        try:
+            futures = {
+                name: executor.submit(
+                    contextvars.copy_context().run, timed, name, branch
+                )
+                for name, branch in branches.items()
+            }
+            done, _ = wait(futures.values(), return_when=FIRST_EXCEPTION)
+            errors = [f.exception() for f in done if f.exception() is not None]
+            if errors:
+                # The other branches stop at their next stage or LLM call.
+                # Waiting for them keeps their requests from outliving the run.
+                failed.set()
+                wait(futures.values())
+                raise errors[0]
+            results = {name: future.result() for name, future in futures.items()}
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    else:
+        for name, branch in branches.items():
+            results[name] = timed(name, branch)
+    wall = time.perf_counter() - start
+
+    print("\nBranch timings:")
+    for name, seconds in timings.items():
+        print(f"  {name}:\t{seconds:.1f}s")
+    print(f"  wall:\t\t{wall:.1f}s (saved {sum(timings.values()) - wall:.1f}s)")
+    return results
+
+def convert(
+    input_dir: str,
+    earthfile_path: str,
+    workflow_content: str,
+    dockerfile_content: str,
+    concurrent: bool = False,
+    dockerfile_context: str = "",
+) -> None:
+    file_structure = repository.file_structure(
+        input_dir, workflow_content, [earthfile_path]
+    )
+
+    print("Starting Workflow and Dockerfile Conversion...")
+    print("(This may take 10 minutes)")
+    results = run_branches(
+        {
+            "workflow": lambda: workflow_convert(workflow_content, file_structure),
+            "dockerfile": lambda: dockerfile_convert(
+                dockerfile_content, workflow_content, dockerfile_context
+            ),
+        },
+        concurrent,
+    )
+    earthfile1 = results["workflow"]
+    earthfile2 = results["dockerfile"]
+
+    print("Merging Earthfiles...\n")
+    earthfile = checkpoint.run_stage(
+        "merge", merge_earthfiles, earthfile1, earthfile2
+    )
+
+    print("Saving Earthfile.\n")
+    io.write(constants.EARTHLY_WARNING + earthfile, earthfile_path)
+
+# Merges neighbouring (name, Earthfile) pairs, all at once, until one is left,
+# so n Earthfiles take log2(n) rounds of merges rather than n - 1. A merged
+# pair keeps the first one's name, which the merger names the second one's
+# conflicting targets after. Each merge keeps its debug files in a folder of
+# its own.
+def merge_tree(earthfiles: List[Tuple[str, str]]) -> str:
+    def merge_pair(folder: str, pair: List[Tuple[str, str]]) -> Tuple[str, str]:
+        if len(pair) == 1:
+            return pair[0]
+        (name1, earthfile1), (name2, earthfile2) = pair
+        print(f"Merging {name1} and {name2}...")
+        with io.use_debug_subdir(folder):
+            earthfile = checkpoint.run_stage(
+                "merge", merge_earthfiles, earthfile1, earthfile2, name1, name2
+            )
+        return (name1, earthfile)
+
+    rounds = 0
+    while len(earthfiles) > 1:
+        rounds += 1
+        pairs = [earthfiles[i:i + 2] for i in range(0, len(earthfiles), 2)]
+        with ThreadPoolExecutor(max_workers=len(pairs)) as executor:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    merge_pair,
+                    f"merge{rounds}-{n}",
+                    pair,
+                )
+                for n, pair in enumerate(pairs)
+            ]
+            earthfiles = [future.result() for future in futures]
+    return earthfiles[0][1] if earthfiles else ""
+
+# The workflow the Dockerfile is converted alongside: the one that says the
+# most about docker, as only its docker steps matter to that stage
+def docker_workflow(workflows: Dict[str, str]) -> str:
+    return max(workflows.values(), key=lambda content: content.lower().count("docker"))
+
+# Converts every workflow, each with its own files listing and debug folder,
+# and the Dockerfile all at once, then merges the results with merge_tree
+def convert_all(
+    input_dir: str,
+    earthfile_path: str,
+    workflows: Dict[str, str],
+    dockerfile_content: str,
+    dockerfile_context: str = "",
+) -> None:
+    def branch(path: str, content: str) -> Callable[[], str]:
+        def run() -> str:
+            with io.use_debug_subdir(os.path.basename(path)):
+                io.write_debug("workflow.yml", content)
+                file_structure = repository.file_structure(
+                    input_dir, content, [earthfile_path]
+                )
+                return workflow_convert(content, file_structure)
+
+        return run
+
+    print(f"Starting Conversion of {len(workflows)} Workflows and the Dockerfile...")
+    print("(This may take 10 minutes)")
+    branches = {
+        os.path.basename(path): branch(path, content)
+        for path, content in workflows.items()
+    }
+    branches["Dockerfile"] = lambda: dockerfile_convert(
+        dockerfile_content, docker_workflow(workflows), dockerfile_context
+    )
+    results = run_branches(branches, True)
 
-def main(input_dir: str, earthfile_path: str) -> None:
+    print("Merging Earthfiles...\n")
+    earthfile = merge_tree(list(results.items()))
+
+    print("Saving Earthfile.\n")
+    io.write(constants.EARTHLY_WARNING + earthfile, earthfile_path)
+
+def main_all(input_dir: str, earthfile_path: str) -> None:
+    workflows = {path: io.read(path) for path in io.find_workflows(input_dir)}
+    dockerfile_path, dockerfile_content = repository.find_first_dockerfile(
+        input_dir, docker_workflow(workflows)
+    )
+    listing = "".join(f"\n  {path}" for path in workflows)
+    print(f"\nInput:\nWorkflows:{listing}")
+    print(
+        dedent(
+            f"""\
+            Dockerfile:\t{dockerfile_path}
+            Output:\t\t{earthfile_path}
+            Debug files:\t{io.debug_dir()}
+            """
+        )
+    )
+    convert_all(
+        input_dir,
+        earthfile_path,
+        workflows,
+        dockerfile_content,
+        repository.build_context(input_dir, dockerfile_path),
+    )
+
+def main(
+    input_dir: str,
+    earthfile_path: str,
+    concurrent: bool = False,
+    all_workflows: bool = False,
+) -> None:
     try:
         print(intro)
+        if all_workflows:
+            main_all(input_dir, earthfile_path)
+            return
         workflow_path, workflow_content = select_workflow(input_dir)
-        dockerfile_path, dockerfile_content = io.find_first_dockerfile(input_dir)
+        dockerfile_path, dockerfile_content = repository.find_first_dockerfile(
+            input_dir, workflow_content
+        )
         print(
             dedent(
                 f"""
@@ -97,34 +392,32 @@ def main(input_dir: str, earthfile_path: str) -> None:
               Workflow:\t{workflow_path}
               Dockerfile:\t{dockerfile_path}
               Output:\t\t{earthfile_path}
-              Debug files:\t{constants.DEBUG_DIR}
+              Debug files:\t{io.debug_dir()}
               """
             )
         )
-        file_structure = io.print_directory(input_dir)
-
-        print("Starting Workflow Conversion...\n (This may take 10 minutes)")
-        earthfile1 = workflow_convert(workflow_content, file_structure)
-
-        print("\nStarting Dockerfile Conversion...")
-        earthfile2 = dockerfile_convert(dockerfile_content, workflow_content)
-
-        print("Merging Earthfiles...\n")
-        earthfile = merge.prompt(earthfile1, "workflow.yml", earthfile2, "Dockerfile")
-        io.verify(earthfile)
-
-        print("Saving Earthfile.\n")
-        io.write(constants.EARTHLY_WARNING + earthfile, earthfile_path)
-
-
-    except openai.error.InvalidRequestError as e:
+        convert(
+            input_dir,
+            earthfile_path,
+            workflow_content,
+            dockerfile_content,
+            concurrent,
+            repository.build_context(input_dir, dockerfile_path),
+        )
+    except llm.invalid_request_error() as e:
         print("Error: We were unable to convert this workflow.")
         io.log(f"Error Type: openai.error.InvalidRequestError \n Error details: {e}")
     except (ValueError, TypeError, IndexError, KeyError) as e:
         print("Error: We were unable to convert this workflow.")
-        trace = traceback.format_exc()
+        stack_trace = traceback.format_exc()
         io.log(f"Error Type: {type(e).__name__} \n Error details: {e}")
-        io.log(f"Stack Trace: {trace}")
+        io.log(f"Stack Trace: {stack_trace}")
+    finally:
+        summary = trace.summary()
+        if summary:
+            print(f"\nTrace, details in {os.path.join(io.debug_dir(), trace.TRACE)}:")
+            print(summary)
+        trace.forget()
 
 
 def get_arg_parser():
@@ -138,9 +431,88 @@ def get_arg_parser():
     parser.add_argument(
         "--debug_dir", help="Debug directory location", default=DEFAULT_DEBUG_DIR
     )
+    parser.add_argument(
+        "--cache", help="LLM response cache file (default: in debug directory)"
+    )
     parser.add_argument(
         "--verify", help="Verify Earthfile", default=True, type=bool
     )
+    parser.add_argument(
+        "--repair_attempts",
+        help="Times to ask the LLM to fix an Earthfile that doesn't parse",
+        default=constants.REPAIR_ATTEMPTS,
+        type=int,
+    )
+    parser.add_argument(
+        "--verify_with_earthly",
+        help="Also verify with `earthly debug ast` (needs the earthly binary)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--concurrent",
+        help="Convert the workflow and the Dockerfile at the same time",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Skip stages whose inputs are unchanged since the last run",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--llm_model",
+        help="Model for stages the routing config doesn't route, and to escalate to",
+        default=constants.LLM_MODEL,
+        choices=sorted(budget.CONTEXT_WINDOWS),
+    )
+    parser.add_argument(
+        "--llm_routes",
+        help="Config routing stages to models, like toearthly/data/router.json. "
+        "Without it every LLM request goes to --llm_model",
+    )
+    parser.add_argument(
+        "--llm_base_url",
+        help="OpenAI compatible API to send requests to",
+        default=constants.LLM_BASE_URL,
+    )
+    parser.add_argument(
+        "--llm_concurrency",
+        help="LLM requests in flight at once",
+        default=constants.LLM_CONCURRENCY,
+        type=int,
+    )
+    parser.add_argument(
+        "--llm_timeout",
+        help="Seconds an LLM request may take before it is retried",
+        default=constants.LLM_TIMEOUT,
+        type=float,
+    )
+    parser.add_argument(
+        "--hedge",
+        help="Send a second copy of LLM requests slower than the usual p95",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream",
+        help="Show LLM progress as it streams and stop once the code is complete",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--all_workflows",
+        help="Convert every workflow instead of picking one, and merge the results",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--split_jobs",
+        help="Convert workflows with at least this many jobs a job at a time, "
+        "0 converts them whole",
+        default=constants.SPLIT_JOBS,
+        type=int,
+    )
+    parser.add_argument(
+        "--fast",
+        help="Ask each stage for its answer in one generation, without a plan turn",
+        action="store_true",
+    )
     return parser
 
 if __name__ == "__main__":
@@ -149,5 +521,19 @@ if __name__ == "__main__":
 
     constants.DEBUG_DIR = args.debug_dir
     constants.VERIFY_EARTHFILE = args.verify
+    constants.VERIFY_WITH_EARTHLY = args.verify_with_earthly
+    constants.REPAIR_ATTEMPTS = args.repair_attempts
+    constants.CACHE_PATH = args.cache
+    constants.RESUME = args.resume
+    constants.STREAM = args.stream
+    constants.FAST = args.fast
+    constants.SPLIT_JOBS = args.split_jobs
+    constants.LLM_MODEL = args.llm_model
+    if args.llm_routes:
+        constants.LLM_ROUTES = os.path.abspath(args.llm_routes)
+    constants.LLM_BASE_URL = args.llm_base_url
+    constants.LLM_CONCURRENCY = args.llm_concurrency
+    constants.LLM_TIMEOUT = args.llm_timeout
+    constants.LLM_HEDGE = args.hedge
 
-    main(args.input_dir, args.earthfile)
+    main(args.input_dir, args.earthfile, args.concurrent, args.all_workflows)